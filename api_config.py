@@ -20,6 +20,7 @@ API_HOST = os.getenv('API_HOST', '127.0.0.1')
 API_PORT = int(os.getenv('API_PORT', 5000))
 API_DEBUG = os.getenv('API_DEBUG', 'False').lower() == 'true'
 API_SECRET_KEY = os.getenv('API_SECRET_KEY', '7dfb94af7de547e09e83ce29ec99aacd')
+API_WARMUP = os.getenv('API_WARMUP', 'False').lower() == 'true'  # Preriscaldamento delle connessioni all'avvio
 
 # Directory
 DOWNLOADS_DIR = "downloads"
@@ -5,22 +5,41 @@ Questo modulo implementa le route API Flask per Telegram Media Downloader
 utilizzando blueprints per organizzare meglio il codice.
 """
 
-from flask import Blueprint, request, jsonify, current_app, send_from_directory
+from flask import Blueprint, request, jsonify, current_app, send_from_directory, Response
 import os
 import time
 import asyncio
-import threading
+import sqlite3
 
 from api_security import require_api_token, require_admin_role
 from utils import load_json, save_json, log_error, log_info, get_instance_id
 from websocket_manager import get_websocket_manager
-from config import DOWNLOADS_DIR
+from config import DOWNLOADS_DIR, ARCHIVE_DIR
 
 # Importazioni per le funzionalità del backend
 from user_management import verify_and_add_user
 from group_management import get_all_user_groups, get_group_link
 from media_handler import download_group_archive
+from sharded_archive import download_sharded_archive, find_group_accounts, is_shardable
+from archive_filters import ArchiveFilter, parse_date
+from archive_progress import ArchiveProgress
+from archive_export import ArchiveExport, EXPORT_FORMATS
+from lazy_media import get_lazy_index
+from message_export import EXPORT_FILE, load_export_index, refresh_message_export, select_chunks
 from event_handler import start_monitoring, cleanup_session_files
+from connection_pool import connection_pool
+from session_manager import session_manager
+from session_storage import session_store
+from telegram_engine import telegram_engine
+from rate_limiter import ScheduledTelegramClient, request_scheduler
+from exported_senders import exported_senders
+from media_store import media_store
+from user_cache import user_cache
+from job_queue import job_queue
+from message_store import message_store, search_order_key
+from text_writer import text_writer
+from media_index import media_index
+from path_resolver import path_resolver
 
 # Crea un blueprint per le API
 api_bp = Blueprint('api', __name__, url_prefix='/api')
@@ -31,11 +50,20 @@ active_operations = {}
 # Dizionario per tenere traccia delle autenticazioni in corso
 pending_authentications = {}
 
-def run_authentication(nickname, phone, auth_id):
-    """Esegue l'autenticazione in un thread separato e invia aggiornamenti via WebSocket"""
-    from telethon import TelegramClient, errors
+async def run_authentication(nickname, phone, auth_id):
+    """
+    Esegue l'autenticazione di un account
+
+    L'accesso esclusivo alla sessione viene preso solo per creare la chiave
+    di autorizzazione e per completare il login, non durante l'attesa del
+    codice: monitoraggi e archivi dell'account non restano bloccati.
+    """
+    return await authenticate_account(nickname, phone, auth_id)
+
+async def authenticate_account(nickname, phone, auth_id):
+    """Esegue l'autenticazione sul motore Telegram e invia aggiornamenti via WebSocket"""
+    from telethon import errors
     from config import API_ID, API_HASH, PHONE_NUMBERS_FILE
-    import nest_asyncio  # Se questa importazione fallisce, installa con: pip install nest_asyncio
     
     # Ottieni il gestore WebSocket
     socketio_manager = get_websocket_manager()
@@ -60,28 +88,22 @@ def run_authentication(nickname, phone, auth_id):
                 'message': 'In attesa del codice di verifica'
             })
         
-        # Crea un nuovo loop di eventi
-        loop = asyncio.new_event_loop()
-        
-        # Importante: imposta il loop come loop corrente per questo thread
-        asyncio.set_event_loop(loop)
-        
-        # Patch del loop per supportare operazioni nidificate
-        nest_asyncio.apply(loop)
-        
-        # Ora esegui le operazioni di autenticazione
-        client = TelegramClient(f'session_{nickname}', API_ID, API_HASH)
-        
-        # Connetti il client
-        loop.run_until_complete(client.connect())
-        
-        # Verifica se l'utente è già autorizzato
-        is_authorized = loop.run_until_complete(client.is_user_authorized())
+        # La connessione può creare la chiave di autorizzazione: nessun'altra connessione nel frattempo
+        async with session_manager.use(nickname, exclusive=True):
+            # Esegui le operazioni di autenticazione sulla sessione condivisa dell'account
+            _, session = session_manager.create_session(nickname)
+            client = ScheduledTelegramClient(session, API_ID, API_HASH)
+            
+            # Connetti il client
+            await client.connect()
+            
+            # Verifica se l'utente è già autorizzato
+            is_authorized = await client.is_user_authorized()
+            
+            # Invia il codice di verifica
+            sent_code = None if is_authorized else await client.send_code_request(phone)
         
         if not is_authorized:
-            # Invia il codice di verifica
-            sent_code = loop.run_until_complete(client.send_code_request(phone))
-            
             # Aggiorna lo stato
             if socketio_manager:
                 socketio_manager.broadcast_event('auth_status', {
@@ -111,12 +133,11 @@ def run_authentication(nickname, phone, auth_id):
                     
                     pending_authentications[auth_id]['status'] = 'timeout'
                     if client.is_connected():
-                        loop.run_until_complete(client.disconnect())
-                    loop.close()
+                        await client.disconnect()
                     return False
                 
-                # Breve attesa - usa sleep sincrono perché siamo in un thread separato
-                time.sleep(1)
+                # Breve attesa senza bloccare le altre operazioni del motore
+                await asyncio.sleep(1)
             
             # Ottieni il codice
             code = pending_authentications[auth_id]['code']
@@ -132,24 +153,28 @@ def run_authentication(nickname, phone, auth_id):
             # Aggiorna lo stato
             pending_authentications[auth_id]['status'] = 'verifying_code'
             
-            # Completa l'autenticazione con il codice
-            try:
-                loop.run_until_complete(client.sign_in(phone, code, phone_code_hash=sent_code.phone_code_hash))
-                pending_authentications[auth_id]['status'] = 'authenticated'
-            except errors.SessionPasswordNeededError:
-                # Gestione autenticazione 2FA
-                if socketio_manager:
-                    socketio_manager.broadcast_event('auth_status', {
-                        'auth_id': auth_id,
-                        'status': 'password_required',
-                        'message': 'È richiesta la password di autenticazione a due fattori'
-                    })
+            # Completa l'autenticazione con il codice: il login salva la nuova autorizzazione
+            async with session_manager.use(nickname, exclusive=True):
+                try:
+                    await client.sign_in(phone, code, phone_code_hash=sent_code.phone_code_hash)
+                    pending_authentications[auth_id]['status'] = 'authenticated'
+                except errors.SessionPasswordNeededError:
+                    # Gestione autenticazione 2FA
+                    if socketio_manager:
+                        socketio_manager.broadcast_event('auth_status', {
+                            'auth_id': auth_id,
+                            'status': 'password_required',
+                            'message': 'È richiesta la password di autenticazione a due fattori'
+                        })
+                    
+                    pending_authentications[auth_id]['status'] = 'password_required'
+                    if client.is_connected():
+                        await client.disconnect()
+                    return False
                 
-                pending_authentications[auth_id]['status'] = 'password_required'
-                if client.is_connected():
-                    loop.run_until_complete(client.disconnect())
-                loop.close()
-                return False
+                # Assicura che la nuova autorizzazione sia salvata prima di rilasciare l'account
+                # (senza bloccare il loop del motore)
+                await asyncio.get_running_loop().run_in_executor(None, session_store.flush)
         else:
             # Già autenticato
             if socketio_manager:
@@ -163,10 +188,7 @@ def run_authentication(nickname, phone, auth_id):
         
         # Disconnetti il client
         if client.is_connected():
-            loop.run_until_complete(client.disconnect())
-        
-        # Chiudi il loop
-        loop.close()
+            await client.disconnect()
         
         # Se autenticato con successo, salva l'utente
         if pending_authentications[auth_id]['status'] in ['authenticated', 'already_authenticated']:
@@ -201,15 +223,8 @@ def run_authentication(nickname, phone, auth_id):
         pending_authentications[auth_id]['error'] = error_msg
     
     finally:
-        # Rimuovi l'autenticazione dopo un po' di tempo
-        def cleanup_auth():
-            time.sleep(600)  # 10 minuti
-            if auth_id in pending_authentications:
-                del pending_authentications[auth_id]
-        
-        cleanup_thread = threading.Thread(target=cleanup_auth)
-        cleanup_thread.daemon = True
-        cleanup_thread.start()
+        # Rimuovi l'autenticazione dopo 10 minuti
+        asyncio.get_running_loop().call_later(600, pending_authentications.pop, auth_id, None)
 
 @api_bp.route('/users/authenticate', methods=['POST'])
 @require_api_token
@@ -224,24 +239,21 @@ def start_user_authentication():
     socketio_manager = get_websocket_manager()
     
     # Verifica se esiste già una sessione per questo utente
-    session_file = f'session_{data["nickname"]}.session'
-    if os.path.exists(session_file):
+    if session_manager.has_session(data["nickname"]):
         # Verifica se la sessione è valida
         try:
-            from telethon import TelegramClient
             from config import API_ID, API_HASH
             
             async def check_session():
-                client = TelegramClient(f'session_{data["nickname"]}', API_ID, API_HASH)
-                await client.connect()
+                _, session = session_manager.create_session(data["nickname"])
+                client = ScheduledTelegramClient(session, API_ID, API_HASH)
+                async with session_manager.use(data["nickname"]):
+                    await client.connect()
                 is_authorized = await client.is_user_authorized()
                 await client.disconnect()
                 return is_authorized
             
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            is_authorized = loop.run_until_complete(check_session())
-            loop.close()
+            is_authorized = telegram_engine.run(check_session(), timeout=60)
             
             if is_authorized:
                 # Invia una notifica WebSocket qui
@@ -263,7 +275,7 @@ def start_user_authentication():
     # Crea un ID univoco per questa operazione di autenticazione
     auth_id = f"auth_{int(time.time())}"
     
-    # Invia una notifica WebSocket iniziale prima di avviare il thread
+    # Invia una notifica WebSocket iniziale prima di avviare l'autenticazione
     if socketio_manager:
         socketio_manager.broadcast_event('auth_status', {
             'auth_id': auth_id,
@@ -273,13 +285,12 @@ def start_user_authentication():
         })
         print(f"Inviato evento auth_status 'starting' per {data['nickname']}")
     
-    # Avvia l'autenticazione in background
-    auth_thread = threading.Thread(
-        target=run_authentication,
-        args=(data['nickname'], data['phone'], auth_id)
+    # Avvia l'autenticazione in background sul motore Telegram
+    telegram_engine.submit(
+        run_authentication(data['nickname'], data['phone'], auth_id),
+        name=auth_id,
+        task_type="authentication"
     )
-    auth_thread.daemon = True
-    auth_thread.start()
     
     return jsonify({
         "status": "pending",
@@ -388,7 +399,9 @@ def api_status():
     return jsonify({
         "status": "online",
         "version": "1.0.0",
-        "time": time.strftime("%Y-%m-%d %H:%M:%S")
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "ready": connection_pool.is_ready(),
+        "warmup": connection_pool.get_warmup_status()
     })
 
 # API per la gestione degli utenti
@@ -419,15 +432,12 @@ def add_user():
     if not data or 'nickname' not in data or 'phone' not in data:
         return jsonify({"error": "Dati mancanti. Richiesti 'nickname' e 'phone'"}), 400
     
-    # Implementazione asincrona dell'aggiunta utente
-    loop = asyncio.new_event_loop()
+    # Implementazione asincrona dell'aggiunta utente sul motore Telegram
     try:
-        success = loop.run_until_complete(verify_and_add_user(data['nickname'], data['phone']))
+        success = telegram_engine.run(verify_and_add_user(data['nickname'], data['phone']))
     except Exception as e:
         log_error(f"Errore durante l'aggiunta dell'utente: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        loop.close()
     
     if success:
         return jsonify({
@@ -455,13 +465,19 @@ def delete_user(nickname):
     del phone_numbers[nickname]
     save_json(PHONE_NUMBERS_FILE, phone_numbers)
     
-    # Rimuove il file di sessione se esiste
-    session_file = f'session_{nickname}.session'
-    if os.path.exists(session_file):
-        try:
-            os.remove(session_file)
-        except Exception as e:
-            log_error(f"Impossibile rimuovere il file di sessione: {e}")
+    # Chiude l'eventuale connessione persistente dell'utente
+    connection_pool.evict(nickname)
+    
+    # Rimuove la sessione dall'archivio e il vecchio file se esiste,
+    # attendendo che finiscano eventuali connessioni o login in corso
+    async def delete_session():
+        async with session_manager.use(nickname, exclusive=True):
+            await exported_senders.close_account(nickname)
+            session_manager.delete(nickname)
+            # L'eliminazione deve essere salvata prima di rilasciare l'account
+            await asyncio.get_running_loop().run_in_executor(None, session_store.flush)
+    
+    telegram_engine.run(delete_session(), timeout=60)
     
     return jsonify({
         "status": "success", 
@@ -473,15 +489,11 @@ def delete_user(nickname):
 @require_api_token
 def get_groups():
     """Ottiene la lista dei gruppi disponibili"""
-    from config import USER_GROUPS_FILE, LOCK_FILE
-    
-    # Crea una nuova istanza per questa operazione
-    instance_id = get_instance_id()
+    from config import USER_GROUPS_FILE
     
-    # Esegui in modo sincrono la funzione asincrona
-    loop = asyncio.new_event_loop()
     try:
-        success = loop.run_until_complete(get_all_user_groups(instance_id))
+        # Esegui la funzione asincrona sulle connessioni persistenti del pool
+        success = telegram_engine.run(get_all_user_groups(pool=connection_pool))
         
         if success:
             # Carica i dati dei gruppi
@@ -505,24 +517,14 @@ def get_groups():
     except Exception as e:
         log_error(f"Errore durante il recupero dei gruppi: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        loop.close()
-        # Pulizia dei file di sessione
-        cleanup_session_files(instance_id)
 
 @api_bp.route('/groups/<int:group_id>/link', methods=['GET'])
 @require_api_token
 def get_group_link_api(group_id):
     """Ottiene il link di invito ad un gruppo"""
-    from config import LOCK_FILE
-    
-    # Crea una nuova istanza per questa operazione
-    instance_id = get_instance_id()
-    
-    # Esegui in modo sincrono la funzione asincrona
-    loop = asyncio.new_event_loop()
     try:
-        link = loop.run_until_complete(get_group_link(group_id, instance_id))
+        # Esegui la funzione asincrona sulle connessioni persistenti del pool
+        link = telegram_engine.run(get_group_link(group_id, pool=connection_pool))
         
         if link:
             return jsonify({"group_id": group_id, "link": link})
@@ -531,16 +533,22 @@ def get_group_link_api(group_id):
     except Exception as e:
         log_error(f"Errore durante il recupero del link del gruppo: {e}")
         return jsonify({"error": str(e)}), 500
-    finally:
-        loop.close()
-        # Pulizia dei file di sessione
-        cleanup_session_files(instance_id)
 
 # API per il download degli archivi
 @api_bp.route('/archives', methods=['POST'])
 @require_api_token
 def start_archive_download():
-    """Avvia il download dell'archivio di un gruppo"""
+    """
+    Avvia il download dell'archivio di un gruppo
+
+    Con "sharded": true l'archivio viene scaricato in parallelo da tutti
+    gli account che hanno accesso al gruppo. Con "filters" vengono scaricati
+    solo i messaggi richiesti (media_types, date_from, date_to, senders,
+    min_size, max_size). Con "lazy": true dei media vengono salvati solo
+    miniature e metadati, e i file completi vengono scaricati quando sono
+    richiesti. L'operazione viene accodata e parte in ordine di "priority"
+    quando c'è posto per gli account coinvolti.
+    """
     from config import USER_GROUPS_FILE
     
     data = request.json
@@ -571,34 +579,75 @@ def start_archive_download():
             "error": f"Gruppo con ID {data['group_id']} non trovato per l'utente {data['user']}"
         }), 404
     
-    # Crea un ID per questa operazione
-    operation_id = f"archive_{int(time.time())}"
+    # Verifica i filtri prima di avviare il download
+    filters = None
+    if data.get('filters'):
+        try:
+            filters = ArchiveFilter.from_dict(data['filters'])
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
     
-    # Avvia il download in un thread separato
-    download_thread = threading.Thread(
-        target=run_archive_download,
-        args=(selected_group, operation_id)
-    )
-    download_thread.daemon = True
-    download_thread.start()
+    try:
+        priority = int(data.get('priority', 0))
+    except (TypeError, ValueError):
+        return jsonify({"error": "'priority' deve essere un numero intero"}), 400
+    
+    if data.get('sharded') and not is_shardable(selected_group["group"]["id"]):
+        return jsonify({
+            "error": "Il download multi-account è disponibile solo per supergruppi e canali"
+        }), 400
+    
+    # Accoda l'operazione: parte quando c'è posto per gli account coinvolti
+    job = job_queue.submit("archive", {
+        "user": selected_group["user"],
+        "group": selected_group["group"],
+        "sharded": bool(data.get('sharded', False)),
+        "filters": filters.to_dict() if filters else None,
+        "lazy": bool(data.get('lazy', False))
+    }, priority=priority)
+    job = job_queue.get(job["id"]) or job
     
-    # Registra l'operazione attiva
+    return jsonify({
+        "status": job["status"],
+        "operation_id": job["id"],
+        "position": job.get("position"),
+        "message": f"Download archivio accodato per il gruppo {selected_group['group']['name']}"
+    })
+
+def get_archive_job_accounts(params):
+    """Account usati da un job di archivio (tutti quelli del gruppo se è scaricato in parallelo)"""
+    if params["sharded"] and is_shardable(params["group"]["id"]):
+        return sorted(set(find_group_accounts(params["group"]["id"])) | {params["user"]})
+    return [params["user"]]
+
+async def run_archive_job(job):
+    """Esegue un job di archivio della coda e restituisce il suo stato finale"""
+    params = job["params"]
+    operation_id = job["id"]
+    selected_group = {"user": params["user"], "group": params["group"]}
+    filters = ArchiveFilter.from_dict(params["filters"]) if params["filters"] else None
+    
+    # Registra l'operazione attiva prima di avviarla
     active_operations[operation_id] = {
         "type": "archive",
         "start_time": time.time(),
         "status": "started",
-        "group": selected_group["group"]["name"],
-        "user": selected_group["user"]
+        "group": params["group"]["name"],
+        "user": params["user"],
+        "sharded": params["sharded"],
+        "filters": params["filters"],
+        "lazy": params.get("lazy", False),
+        "priority": job["priority"],
+        "attempt": job["attempts"]
     }
     
-    return jsonify({
-        "status": "started",
-        "operation_id": operation_id,
-        "message": f"Download archivio avviato per il gruppo {selected_group['group']['name']}"
-    })
+    await run_archive_download(selected_group, operation_id, params["sharded"], filters, params.get("lazy", False))
+    return active_operations[operation_id]["status"]
 
-def run_archive_download(selected_group, operation_id):
-    """Esegue il download dell'archivio in un thread separato e invia aggiornamenti via Socket.IO"""
+job_queue.register("archive", run_archive_job, get_archive_job_accounts)
+
+async def run_archive_download(selected_group, operation_id, sharded=False, filters=None, lazy=False):
+    """Esegue il download dell'archivio sul motore Telegram e invia aggiornamenti via Socket.IO"""
     from config import LOCK_FILE
     
     # Ottieni il gestore WebSocket
@@ -607,6 +656,15 @@ def run_archive_download(selected_group, operation_id):
     # Crea una nuova istanza per questa operazione
     instance_id = get_instance_id()
     
+    def publish_progress(snapshot):
+        """Aggiorna l'avanzamento dell'operazione e lo invia ai client Socket.IO"""
+        active_operations[operation_id]["progress"] = snapshot
+        if socketio_manager:
+            socketio_manager.broadcast_event('archive_progress', {'operation_id': operation_id, **snapshot})
+    
+    # Avanzamento in tempo reale (pubblicato al massimo ogni PROGRESS_EMIT_INTERVAL secondi)
+    progress = ArchiveProgress(on_update=publish_progress)
+    
     try:
         # Invia notifica di inizio
         if socketio_manager:
@@ -621,10 +679,6 @@ def run_archive_download(selected_group, operation_id):
         # Aggiorna lo stato dell'operazione
         active_operations[operation_id]["status"] = "downloading"
         
-        # Configura un nuovo loop di eventi asyncio per questo thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
         # Invia notifica di download in corso
         if socketio_manager:
             socketio_manager.broadcast_event('archive_status', {
@@ -634,9 +688,12 @@ def run_archive_download(selected_group, operation_id):
             })
         
         # Esegui il download
-        result = loop.run_until_complete(
-            download_group_archive(selected_group, instance_id, operation_id)
-        )
+        if sharded:
+            accounts = active_operations[operation_id]["accounts"] = {}
+            result = await download_sharded_archive(selected_group, operation_id, accounts, filters, progress, lazy)
+        else:
+            result = await download_group_archive(selected_group, instance_id, operation_id, filters, progress, lazy)
+        progress.finish()
         
         # Aggiorna lo stato finale dell'operazione
         if result:
@@ -662,9 +719,11 @@ def run_archive_download(selected_group, operation_id):
                     'error': 'Download non riuscito',
                     'time': time.strftime("%Y-%m-%d %H:%M:%S")
                 })
-        
-        # Chiudi il loop
-        loop.close()
+    except asyncio.CancelledError:
+        # Download annullato (ad esempio all'arresto del server)
+        active_operations[operation_id]["status"] = "cancelled"
+        active_operations[operation_id]["end_time"] = time.time()
+        raise
     except Exception as e:
         error_msg = str(e)
         log_error(f"Errore nel download archivio (Op {operation_id}): {error_msg}")
@@ -696,29 +755,28 @@ def start_monitoring_api():
     # Crea un ID per questa istanza
     instance_id = get_instance_id()
     
-    # Avvia il monitoraggio in un thread separato
-    monitoring_thread = threading.Thread(
-        target=run_monitoring,
-        args=(instance_id,)
-    )
-    monitoring_thread.daemon = True
-    monitoring_thread.start()
-    
-    # Registra l'operazione attiva
+    # Registra l'operazione attiva prima di avviarla
     active_operations[instance_id] = {
         "type": "monitoring",
         "start_time": time.time(),
         "status": "started"
     }
     
+    # Avvia il monitoraggio in background sul motore Telegram
+    telegram_engine.submit(
+        run_monitoring(instance_id),
+        name=instance_id,
+        task_type="monitoring"
+    )
+    
     return jsonify({
         "status": "started",
         "instance_id": instance_id,
         "message": "Monitoraggio avviato"
     })
 
-def run_monitoring(instance_id):
-    """Esegue il monitoraggio in un thread separato"""
+async def run_monitoring(instance_id):
+    """Esegue il monitoraggio sul motore Telegram"""
     from config import LOCK_FILE
     
     # Ottieni il gestore WebSocket
@@ -733,10 +791,6 @@ def run_monitoring(instance_id):
                 'time': time.strftime("%Y-%m-%d %H:%M:%S")
             })
         
-        # Configura un nuovo loop di eventi asyncio per questo thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
         # Invia notifica di monitoraggio attivo
         if socketio_manager:
             socketio_manager.broadcast_event('monitoring_status', {
@@ -749,7 +803,7 @@ def run_monitoring(instance_id):
         active_operations[instance_id]["status"] = "active"
         
         # Esegui il monitoraggio
-        loop.run_until_complete(start_monitoring(instance_id))
+        await start_monitoring(instance_id)
         
         # Aggiorna lo stato finale dell'operazione
         active_operations[instance_id]["status"] = "completed"
@@ -762,10 +816,7 @@ def run_monitoring(instance_id):
                 'status': 'completed',
                 'time': time.strftime("%Y-%m-%d %H:%M:%S")
             })
-        
-        # Chiudi il loop
-        loop.close()
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         # Aggiorna lo stato dell'operazione
         active_operations[instance_id]["status"] = "stopped"
         active_operations[instance_id]["end_time"] = time.time()
@@ -777,6 +828,7 @@ def run_monitoring(instance_id):
                 'status': 'stopped',
                 'time': time.strftime("%Y-%m-%d %H:%M:%S")
             })
+        raise
     except Exception as e:
         error_msg = str(e)
         log_error(f"Errore nel monitoraggio (Istanza {instance_id}): {error_msg}")
@@ -818,6 +870,9 @@ def stop_monitoring_api(instance_id):
     # Aggiorna lo stato dell'operazione
     active_operations[instance_id]["status"] = "stopping"
     
+    # Annulla il monitoraggio: i client vengono disconnessi dal suo blocco finally
+    telegram_engine.cancel(instance_id)
+    
     # Ottieni il gestore WebSocket
     socketio_manager = get_websocket_manager()
     
@@ -855,61 +910,55 @@ def get_monitoring_status():
 @api_bp.route('/media', methods=['GET'])
 @require_api_token
 def get_media_files():
-    """Ottiene la lista dei file media"""
-    # Parametri opzionali per filtrare
-    user = request.args.get('user')
-    group = request.args.get('group')
-    media_type = request.args.get('type')
+    """
+    Ottiene la lista dei file media dall'indice dei media
+
+    Parametri opzionali: user, group, type, sender_id, message_id,
+    date_from, date_to (YYYY-MM-DD), limit (default 100, massimo 1000) e offset
+    """
+    try:
+        sender_id = int(request.args['sender_id']) if request.args.get('sender_id') else None
+        message_id = int(request.args['message_id']) if request.args.get('message_id') else None
+        limit = max(int(request.args['limit']), 1) if request.args.get('limit') else None
+        offset = max(int(request.args.get('offset', 0)), 0)
+        date_from = int(parse_date(request.args['date_from']).timestamp()) if request.args.get('date_from') else None
+        date_to = int(parse_date(request.args['date_to'], end_of_day=True).timestamp()) if request.args.get('date_to') else None
+    except ValueError as e:
+        return jsonify({"error": f"Parametro non valido: {e}"}), 400
+    
+    entries = media_index.list(
+        DOWNLOADS_DIR,
+        account=request.args.get('user'),
+        group_name=request.args.get('group'),
+        media_type=request.args.get('type'),
+        sender_id=sender_id,
+        message_id=message_id,
+        date_from=date_from,
+        date_to=date_to,
+        limit=limit,
+        offset=offset
+    )
     
     result = []
-    
-    # Funzione ricorsiva per scansionare le directory
-    def scan_directory(base_dir, current_path=None):
-        if current_path:
-            full_path = os.path.join(base_dir, current_path)
-        else:
-            full_path = base_dir
-            current_path = ""
-        
-        items = []
-        
-        try:
-            for item in os.listdir(full_path):
-                item_path = os.path.join(full_path, item)
-                rel_path = os.path.join(current_path, item) if current_path else item
-                
-                if os.path.isdir(item_path):
-                    # È una directory, scansiona ricorsivamente
-                    sub_items = scan_directory(base_dir, rel_path)
-                    items.extend(sub_items)
-                else:
-                    # È un file, aggiungilo alla lista
-                    items.append({
-                        "name": item,
-                        "path": rel_path,
-                        "size": os.path.getsize(item_path),
-                        "type": os.path.splitext(item)[1][1:] if os.path.splitext(item)[1] else "",
-                        "last_modified": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(os.path.getmtime(item_path)))
-                    })
-        except Exception as e:
-            log_error(f"Errore durante la scansione della directory {full_path}: {e}")
-        
-        return items
-    
-    # Directory base per la ricerca dei media
-    base_path = DOWNLOADS_DIR
-    
-    # Applica i filtri
-    if user:
-        base_path = os.path.join(base_path, user)
-        if group:
-            base_path = os.path.join(base_path, group)
-            if media_type:
-                base_path = os.path.join(base_path, media_type)
-    
-    # Verifica che la directory esista
-    if os.path.exists(base_path) and os.path.isdir(base_path):
-        result = scan_directory(base_path)
+    for entry in entries:
+        name = os.path.basename(entry["path"])
+        result.append({
+            "name": name,
+            # Percorso relativo a DOWNLOADS_DIR, utilizzabile con /media/<path>
+            "path": entry["path"].replace(os.sep, "/"),
+            "size": entry["size"],
+            "type": os.path.splitext(name)[1][1:],
+            "last_modified": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry["saved"])),
+            "user": entry["account"],
+            "group": entry["group_name"],
+            "group_id": entry["group_id"],
+            "media_type": entry["media_type"],
+            "sender_id": entry["sender_id"],
+            "sender": entry["sender"],
+            "message_id": entry["message_id"],
+            "date": entry["date"],
+            "file_id": entry["file_id"]
+        })
     
     return jsonify({"files": result})
 
@@ -934,21 +983,290 @@ def get_media_file(file_path):
     # Invia il file al client
     return send_from_directory(directory, filename)
 
+# API per l'esportazione e la consultazione degli archivi
+def get_archive_path(user, group, filter_id=None):
+    """
+    Restituisce la cartella dell'archivio di un gruppo
+
+    Returns:
+        Tupla (percorso, None) oppure (None, risposta di errore)
+    """
+    # Assicurati che il percorso non contenga ".." per evitare accessi non autorizzati
+    if any('..' in part or '/' in part or '\\' in part for part in (user, group, filter_id or '')):
+        return None, (jsonify({"error": "Percorso non valido"}), 400)
+    
+    base_dir = os.path.join(ARCHIVE_DIR, "filtered", filter_id) if filter_id else ARCHIVE_DIR
+    archive_path = os.path.join(base_dir, user, group)
+    if not os.path.isdir(archive_path):
+        return None, (jsonify({"error": "Archivio non trovato"}), 404)
+    
+    return archive_path, None
+
+@api_bp.route('/archives/<user>/<group>/export', methods=['GET'])
+@require_api_token
+def export_archive(user, group):
+    """
+    Esporta l'archivio di un gruppo come TAR o ZIP generato in streaming
+
+    Parametri: format (tar/zip), types (tipi di media separati da virgola),
+    date_from, date_to, filter (ID dei filtri di un archivio filtrato) e
+    offset (byte da cui riprendere). Per il TAR è supportato anche
+    l'header Range (bytes=N-), con If-Range per verificare che l'archivio
+    non sia cambiato.
+    """
+    export_format = request.args.get('format', 'tar')
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"Formato non valido. Validi: {', '.join(EXPORT_FORMATS)}"}), 400
+    
+    archive_path, error = get_archive_path(user, group, request.args.get('filter'))
+    if error:
+        return error
+    
+    media_types = [t for t in request.args.get('types', '').split(',') if t] or None
+    try:
+        export = ArchiveExport(archive_path, media_types,
+                               request.args.get('date_from'), request.args.get('date_to'))
+    except ValueError as e:
+        return jsonify({"error": f"Data non valida: {e}"}), 400
+    
+    # Punto di ripresa: parametro offset oppure header Range (solo TAR)
+    try:
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "'offset' deve essere un numero di byte"}), 400
+    
+    range_header = request.headers.get('Range', '')
+    if export_format == 'tar' and range_header.startswith('bytes=') and range_header.endswith('-'):
+        if request.headers.get('If-Range', export.etag).strip('"') == export.etag:
+            try:
+                offset = int(range_header[len('bytes='):-1])
+            except ValueError:
+                return jsonify({"error": "Header Range non valido"}), 400
+    
+    headers = {
+        "Content-Disposition": f'attachment; filename="{group}.{export_format}"',
+        "ETag": f'"{export.etag}"'
+    }
+    
+    if export_format == 'tar':
+        total_size = export.tar_size()
+        if offset < 0 or (offset and offset >= total_size):
+            return jsonify({"error": "Offset oltre la fine dell'esportazione"}), 416
+        headers["Accept-Ranges"] = "bytes"
+        headers["Content-Length"] = str(total_size - offset)
+        if offset:
+            headers["Content-Range"] = f"bytes {offset}-{total_size - 1}/{total_size}"
+        body = export.stream_tar(offset)
+        mimetype = "application/x-tar"
+    else:
+        if offset < 0:
+            return jsonify({"error": "Offset non valido"}), 400
+        body = export.stream_zip(offset)
+        mimetype = "application/zip"
+    
+    log_info(f"Esportazione {export_format} di {archive_path} ({len(export.files)} file, offset {offset})", "api_server.log")
+    
+    return Response(body, status=206 if "Content-Range" in headers else 200,
+                    mimetype=mimetype, headers=headers)
+
+@api_bp.route('/archives/<user>/<group>/media', methods=['GET'])
+@require_api_token
+def get_archive_media(user, group):
+    """Elenca i media di un archivio lazy con i loro metadati (parametri: type, filter)"""
+    archive_path, error = get_archive_path(user, group, request.args.get('filter'))
+    if error:
+        return error
+    
+    index = get_lazy_index(archive_path)
+    media = index.list(request.args.get('type'))
+    for entry in media:
+        entry["available"] = index.path(entry, "file") is not None
+    
+    return jsonify({"media": media})
+
+@api_bp.route('/archives/<user>/<group>/media/<int:message_id>', methods=['GET'])
+@require_api_token
+def get_archive_media_file(user, group, message_id):
+    """
+    Restituisce un media di un archivio lazy
+
+    Con thumbnail=1 restituisce la miniatura; altrimenti il file completo,
+    che viene scaricato da Telegram la prima volta che viene richiesto.
+    """
+    archive_path, error = get_archive_path(user, group, request.args.get('filter'))
+    if error:
+        return error
+    
+    index = get_lazy_index(archive_path)
+    entry = index.get(message_id)
+    if entry is None:
+        return jsonify({"error": f"Media {message_id} non presente nell'archivio"}), 404
+    
+    if request.args.get('thumbnail') in ('1', 'true'):
+        path = index.path(entry, "thumbnail")
+        if not path:
+            return jsonify({"error": "Miniatura non disponibile"}), 404
+    else:
+        path = index.path(entry, "file")
+        if not path:
+            try:
+                # Download su richiesta con la connessione persistente dell'account
+                path = telegram_engine.run(index.materialise(user, message_id))
+            except Exception as e:
+                log_error(f"Errore durante il download del media {message_id} dell'archivio {archive_path}: {e}")
+                return jsonify({"error": str(e)}), 500
+            if not path:
+                return jsonify({"error": f"Media {message_id} non più disponibile"}), 410
+    
+    return send_from_directory(os.path.dirname(os.path.abspath(path)), os.path.basename(path))
+
+@api_bp.route('/archives/<user>/<group>/messages.ndjson.gz', methods=['GET'])
+@require_api_token
+def get_archive_messages_export(user, group):
+    """
+    Scarica l'esportazione NDJSON compressa dei messaggi di un archivio
+
+    Supporta le richieste Range, così i blocchi indicati dall'indice
+    possono essere scaricati singolarmente. Parametri: filter (ID dei
+    filtri di un archivio filtrato), refresh=1 per aggiungere prima i
+    messaggi salvati dopo l'ultima esportazione.
+    """
+    archive_path, error = get_archive_path(user, group, request.args.get('filter'))
+    if error:
+        return error
+    
+    if request.args.get('refresh') in ('1', 'true'):
+        refresh_message_export(archive_path)
+    
+    export_file = os.path.join(archive_path, EXPORT_FILE)
+    if load_export_index(archive_path) is None or not os.path.exists(export_file):
+        return jsonify({"error": "Esportazione non disponibile: viene creata al termine del download dell'archivio"}), 404
+    
+    return send_from_directory(os.path.abspath(archive_path), EXPORT_FILE, mimetype="application/gzip", conditional=True)
+
+@api_bp.route('/archives/<user>/<group>/messages/index', methods=['GET'])
+@require_api_token
+def get_archive_messages_index(user, group):
+    """
+    Restituisce l'indice dei blocchi dell'esportazione NDJSON di un archivio
+
+    Parametri: filter, refresh=1, date_from e date_to (YYYY-MM-DD) per
+    ottenere solo i blocchi che possono contenere messaggi dell'intervallo.
+    """
+    try:
+        date_from = int(parse_date(request.args['date_from']).timestamp()) if request.args.get('date_from') else None
+        date_to = int(parse_date(request.args['date_to'], end_of_day=True).timestamp()) if request.args.get('date_to') else None
+    except ValueError as e:
+        return jsonify({"error": f"Parametro non valido: {e}"}), 400
+    
+    archive_path, error = get_archive_path(user, group, request.args.get('filter'))
+    if error:
+        return error
+    
+    if request.args.get('refresh') in ('1', 'true'):
+        index = refresh_message_export(archive_path)
+    else:
+        index = load_export_index(archive_path)
+    if index is None:
+        return jsonify({"error": "Esportazione non disponibile: viene creata al termine del download dell'archivio"}), 404
+    
+    index["chunks"] = select_chunks(index, date_from, date_to)
+    return jsonify(index)
+
+# API per la ricerca nei messaggi
+@api_bp.route('/messages/search', methods=['GET'])
+@require_api_token
+def search_messages():
+    """
+    Cerca nei messaggi salvati di uno o di tutti gli account
+
+    Parametri: q (ricerca full-text), user, chat_id, sender_id, date_from,
+    date_to (YYYY-MM-DD), media_type, limit (massimo 500) e offset.
+    Risultati dal messaggio più recente, con o senza q.
+    """
+    try:
+        chat_id = int(request.args['chat_id']) if request.args.get('chat_id') else None
+        sender_id = int(request.args['sender_id']) if request.args.get('sender_id') else None
+        limit = min(max(int(request.args.get('limit', 50)), 1), 500)
+        offset = max(int(request.args.get('offset', 0)), 0)
+        date_from = int(parse_date(request.args['date_from']).timestamp()) if request.args.get('date_from') else None
+        date_to = int(parse_date(request.args['date_to'], end_of_day=True).timestamp()) if request.args.get('date_to') else None
+    except ValueError as e:
+        return jsonify({"error": f"Parametro non valido: {e}"}), 400
+    
+    user = request.args.get('user')
+    if user and user not in message_store.accounts():
+        return jsonify({"error": f"Nessun messaggio salvato per l'utente '{user}'"}), 404
+    accounts = [user] if user else message_store.accounts()
+    
+    start_time = time.time()
+    results = []
+    try:
+        for account in accounts:
+            # Ogni account restituisce i primi offset + limit risultati, uniti per data
+            results.extend(message_store.search(
+                account, request.args.get('q'), chat_id, sender_id, date_from, date_to,
+                request.args.get('media_type'), limit + offset, 0
+            ))
+    except sqlite3.OperationalError as e:
+        return jsonify({"error": f"Ricerca non valida: {e}"}), 400
+    
+    # Stessa chiave della query SQL: ogni pagina unisce i primi offset + limit risultati di ogni account
+    results.sort(key=search_order_key, reverse=True)
+    
+    return jsonify({
+        "messages": results[offset:offset + limit],
+        "took_ms": round((time.time() - start_time) * 1000, 1)
+    })
+
 # API per le operazioni attive
 @api_bp.route('/operations', methods=['GET'])
 @require_api_token
 def get_active_operations():
-    """Ottiene la lista delle operazioni attive"""
-    return jsonify({"operations": active_operations})
+    """Ottiene la lista delle operazioni attive e lo stato del motore Telegram"""
+    return jsonify({
+        "operations": active_operations,
+        "engine": telegram_engine.get_status(),
+        "connections": connection_pool.get_status(),
+        "rate_limits": request_scheduler.get_status(),
+        "exported_senders": exported_senders.get_status(),
+        "media_store": media_store.get_status(),
+        "user_cache": user_cache.get_status(),
+        "jobs": job_queue.get_status(),
+        "message_store": message_store.get_status(),
+        "text_writer": text_writer.get_status(),
+        "media_index": media_index.get_status(),
+        "paths": path_resolver.get_status()
+    })
 
 @api_bp.route('/operations/<operation_id>', methods=['GET'])
 @require_api_token
 def get_operation_status(operation_id):
-    """Ottiene lo stato di un'operazione specifica"""
-    if operation_id not in active_operations:
+    """Ottiene lo stato di un'operazione specifica (anche se ancora in coda)"""
+    if operation_id in active_operations:
+        return jsonify({"operation": active_operations[operation_id]})
+    
+    job = job_queue.get(operation_id)
+    if not job:
+        return jsonify({"error": f"Operazione {operation_id} non trovata"}), 404
+    
+    return jsonify({"operation": job})
+
+@api_bp.route('/operations/<operation_id>', methods=['DELETE'])
+@require_api_token
+def cancel_operation(operation_id):
+    """Annulla un'operazione in coda o in esecuzione"""
+    if not job_queue.get(operation_id):
         return jsonify({"error": f"Operazione {operation_id} non trovata"}), 404
     
-    return jsonify({"operation": active_operations[operation_id]})
+    if not job_queue.cancel(operation_id):
+        return jsonify({"error": f"Operazione {operation_id} già conclusa"}), 400
+    
+    return jsonify({
+        "status": "cancelling",
+        "operation_id": operation_id,
+        "message": "Operazione in fase di annullamento"
+    })
 
 # API per la gestione dei token
 @api_bp.route('/tokens', methods=['POST'])
@@ -1,8 +1,6 @@
 import os
 import sys
 import asyncio
-import time
-import random
 from config import LOCK_FILE
 from utils import get_instance_id, register_instance, unregister_instance, check_running_instances, log_error
 from user_management import add_new_user, remove_user, show_saved_users
@@ -190,9 +188,6 @@ if __name__ == "__main__":
     # Genera un ID univoco per questa istanza
     instance_id = get_instance_id()
     
-    # Aggiungi un piccolo ritardo casuale per evitare conflitti all'avvio
-    time.sleep(random.uniform(0.1, 0.5))
-    
     # Registra l'istanza
     if not register_instance(instance_id, LOCK_FILE):
         print("❌ Impossibile registrare l'istanza. Controlla i log per maggiori dettagli.")
@@ -0,0 +1,130 @@
+"""
+Checkpoint e manifest degli archivi dei gruppi
+
+Per ogni coppia (account, gruppo) viene salvato nella cartella dell'archivio
+l'ultimo messaggio archiviato completamente e l'elenco dei media già
+scaricati. Le esecuzioni successive leggono solo i messaggi più recenti,
+non riscrivono il testo già salvato e non scaricano di nuovo i file
+presenti; un'esecuzione interrotta riprende dall'ultimo checkpoint.
+
+Il caricamento verifica una sola volta i file del manifest e va eseguito
+fuori dal loop di eventi; durante l'archivio has_media() consulta solo la
+memoria e le scritture passano dal text_writer, nell'ordine in cui
+vengono richieste (prima le righe del manifest, poi il checkpoint).
+"""
+
+import json
+import os
+import threading
+import time
+from utils import log_error
+from text_writer import text_writer
+
+CHECKPOINT_FILE = "checkpoint.json"
+MANIFEST_FILE = "manifest.jsonl"
+
+class ArchiveCheckpoint:
+    """
+    Stato di avanzamento dell'archivio di un gruppo
+
+    - max_id: tutti i messaggi fino a questo ID sono stati archiviati
+    - text_id: ultimo messaggio scritto in messages.txt
+    - failed: messaggi i cui media non sono stati scaricati
+    - manifest: media scaricati (ID messaggio -> file e dimensione)
+    """
+
+    def __init__(self, archive_path):
+        """Carica lo stato dell'archivio dalla sua cartella"""
+        self.archive_path = archive_path
+        self.checkpoint_file = os.path.join(archive_path, CHECKPOINT_FILE)
+        self.manifest_file = os.path.join(archive_path, MANIFEST_FILE)
+        self.max_id = 0
+        self.text_id = 0
+        self.failed = set()
+        self.manifest = {}
+        self.lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        """Legge checkpoint e manifest, se esistono"""
+        # Scritture di un'esecuzione precedente ancora in coda
+        text_writer.flush(timeout=60)
+
+        if os.path.exists(self.checkpoint_file):
+            try:
+                with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                self.max_id = data.get("max_id", 0)
+                self.text_id = data.get("text_id", 0)
+                self.failed = set(data.get("failed", []))
+            except Exception as e:
+                log_error(f"Checkpoint non leggibile {self.checkpoint_file}, archivio completo: {e}")
+
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.manifest[entry["id"]] = entry
+                    except (ValueError, KeyError):
+                        # Riga troncata da un'interruzione
+                        continue
+
+        # I media cancellati o incompleti vengono scaricati di nuovo
+        for message_id, entry in list(self.manifest.items()):
+            path = os.path.join(self.archive_path, entry["file"])
+            try:
+                if os.path.getsize(path) != entry["size"]:
+                    del self.manifest[message_id]
+            except OSError:
+                del self.manifest[message_id]
+
+    def has_media(self, message_id):
+        """Verifica se il media di un messaggio è già stato scaricato (file verificato al caricamento)"""
+        with self.lock:
+            return message_id in self.manifest
+
+    def record_media(self, message_id, file_path):
+        """
+        Registra un media scaricato nel manifest
+
+        Args:
+            message_id: ID del messaggio
+            file_path: Percorso del file scaricato
+        """
+        entry = {
+            "id": message_id,
+            "file": os.path.relpath(file_path, self.archive_path),
+            "size": os.path.getsize(file_path)
+        }
+        with self.lock:
+            self.manifest[message_id] = entry
+            self.failed.discard(message_id)
+        text_writer.append(self.manifest_file, json.dumps(entry) + "\n")
+
+    def record_failure(self, message_id):
+        """Registra un media da scaricare di nuovo alla prossima esecuzione"""
+        with self.lock:
+            self.failed.add(message_id)
+
+    def save(self, max_id=None, text_id=None):
+        """
+        Accoda il salvataggio atomico del checkpoint
+
+        Args:
+            max_id: Nuovo ID fino al quale l'archivio è completo
+            text_id: Nuovo ID dell'ultimo messaggio di testo scritto
+        """
+        with self.lock:
+            if max_id is not None:
+                self.max_id = max(self.max_id, max_id)
+            if text_id is not None:
+                self.text_id = max(self.text_id, text_id)
+
+            data = {
+                "max_id": self.max_id,
+                "text_id": self.text_id,
+                "failed": sorted(self.failed),
+                "updated": time.strftime("%Y-%m-%d %H:%M:%S")
+            }
+        text_writer.replace(self.checkpoint_file, json.dumps(data, indent=2))
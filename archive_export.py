@@ -0,0 +1,222 @@
+"""
+Esportazione degli archivi in streaming (TAR o ZIP)
+
+L'archivio di un gruppo (ARCHIVE_DIR/<utente>/<gruppo>) viene inviato come
+un unico file TAR o ZIP generato durante l'invio: nessun file temporaneo
+e memoria costante, anche per archivi di molti GB. I file vengono letti
+a blocchi di EXPORT_CHUNK_SIZE byte.
+
+Il contenuto esportato è deterministico (file in ordine di percorso, con
+dimensione e data fissate all'inizio dell'esportazione), quindi un
+download interrotto può riprendere da un offset in byte:
+- TAR: la struttura è calcolata in anticipo e i file già inviati vengono
+  saltati senza leggerli (Content-Length e Range supportati)
+- ZIP: i file già inviati vengono riletti solo per calcolare il CRC
+  richiesto dalla directory centrale, ma non vengono reinviati
+"""
+
+import hashlib
+import os
+import re
+import tarfile
+import time
+import zipfile
+from archive_filters import parse_date
+from utils import log_error
+from config import EXPORT_CHUNK_SIZE
+
+# Stato interno dell'archivio escluso dall'esportazione
+EXCLUDED_FILES = {"checkpoint.json", "manifest.jsonl"}
+EXCLUDED_SUFFIXES = (".part", ".tmp")
+
+# I media sono salvati come <timestamp>_<id messaggio>.<estensione>
+MEDIA_NAME_PATTERN = re.compile(r"^(\d+)_\d+")
+
+EXPORT_FORMATS = ("tar", "zip")
+
+# Il formato ZIP non rappresenta date precedenti al 1980
+ZIP_MIN_TIMESTAMP = 315619200
+
+class _StreamBuffer:
+    """File di sola scrittura da cui vengono prelevati i byte prodotti da zipfile"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+class ArchiveExport:
+    """Esportazione di un archivio, con filtri opzionali su tipo di media e data"""
+
+    def __init__(self, root, media_types=None, date_from=None, date_to=None):
+        """
+        Prepara l'elenco dei file da esportare
+
+        Args:
+            root: Directory dell'archivio (ARCHIVE_DIR/<utente>/<gruppo>)
+            media_types: Tipi di media da includere (cartelle images, videos, ...); None = tutti
+            date_from, date_to: Intervallo di date ISO dei media (YYYY-MM-DD)
+
+        I file di testo dell'archivio (messaggi, utenti, report) sono sempre inclusi.
+        """
+        self.root = root
+        self.prefix = os.path.basename(os.path.normpath(root))
+        self.media_types = set(media_types) if media_types else None
+        self.start = parse_date(date_from).timestamp() if date_from else None
+        self.end = parse_date(date_to, end_of_day=True).timestamp() if date_to else None
+        self.files = self._list_files()
+
+    def _media_timestamp(self, name, mtime):
+        """Data di un media: dal nome del file, o dalla data di modifica"""
+        match = MEDIA_NAME_PATTERN.match(name)
+        return int(match.group(1)) if match else mtime
+
+    def _list_files(self):
+        """Elenco ordinato dei file: (nome nell'esportazione, percorso, dimensione, data di modifica)"""
+        files = []
+        for directory, subdirs, names in os.walk(self.root):
+            subdirs.sort()
+            relative_dir = os.path.relpath(directory, self.root)
+            media_type = None if relative_dir == "." else relative_dir.split(os.sep)[0]
+
+            for name in sorted(names):
+                if name in EXCLUDED_FILES or name.endswith(EXCLUDED_SUFFIXES):
+                    continue
+
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                if media_type is not None:
+                    if self.media_types is not None and media_type not in self.media_types:
+                        continue
+                    timestamp = self._media_timestamp(name, stat.st_mtime)
+                    if self.start is not None and timestamp < self.start:
+                        continue
+                    if self.end is not None and timestamp >= self.end:
+                        continue
+
+                arcname = "/".join([self.prefix] + ([] if relative_dir == "." else relative_dir.split(os.sep)) + [name])
+                files.append((arcname, path, stat.st_size, int(stat.st_mtime)))
+        return files
+
+    @property
+    def etag(self):
+        """Identifica il contenuto esportato: cambia se l'archivio cambia"""
+        digest = hashlib.sha1()
+        for arcname, _, size, mtime in self.files:
+            digest.update(f"{arcname}\0{size}\0{mtime}\n".encode("utf-8"))
+        return digest.hexdigest()
+
+    def _read_file(self, path, size, start=0):
+        """
+        Legge un file a blocchi da start alla dimensione registrata
+
+        Se il file è cambiato dopo l'elenco, viene completato con zeri o
+        troncato, così la struttura dell'esportazione resta quella calcolata.
+        """
+        remaining = size - start
+        try:
+            with open(path, "rb") as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(EXPORT_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+        except OSError as e:
+            log_error(f"Errore durante la lettura di {path} per l'esportazione: {e}")
+
+        if remaining > 0:
+            log_error(f"File modificato durante l'esportazione: {path}")
+            while remaining > 0:
+                chunk = min(EXPORT_CHUNK_SIZE, remaining)
+                remaining -= chunk
+                yield b"\0" * chunk
+
+    # --- TAR ---
+
+    def _tar_header(self, arcname, size, mtime):
+        """Intestazione TAR (PAX per nomi lunghi e file oltre 8 GB)"""
+        info = tarfile.TarInfo(arcname)
+        info.size = size
+        info.mtime = mtime
+        info.mode = 0o644
+        return info.tobuf(format=tarfile.PAX_FORMAT, encoding="utf-8", errors="surrogateescape")
+
+    def _tar_segments(self):
+        """Parti del file TAR: ("data", byte) oppure ("file", percorso, dimensione)"""
+        for arcname, path, size, mtime in self.files:
+            yield ("data", self._tar_header(arcname, size, mtime))
+            yield ("file", path, size)
+            if size % tarfile.BLOCKSIZE:
+                yield ("data", b"\0" * (tarfile.BLOCKSIZE - size % tarfile.BLOCKSIZE))
+        # Fine dell'archivio: due blocchi vuoti
+        yield ("data", b"\0" * (2 * tarfile.BLOCKSIZE))
+
+    def tar_size(self):
+        """Dimensione totale del file TAR"""
+        return sum(len(segment[1]) if segment[0] == "data" else segment[2] for segment in self._tar_segments())
+
+    def stream_tar(self, offset=0):
+        """Genera il file TAR a partire da offset, saltando le parti già inviate"""
+        position = 0
+        for segment in self._tar_segments():
+            length = len(segment[1]) if segment[0] == "data" else segment[2]
+            if position + length <= offset:
+                position += length
+                continue
+
+            skip = max(0, offset - position)
+            if segment[0] == "data":
+                yield segment[1][skip:]
+            else:
+                yield from self._read_file(segment[1], segment[2], skip)
+            position += length
+
+    # --- ZIP ---
+
+    def stream_zip(self, offset=0):
+        """Genera il file ZIP (senza compressione, Zip64 se necessario) a partire da offset"""
+        buffer = _StreamBuffer()
+        position = 0
+
+        def output():
+            # Restituisce solo i byte successivi a offset
+            nonlocal position
+            data = buffer.drain()
+            start = max(0, offset - position)
+            position += len(data)
+            return data[start:]
+
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED, allowZip64=True) as archive:
+            for arcname, path, size, mtime in self.files:
+                info = zipfile.ZipInfo(arcname, date_time=time.localtime(max(mtime, ZIP_MIN_TIMESTAMP))[:6])
+                info.file_size = size
+                info.external_attr = 0o644 << 16
+                with archive.open(info, "w") as entry:
+                    for chunk in self._read_file(path, size):
+                        entry.write(chunk)
+                        data = output()
+                        if data:
+                            yield data
+                data = output()
+                if data:
+                    yield data
+
+        data = output()
+        if data:
+            yield data
@@ -0,0 +1,215 @@
+"""
+Filtri degli archivi dei gruppi
+
+Un archivio filtrato scarica solo i messaggi con determinati tipi di media,
+in un intervallo di date, di determinati mittenti o entro limiti di
+dimensione. Tipi di media, date e mittenti vengono passati a Telegram
+(filtri di ricerca, offset_date/min_id e from_user), così la cronologia
+esclusa non viene mai trasferita; il tipo esatto (ad esempio gli sticker,
+cercati tra tutti i documenti) e i limiti di dimensione vengono verificati
+sui messaggi ricevuti prima di scaricare i media.
+
+Ogni combinazione di filtri ha una propria cartella (e un proprio
+checkpoint) in ARCHIVE_DIR/filtered/<id filtro>/.
+"""
+
+import hashlib
+import heapq
+import json
+import os
+from datetime import datetime, timedelta, timezone
+from telethon.tl import types
+from media_handler import get_media_type
+from config import ARCHIVE_DIR
+
+# Filtri di ricerca di Telegram per i tipi di media dell'archivio
+MEDIA_FILTERS = {
+    "images": types.InputMessagesFilterPhotos,
+    "videos": types.InputMessagesFilterVideo,
+    "audio": types.InputMessagesFilterMusic,
+    "voice": types.InputMessagesFilterVoice,
+    "documents": types.InputMessagesFilterDocument,
+    # Telegram non ha un filtro per gli sticker: si cercano tutti i documenti e
+    # matches() tiene solo quelli con DocumentAttributeSticker (message.sticker)
+    "stickers": types.InputMessagesFilterDocument,
+    "gifs": types.InputMessagesFilterGif
+}
+
+def parse_date(value, end_of_day=False):
+    """Converte una data ISO (YYYY-MM-DD o con orario) in un datetime UTC"""
+    date = datetime.fromisoformat(value)
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    if end_of_day and len(value) == 10:
+        # Una data senza orario comprende tutto il giorno
+        date += timedelta(days=1)
+    return date
+
+async def merge_histories(iterators):
+    """Unisce più cronologie ordinate per ID crescente, senza duplicati"""
+    heads = []
+    for index, iterator in enumerate(iterators):
+        try:
+            message = await iterator.__anext__()
+            heapq.heappush(heads, (message.id, index, message))
+        except StopAsyncIteration:
+            pass
+
+    last_id = None
+    while heads:
+        message_id, index, message = heapq.heappop(heads)
+        if message_id != last_id:
+            last_id = message_id
+            yield message
+        try:
+            message = await iterators[index].__anext__()
+            heapq.heappush(heads, (message.id, index, message))
+        except StopAsyncIteration:
+            pass
+
+class ArchiveFilter:
+    """Filtri di un archivio, validati a partire dalla richiesta API"""
+
+    def __init__(self, media_types=None, date_from=None, date_to=None, senders=None, min_size=None, max_size=None):
+        self.media_types = sorted(set(media_types or []))
+        self.date_from = date_from
+        self.date_to = date_to
+        self.senders = list(senders or [])
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.start_date = parse_date(date_from) if date_from else None
+        self.end_date = parse_date(date_to, end_of_day=True) if date_to else None
+
+    @classmethod
+    def from_dict(cls, data):
+        """
+        Crea i filtri dai parametri di una richiesta
+
+        Args:
+            data: Dictionary con media_types, date_from, date_to, senders, min_size, max_size
+
+        Raises:
+            ValueError: Se un parametro non è valido
+        """
+        if not isinstance(data, dict):
+            raise ValueError("I filtri devono essere un oggetto")
+
+        unknown = set(data) - {"media_types", "date_from", "date_to", "senders", "min_size", "max_size"}
+        if unknown:
+            raise ValueError(f"Filtri non supportati: {', '.join(sorted(unknown))}")
+
+        media_types = data.get("media_types") or []
+        invalid = [media_type for media_type in media_types if media_type not in MEDIA_FILTERS]
+        if invalid:
+            raise ValueError(f"Tipi di media non validi: {', '.join(invalid)} (validi: {', '.join(MEDIA_FILTERS)})")
+
+        for key in ("date_from", "date_to"):
+            if data.get(key):
+                try:
+                    parse_date(data[key])
+                except (TypeError, ValueError):
+                    raise ValueError(f"Data non valida per {key}: {data[key]}")
+
+        for key in ("min_size", "max_size"):
+            if data.get(key) is not None and (not isinstance(data[key], int) or data[key] < 0):
+                raise ValueError(f"{key} deve essere un numero di byte")
+
+        # ID numerici come interi, username come stringhe
+        senders = [
+            int(sender) if isinstance(sender, str) and sender.lstrip("-").isdigit() else sender
+            for sender in data.get("senders") or []
+        ]
+
+        return cls(
+            media_types=media_types,
+            date_from=data.get("date_from"),
+            date_to=data.get("date_to"),
+            senders=senders,
+            min_size=data.get("min_size"),
+            max_size=data.get("max_size")
+        )
+
+    def to_dict(self):
+        """Parametri dei filtri (come nella richiesta)"""
+        return {
+            "media_types": self.media_types,
+            "date_from": self.date_from,
+            "date_to": self.date_to,
+            "senders": self.senders,
+            "min_size": self.min_size,
+            "max_size": self.max_size
+        }
+
+    @property
+    def filter_id(self):
+        """Identificativo stabile della combinazione di filtri"""
+        data = json.dumps(self.to_dict(), sort_keys=True, default=str)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()[:12]
+
+    @property
+    def base_dir(self):
+        """Directory degli archivi con questi filtri"""
+        return os.path.join(ARCHIVE_DIR, "filtered", self.filter_id)
+
+    def _search_filters(self):
+        """Filtri di ricerca da passare a Telegram (None = nessun filtro sul tipo)"""
+        if not self.media_types:
+            return [None]
+
+        media_types = set(self.media_types)
+        search_filters = []
+        if {"images", "videos"} <= media_types:
+            # Foto e video con un'unica ricerca
+            search_filters.append(types.InputMessagesFilterPhotoVideo)
+            media_types -= {"images", "videos"}
+        search_filters.extend(MEDIA_FILTERS[media_type] for media_type in sorted(media_types))
+        return list(dict.fromkeys(search_filters))
+
+    def matches(self, message):
+        """Verifica i filtri che Telegram non può applicare (tipo esatto, dimensione e date)"""
+        # Esclude ad esempio i documenti che non sono sticker, restituiti dalla ricerca degli sticker
+        if self.media_types and get_media_type(message) not in self.media_types:
+            return False
+
+        if self.start_date and message.date < self.start_date:
+            return False
+
+        if self.min_size is not None or self.max_size is not None:
+            size = message.file.size if message.file else None
+            if size is None:
+                return False
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+
+        return True
+
+    async def iter_messages(self, client, entity, min_id=0, max_id=0):
+        """
+        Cronologia filtrata del gruppo, dal messaggio più vecchio al più recente
+
+        Ogni combinazione di tipo di media e mittente è una ricerca separata
+        su Telegram; i risultati vengono uniti in ordine di ID.
+
+        Args:
+            client: Client Telegram connesso
+            entity: Gruppo
+            min_id, max_id: Intervallo di ID escluso agli estremi (0 = nessun limite)
+        """
+        iterators = [
+            client.iter_messages(
+                entity, min_id=min_id, max_id=max_id, reverse=True,
+                offset_date=self.start_date, filter=search_filter, from_user=sender
+            )
+            for search_filter in self._search_filters()
+            for sender in (self.senders or [None])
+        ]
+
+        async for message in merge_histories(iterators):
+            # La cronologia è in ordine crescente: oltre la data finale non c'è altro
+            if self.end_date and message.date >= self.end_date:
+                break
+            if self.matches(message):
+                yield message
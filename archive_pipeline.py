@@ -0,0 +1,346 @@
+"""
+Pipeline concorrente per il download degli archivi dei gruppi
+
+La cronologia di un gruppo viene letta da un produttore, mentre i media
+vengono scaricati da un gruppo limitato di worker e il testo viene scritto
+su disco da una fase separata. Le code hanno una dimensione massima, così
+la lettura della cronologia rallenta quando i download non tengono il passo.
+Il file messages.txt mantiene l'ordine in cui i messaggi vengono letti.
+
+Con un checkpoint la cronologia viene letta dal messaggio più vecchio non
+ancora archiviato verso il più recente, così l'avanzamento è monotono e
+un'esecuzione interrotta può riprendere dall'ultimo messaggio completato.
+
+In modalità lazy (lazy_media) dei media vengono salvati solo miniatura e
+metadati; il file completo viene scaricato quando viene richiesto.
+"""
+
+import asyncio
+import time
+import traceback
+from collections import deque
+from utils import log_error, format_user_info
+from user_cache import user_cache
+from message_store import message_store, message_row
+from media_handler import download_media, format_message_line, get_media_type, get_messages_file
+from config import (
+    ARCHIVE_DIR, ARCHIVE_MEDIA_WORKERS, ARCHIVE_QUEUE_SIZE, ARCHIVE_WRITE_BATCH,
+    ARCHIVE_CHECKPOINT_INTERVAL, ARCHIVE_SENDER_BATCH, VERBOSE
+)
+
+class ArchivePipeline:
+    """
+    Download dell'archivio di un gruppo in tre fasi concorrenti
+
+    Il produttore legge i messaggi e risolve i mittenti a blocchi, i worker
+    scaricano i media e lo scrittore salva i messaggi di testo a blocchi.
+    """
+
+    def __init__(self, client, target_group, group_name, nickname, base_dir=ARCHIVE_DIR,
+                 media_workers=ARCHIVE_MEDIA_WORKERS, queue_size=ARCHIVE_QUEUE_SIZE, checkpoint=None,
+                 history=None, messages_file=None, progress=None, lazy_media=None):
+        """
+        Inizializza la pipeline per un gruppo
+
+        Args:
+            checkpoint: ArchiveCheckpoint per riprendere un archivio esistente
+            history: Messaggi da archiviare (di default tutta la cronologia dopo il checkpoint)
+            messages_file: File del testo (di default messages.txt del gruppo)
+            progress: ArchiveProgress aggiornato durante il download
+            lazy_media: LazyMediaIndex per salvare solo miniature e metadati dei media
+        """
+        self.client = client
+        self.target_group = target_group
+        self.group_name = group_name
+        self.nickname = nickname
+        self.base_dir = base_dir
+        self.media_workers = max(1, media_workers)
+        self.queue_size = queue_size
+        self.user_cache = {}
+        self.users_found = set()
+        self.checkpoint = checkpoint
+        self.history = history
+        self.messages_file = messages_file
+        self.progress = progress
+        self.lazy_media = lazy_media
+        self.stats = {
+            'total_messages': 0,
+            'media_count': 0,
+            'media_previews': 0,
+            'media_skipped': 0,
+            'text_count': 0
+        }
+
+        # Messaggi letti ma non ancora completati, nell'ordine di lettura
+        self._pending = {}
+        self._order = deque()
+        self._completed_id = 0
+        self._text_id = 0
+        self._last_save = time.time()
+
+    async def run(self):
+        """
+        Esegue la pipeline fino alla fine della cronologia
+
+        Returns:
+            Dictionary con le statistiche del download
+        """
+        media_queue = asyncio.Queue(self.queue_size)
+        text_queue = asyncio.Queue(self.queue_size)
+
+        stages = [asyncio.ensure_future(self._media_worker(media_queue)) for _ in range(self.media_workers)]
+        stages.append(asyncio.ensure_future(self._writer(text_queue)))
+
+        try:
+            await self._produce(media_queue, text_queue)
+
+            # Segnala la fine ai worker e allo scrittore
+            for _ in range(self.media_workers):
+                await media_queue.put(None)
+            await text_queue.put(None)
+
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            await asyncio.gather(*stages, return_exceptions=True)
+            raise
+        finally:
+            # Salva i progressi anche se il download è stato interrotto
+            self._save_checkpoint()
+
+        return self.stats
+
+    def _track(self, message_id, stages):
+        """Registra un messaggio letto con il numero di fasi che deve completare"""
+        self._pending[message_id] = stages
+        self._order.append(message_id)
+        self._advance()
+
+    def _complete(self, message_id):
+        """Segnala il completamento di una fase di un messaggio"""
+        if message_id in self._pending:
+            self._pending[message_id] -= 1
+            self._advance()
+
+    def _advance(self):
+        """Avanza il checkpoint fino al primo messaggio non ancora completato"""
+        while self._order and self._pending[self._order[0]] <= 0:
+            message_id = self._order.popleft()
+            del self._pending[message_id]
+            self._completed_id = max(self._completed_id, message_id)
+            if self.progress:
+                self.progress.messages_completed(self._completed_id)
+
+        if time.time() - self._last_save > ARCHIVE_CHECKPOINT_INTERVAL:
+            self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        """Salva il checkpoint con i progressi attuali"""
+        self._last_save = time.time()
+        if self.checkpoint is not None:
+            self.checkpoint.save(max_id=self._completed_id or None, text_id=self._text_id or None)
+
+    def _iter_history(self):
+        """Cronologia da leggere: tutta, o solo i messaggi successivi al checkpoint"""
+        if self.history is not None:
+            return self.history
+        if self.checkpoint is None:
+            return self.client.iter_messages(self.target_group)
+        return self.client.iter_messages(self.target_group, min_id=self.checkpoint.max_id, reverse=True)
+
+    async def _retry_failed(self, media_queue):
+        """Rimette in coda i media non scaricati nelle esecuzioni precedenti"""
+        failed = sorted(self.checkpoint.failed) if self.checkpoint else []
+        if not failed:
+            return
+
+        print(f"🔁 Nuovo tentativo per {len(failed)} media non scaricati in precedenza")
+        messages = await self.client.get_messages(self.target_group, ids=failed)
+        retry = []
+        for message_id, message in zip(failed, messages):
+            if message and message.media and get_media_type(message) != "others":
+                retry.append(message)
+            else:
+                # Messaggio eliminato nel frattempo: non c'è più niente da scaricare
+                self.checkpoint.failed.discard(message_id)
+
+        for message, sender_info in zip(retry, await self._resolve_senders(retry)):
+            await media_queue.put((message, sender_info))
+
+    async def _produce(self, media_queue, text_queue):
+        """Legge la cronologia del gruppo e distribuisce i messaggi alle fasi successive"""
+        last_update = time.time()
+
+        await self._retry_failed(media_queue)
+
+        batch = []
+        async for message in self._iter_history():
+            self.stats['total_messages'] += 1
+            if self.progress:
+                self.progress.message_read(message.id)
+
+            # Aggiorna lo stato ogni 50 messaggi o ogni 10 secondi
+            current_time = time.time()
+            if self.stats['total_messages'] % 50 == 0 or current_time - last_update > 10:
+                print(f"💬 Messaggi processati: {self.stats['total_messages']} (Media: {self.stats['media_count']}, "
+                      f"Testo: {self.stats['text_count']}, Utenti: {len(self.users_found)})")
+                last_update = current_time
+
+            batch.append(message)
+            if len(batch) >= ARCHIVE_SENDER_BATCH:
+                await self._dispatch(batch, media_queue, text_queue)
+                batch = []
+
+        if batch:
+            await self._dispatch(batch, media_queue, text_queue)
+
+    async def _dispatch(self, messages, media_queue, text_queue):
+        """Risolve i mittenti di un blocco di messaggi e li passa alle fasi successive"""
+        senders = await self._resolve_senders(messages)
+
+        # Tutti i messaggi del blocco nell'archivio dei messaggi (ricerca full-text)
+        message_store.add_many(self.nickname, [
+            message_row(message, sender_info, self.group_name) for message, sender_info in zip(messages, senders)
+        ])
+
+        for message, sender_info in zip(messages, senders):
+            # Il testo già scritto da un'esecuzione interrotta non viene ripetuto
+            has_text = bool(message.text or message.message)
+            if has_text and self.checkpoint and message.id <= self.checkpoint.text_id:
+                has_text = False
+            has_media = bool(message.media) and get_media_type(message) != "others"
+
+            self._track(message.id, int(has_text) + int(has_media))
+
+            if has_text:
+                await text_queue.put((message, sender_info))
+
+            if has_media:
+                await media_queue.put((message, sender_info))
+
+    async def _resolve_senders(self, messages):
+        """
+        Restituisce le informazioni sui mittenti di un blocco di messaggi
+
+        I mittenti arrivano di solito insieme ai messaggi; quelli mancanti
+        vengono risolti tutti insieme dalla cache condivisa degli utenti.
+        """
+        senders = [None] * len(messages)
+        missing = []
+        for index, message in enumerate(messages):
+            if not message.sender_id:
+                continue
+            sender_info = self.user_cache.get(message.sender_id) or user_cache.from_message(message)
+            if sender_info is None:
+                missing.append(index)
+            senders[index] = sender_info
+
+        if missing:
+            resolved = await user_cache.resolve(self.client, [messages[index].sender_id for index in missing])
+            for index in missing:
+                senders[index] = resolved[messages[index].sender_id]
+
+        for message, sender_info in zip(messages, senders):
+            if sender_info is not None:
+                self.user_cache[message.sender_id] = sender_info
+                self.users_found.add(message.sender_id)
+
+        return senders
+
+    async def _media_worker(self, queue):
+        """Scarica i media in coda finché non riceve il segnale di fine"""
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+
+            message, sender_info = item
+            result = None
+            try:
+                if self.checkpoint and self.checkpoint.has_media(message.id):
+                    # File già presente da un'esecuzione precedente
+                    self.stats['media_skipped'] += 1
+                    continue
+
+                if self.lazy_media is not None:
+                    result = await self._save_preview(message)
+                    continue
+
+                progress_callback = self.progress.file_callback(message.id) if self.progress else None
+                result = await download_media(message, self.group_name, self.nickname, self.base_dir,
+                                              sender_info=sender_info, progress_callback=progress_callback)
+                if result:
+                    self.stats['media_count'] += 1
+                    message_store.set_media(self.nickname, message.chat_id, message.id, result)
+                    if self.checkpoint:
+                        self.checkpoint.record_media(message.id, result)
+                    if VERBOSE:
+                        sender_display = format_user_info(sender_info) if sender_info else "Mittente sconosciuto"
+                        print(f"📥 Salvato {get_media_type(message)} di {sender_display}")
+                elif self.checkpoint:
+                    self.checkpoint.record_failure(message.id)
+            except Exception as e:
+                log_error(f"Errore durante il download del media {message.id}: {e}\n{traceback.format_exc()}")
+                if self.checkpoint:
+                    self.checkpoint.record_failure(message.id)
+            finally:
+                if self.progress:
+                    self.progress.file_finished(message.id, completed=bool(result))
+                self._complete(message.id)
+
+    async def _save_preview(self, message):
+        """Salva miniatura e metadati di un media (modalità lazy)"""
+        if self.lazy_media.has(message.id):
+            self.stats['media_skipped'] += 1
+            return None
+
+        entry = await self.lazy_media.save_preview(message)
+        self.stats['media_previews'] += 1
+        if self.checkpoint:
+            self.checkpoint.failed.discard(message.id)
+        return entry
+
+    async def _writer(self, queue):
+        """Scrive su disco i messaggi di testo raggruppandoli in blocchi"""
+        file_path = self.messages_file or get_messages_file(self.group_name, self.nickname, self.base_dir)
+        loop = asyncio.get_running_loop()
+        finished = False
+
+        while not finished:
+            batch = []
+            item = await queue.get()
+            while True:
+                if item is None:
+                    finished = True
+                    break
+                batch.append(item)
+                if len(batch) >= ARCHIVE_WRITE_BATCH or queue.empty():
+                    break
+                item = queue.get_nowait()
+
+            if not batch:
+                continue
+
+            lines = []
+            for message, sender_info in batch:
+                sender_display = format_user_info(sender_info) if sender_info else f"User_{message.sender_id or 'unknown'}"
+                lines.append(format_message_line(message, sender_display))
+
+            try:
+                await loop.run_in_executor(None, self._append_lines, file_path, lines)
+                self.stats['text_count'] += len(lines)
+                self._text_id = max(self._text_id, max(message.id for message, _ in batch))
+                if VERBOSE:
+                    print(f"💬 Salvati {len(lines)} messaggi di testo")
+            except Exception as e:
+                log_error(f"Errore salvataggio messaggi: {e}\n{traceback.format_exc()}")
+            finally:
+                for message, _ in batch:
+                    self._complete(message.id)
+
+    @staticmethod
+    def _append_lines(file_path, lines):
+        """Aggiunge le righe al file dei messaggi"""
+        with open(file_path, 'a', encoding='utf-8') as f:
+            f.writelines(lines)
@@ -0,0 +1,160 @@
+"""
+Avanzamento in tempo reale dei download degli archivi
+
+Raccoglie durante il download i messaggi letti, i byte scaricati e i file
+in corso (tramite le callback di avanzamento di Telethon) e calcola
+velocità e tempo stimato. Lo stato viene pubblicato al massimo ogni
+PROGRESS_EMIT_INTERVAL secondi, così gli aggiornamenti via Socket.IO
+non rallentano il download.
+"""
+
+import threading
+import time
+from collections import deque
+from config import PROGRESS_EMIT_INTERVAL, PROGRESS_RATE_WINDOW
+
+class ArchiveProgress:
+    """
+    Telemetria di un download di archivio
+
+    L'avanzamento si basa sugli ID dei messaggi già archiviati, dal più
+    vecchio al più recente tra first_id e last_id; completion permette
+    di calcolarlo in altro modo (ad esempio sommando più frammenti).
+    """
+
+    def __init__(self, on_update=None, interval=PROGRESS_EMIT_INTERVAL):
+        """
+        Inizializza l'avanzamento
+
+        Args:
+            on_update: Funzione chiamata con lo stato aggiornato (al massimo ogni interval secondi)
+            interval: Secondi minimi tra due pubblicazioni
+        """
+        self.on_update = on_update
+        self.interval = interval
+        self.start_time = time.time()
+        self.first_id = 0
+        self.last_id = 0
+        self.current_id = 0
+        self.completion = None
+        self.messages = 0
+        self.files_completed = 0
+        self.bytes_downloaded = 0
+        self.in_flight = {}
+        self.samples = deque()
+        self.lock = threading.Lock()
+        self._last_emit = 0
+
+    def set_range(self, first_id, last_id):
+        """Imposta l'intervallo di ID da leggere (first_id escluso)"""
+        with self.lock:
+            self.first_id = first_id
+            self.last_id = last_id
+            self.current_id = max(self.current_id, first_id)
+
+    def message_read(self, message_id):
+        """Registra un messaggio letto dalla cronologia"""
+        with self.lock:
+            self.messages += 1
+        self._maybe_emit()
+
+    def messages_completed(self, message_id):
+        """Registra che tutti i messaggi fino a message_id sono stati archiviati (testo e media)"""
+        with self.lock:
+            self.current_id = max(self.current_id, message_id)
+
+    def file_callback(self, message_id):
+        """
+        Restituisce la callback di avanzamento per il download di un media
+
+        Args:
+            message_id: ID del messaggio del media
+
+        Returns:
+            Funzione (byte scaricati, byte totali) per progress_callback di Telethon
+        """
+        with self.lock:
+            self.in_flight[message_id] = [0, 0]
+
+        def callback(current, total):
+            with self.lock:
+                entry = self.in_flight.get(message_id)
+                if entry is None:
+                    return
+                # Un nuovo tentativo riparte da zero
+                previous = entry[0] if current >= entry[0] else 0
+                self.bytes_downloaded += current - previous
+                entry[0], entry[1] = current, total
+            self._maybe_emit()
+
+        return callback
+
+    def file_finished(self, message_id, completed=True):
+        """Registra la fine (o l'interruzione) del download di un media"""
+        with self.lock:
+            self.in_flight.pop(message_id, None)
+            if completed:
+                self.files_completed += 1
+        self._maybe_emit()
+
+    def _fraction(self):
+        """Frazione della cronologia già letta (None se non stimabile)"""
+        if self.completion is not None:
+            return self.completion()
+        if self.last_id <= self.first_id:
+            return None
+        return min(1.0, (self.current_id - self.first_id) / (self.last_id - self.first_id))
+
+    def snapshot(self):
+        """
+        Restituisce lo stato attuale del download
+
+        Returns:
+            Dictionary con contatori, velocità, file in corso e tempo stimato
+        """
+        now = time.time()
+        with self.lock:
+            self.samples.append((now, self.messages, self.bytes_downloaded))
+            while len(self.samples) > 2 and now - self.samples[0][0] > PROGRESS_RATE_WINDOW:
+                self.samples.popleft()
+
+            oldest = self.samples[0]
+            elapsed = now - oldest[0]
+            messages_per_second = (self.messages - oldest[1]) / elapsed if elapsed > 0 else 0
+            bytes_per_second = (self.bytes_downloaded - oldest[2]) / elapsed if elapsed > 0 else 0
+
+            files = [
+                {"message_id": message_id, "bytes": current, "total": total, "remaining": max(0, total - current)}
+                for message_id, (current, total) in self.in_flight.items()
+            ]
+            fraction = self._fraction()
+            duration = now - self.start_time
+
+        eta = None
+        if fraction and fraction < 1:
+            eta = round(duration * (1 - fraction) / fraction)
+
+        return {
+            "messages": self.messages,
+            "messages_per_second": round(messages_per_second, 1),
+            "files_completed": self.files_completed,
+            "files_in_flight": files,
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_per_second": round(bytes_per_second),
+            "progress": round(fraction, 4) if fraction is not None else None,
+            "elapsed": round(duration),
+            "eta_seconds": eta
+        }
+
+    def _maybe_emit(self):
+        """Pubblica lo stato se è passato abbastanza tempo dall'ultima volta"""
+        now = time.time()
+        if self.on_update is None or now - self._last_emit < self.interval:
+            return
+        self._last_emit = now
+        self.on_update(self.snapshot())
+
+    def finish(self):
+        """Pubblica lo stato finale"""
+        if self.on_update is not None:
+            self.on_update(self.snapshot())
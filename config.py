@@ -12,17 +12,93 @@ API_HASH = os.getenv('API_HASH')
 DOWNLOADS_DIR = "downloads"
 TEMP_DIR = "private"
 ARCHIVE_DIR = "archive"  # Directory per gli archivi completi dei gruppi
+MEDIA_STORE_DIR = "media_store"  # Directory dei media condivisi tra gruppi e account
+MESSAGES_DB_DIR = "messages_db"  # Database dei messaggi di ogni account (con ricerca full-text)
 
 # File di configurazione
 USER_GROUPS_FILE = "user_groups.json"
 PHONE_NUMBERS_FILE = "phone_numbers.json"
 LOCK_FILE = "running_instances.lock"  # File per gestire istanze multiple
+SESSIONS_DB_FILE = "sessions.db"  # Database condiviso delle sessioni Telegram
+JOBS_FILE = "archive_jobs.json"  # Coda persistente delle operazioni di archivio
+MEDIA_INDEX_DB = "media_index.db"  # Indice dei media scaricati
 
 # Impostazioni
 VERBOSE = True
 MAX_DOWNLOAD_RETRIES = 3
 DOWNLOAD_RETRY_DELAY = 2  # secondi
 
+# Pool di connessioni persistenti
+POOL_IDLE_TIMEOUT = 600  # secondi di inattività prima di chiudere una connessione
+POOL_HEALTH_CHECK_INTERVAL = 60  # secondi tra due verifiche della stessa connessione
+POOL_MAINTENANCE_INTERVAL = 30  # secondi tra due cicli di pulizia del pool
+
+# Archivio condiviso delle sessioni
+SESSION_STORE_FLUSH_INTERVAL = 1.0  # secondi massimi di attesa prima di salvare un blocco di scritture
+SESSION_STORE_BATCH_SIZE = 500  # scritture massime per transazione
+
+# Pianificazione delle richieste per account (FloodWait)
+RATE_LIMIT_ACCOUNT_RATE = 20  # richieste al secondo per account
+RATE_LIMIT_ACCOUNT_BURST = 30  # richieste consecutive ammesse senza attesa
+RATE_LIMIT_TRANSFER_RATE = 400  # parti di file al secondo per account (download e upload, bucket separato)
+RATE_LIMIT_TRANSFER_BURST = 400  # parti di file consecutive ammesse senza attesa
+RATE_LIMIT_MIN_RATE = 0.02  # richieste al secondo minime per un metodo limitato
+RATE_LIMIT_RECOVERY = 0.01  # aumento del limite di un metodo dopo ogni chiamata riuscita
+RATE_LIMIT_WINDOW = 60  # secondi di chiamate considerati per stimare il limite
+FLOOD_WAIT_MAX_SLEEP = 300  # attese FloodWait più lunghe vengono segnalate al chiamante
+
+# Connessioni verso data center esterni (media su altri DC)
+EXPORTED_SENDER_IDLE_TIMEOUT = 300  # secondi di inattività prima di chiudere una connessione esportata
+
+# Download paralleli dei file di grandi dimensioni
+PARALLEL_DOWNLOAD_THRESHOLD = 10 * 1024 * 1024  # byte oltre i quali un file viene scaricato a blocchi paralleli
+PARALLEL_DOWNLOAD_WORKERS = 4  # blocchi richiesti contemporaneamente per file
+PARALLEL_DOWNLOAD_LARGE_FILE = 100 * 1024 * 1024  # byte oltre i quali si usano blocchi da 1 MB invece di 512 KB
+
+# Pipeline di download degli archivi
+ARCHIVE_MEDIA_WORKERS = 4  # download di media contemporanei per archivio
+ARCHIVE_QUEUE_SIZE = 200  # messaggi in attesa per fase prima di rallentare la lettura della cronologia
+ARCHIVE_WRITE_BATCH = 500  # messaggi di testo scritti su disco in un'unica operazione
+ARCHIVE_CHECKPOINT_INTERVAL = 5  # secondi tra due salvataggi del checkpoint durante il download
+ARCHIVE_SHARD_SIZE = 5000  # ID di messaggi per frammento negli archivi scaricati con più account
+ARCHIVE_SHARD_MIN_STEAL = 200  # ID rimanenti minimi perché un frammento venga diviso con un altro account
+LAZY_THUMBNAIL_SIZE = 320  # lato massimo in pixel delle miniature salvate negli archivi lazy
+
+# Avanzamento dei download degli archivi
+PROGRESS_EMIT_INTERVAL = 2  # secondi minimi tra due aggiornamenti di avanzamento pubblicati
+PROGRESS_RATE_WINDOW = 30  # secondi considerati per calcolare la velocità di download
+
+# Cache degli utenti (mittenti di archivi e monitoraggi)
+USER_CACHE_TTL = 24 * 3600  # secondi dopo i quali le informazioni su un utente vengono richieste di nuovo
+USER_RESOLVE_BATCH = 200  # utenti richiesti a Telegram in un'unica chiamata GetUsers
+ARCHIVE_SENDER_BATCH = 100  # messaggi letti prima di risolvere insieme i mittenti sconosciuti
+
+# Coda delle operazioni di archivio
+JOBS_MAX_RUNNING = 3  # operazioni di archivio eseguite contemporaneamente
+JOBS_MAX_PER_ACCOUNT = 1  # operazioni contemporanee che usano lo stesso account
+JOBS_HISTORY_LIMIT = 200  # operazioni concluse conservate nella coda
+
+# Esportazione degli archivi
+EXPORT_CHUNK_SIZE = 1024 * 1024  # byte letti e inviati per volta durante l'esportazione TAR/ZIP
+
+# Archivio dei messaggi
+MESSAGE_STORE_FLUSH_INTERVAL = 1.0  # secondi massimi di attesa prima di salvare un blocco di messaggi
+MESSAGE_STORE_BATCH_SIZE = 1000  # scritture massime per transazione
+
+# Esportazione NDJSON dei messaggi degli archivi
+MESSAGE_EXPORT_CHUNK_SIZE = 5000  # messaggi per blocco compresso (unità di lettura indipendente)
+MESSAGE_EXPORT_COMPRESSION = 6  # livello di compressione gzip dei blocchi (1-9)
+
+# Scrittura dei file di log e dei metadati
+TEXT_WRITER_FLUSH_INTERVAL = 0.5  # secondi massimi prima di scrivere su disco le righe accodate
+TEXT_WRITER_BATCH_BYTES = 256 * 1024  # byte accodati oltre i quali le righe vengono scritte subito
+TEXT_WRITER_DURABILITY = "flush"  # "buffered" (più veloce), "flush" (resiste a un crash del programma) o "fsync" (resiste a un'interruzione di corrente)
+TEXT_WRITER_MAX_OPEN_FILES = 64  # file di log tenuti aperti contemporaneamente
+
+# Elenco dei media dall'indice (/api/media)
+MEDIA_LIST_DEFAULT_LIMIT = 100  # media restituiti se limit non è indicato
+MEDIA_LIST_MAX_LIMIT = 1000  # media massimi per richiesta
+
 # Creazione delle directory se non esistono
-for directory in [DOWNLOADS_DIR, TEMP_DIR, ARCHIVE_DIR]:
+for directory in [DOWNLOADS_DIR, TEMP_DIR, ARCHIVE_DIR, MEDIA_STORE_DIR, MESSAGES_DB_DIR]:
     os.makedirs(directory, exist_ok=True)
\ No newline at end of file
@@ -0,0 +1,382 @@
+"""
+Pool di connessioni Telethon persistenti
+
+Questo modulo mantiene un client connesso per ogni account (nickname),
+condiviso da tutte le richieste API. Le richieste prendono in prestito
+il client dal pool e lo restituiscono al termine, evitando di ripetere
+l'handshake MTProto a ogni chiamata.
+"""
+
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager
+from telethon import functions
+from rate_limiter import ScheduledTelegramClient
+from exported_senders import exported_senders
+from session_manager import session_manager
+from telegram_engine import telegram_engine
+from utils import load_json, log_error, log_info
+from config import (
+    API_ID, API_HASH, PHONE_NUMBERS_FILE, USER_GROUPS_FILE, POOL_IDLE_TIMEOUT,
+    POOL_HEALTH_CHECK_INTERVAL, POOL_MAINTENANCE_INTERVAL
+)
+
+# Operazione a cui sono associate le sessioni in memoria del pool
+POOL_OPERATION_ID = "pool"
+
+class PooledClient:
+    """Client del pool con le informazioni sul suo utilizzo"""
+
+    def __init__(self, nickname, client):
+        self.nickname = nickname
+        self.client = client
+        self.leases = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+        self.last_health_check = self.created_at
+
+class ConnectionPool:
+    """
+    Gestisce un client Telegram connesso per ogni account
+
+    I client Telethon sono legati al loop di eventi su cui vengono creati,
+    quindi il pool esegue tutte le operazioni sul loop persistente del
+    motore Telegram. Le connessioni inutilizzate da troppo tempo vengono
+    chiuse automaticamente.
+    """
+
+    def __init__(self, idle_timeout=POOL_IDLE_TIMEOUT, health_check_interval=POOL_HEALTH_CHECK_INTERVAL):
+        """Inizializza il pool di connessioni"""
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.entries = {}
+        self.entries_lock = threading.RLock()
+        self._connect_locks = {}
+        self._maintenance_task = None
+        self.warmup = {'status': 'disabled', 'accounts': {}}
+
+    def _ensure_maintenance(self):
+        """Avvia la chiusura periodica delle connessioni inattive (sul loop del motore)"""
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.get_running_loop().create_task(self._maintenance())
+
+    def submit(self, coro):
+        """
+        Esegue una coroutine sul loop del motore Telegram
+
+        Args:
+            coro: Coroutine da eseguire
+
+        Returns:
+            concurrent.futures.Future con il risultato della coroutine
+        """
+        return telegram_engine.submit(coro)
+
+    def run(self, coro, timeout=None):
+        """
+        Esegue una coroutine sul loop del motore Telegram e ne attende il risultato
+
+        Args:
+            coro: Coroutine da eseguire
+            timeout: Secondi massimi di attesa (None = nessun limite)
+
+        Returns:
+            Il risultato della coroutine
+        """
+        return telegram_engine.run(coro, timeout)
+
+    @asynccontextmanager
+    async def lease(self, nickname):
+        """
+        Prende in prestito il client connesso di un account
+
+        Il client può essere condiviso da più richieste contemporanee:
+        non deve essere disconnesso da chi lo riceve.
+
+        Args:
+            nickname: Nome utente di cui ottenere il client
+        """
+        entry = await self._acquire(nickname)
+        try:
+            yield entry.client
+        finally:
+            self._release(entry)
+
+    async def _acquire(self, nickname):
+        """Restituisce una connessione sana per l'account, creandola se necessario"""
+        self._ensure_maintenance()
+
+        lock = self._connect_locks.setdefault(nickname, asyncio.Lock())
+        async with lock:
+            with self.entries_lock:
+                entry = self.entries.get(nickname)
+
+            if entry and not await self._is_healthy(entry):
+                await self._close_entry(entry)
+                entry = None
+
+            if entry is None:
+                entry = await self._connect(nickname)
+
+            with self.entries_lock:
+                entry.leases += 1
+                entry.last_used = time.time()
+
+            return entry
+
+    def _release(self, entry):
+        """Restituisce una connessione al pool"""
+        with self.entries_lock:
+            entry.leases = max(0, entry.leases - 1)
+            entry.last_used = time.time()
+
+    async def _connect(self, nickname):
+        """Crea e connette un nuovo client per l'account"""
+        # Sessione in memoria: il pool non tiene aperto il file SQLite dell'account
+        _, session = session_manager.create_session(nickname, POOL_OPERATION_ID)
+        client = ScheduledTelegramClient(
+            session,
+            API_ID,
+            API_HASH,
+            connection_retries=10,
+            retry_delay=3
+        )
+
+        try:
+            async with session_manager.use(nickname):
+                await client.connect()
+            if not await client.is_user_authorized():
+                raise RuntimeError(f"L'utente {nickname} non è autenticato")
+        except Exception:
+            if client.is_connected():
+                await client.disconnect()
+            session_manager.release(client.session)
+            raise
+
+        entry = PooledClient(nickname, client)
+        with self.entries_lock:
+            self.entries[nickname] = entry
+
+        log_info(f"Connessione aperta nel pool per {nickname}", "connection_pool.log")
+        return entry
+
+    async def _is_healthy(self, entry):
+        """Verifica che una connessione sia ancora utilizzabile"""
+        client = entry.client
+
+        try:
+            if not client.is_connected():
+                await client.connect()
+                entry.last_health_check = time.time()
+                return await client.is_user_authorized()
+
+            # Verifica periodica con una richiesta leggera
+            if time.time() - entry.last_health_check > self.health_check_interval:
+                await asyncio.wait_for(client(functions.updates.GetStateRequest()), timeout=10)
+                entry.last_health_check = time.time()
+
+            return True
+        except Exception as e:
+            log_error(f"Connessione del pool non valida per {entry.nickname}: {e}")
+            return False
+
+    async def _close_entry(self, entry):
+        """Disconnette un client e lo rimuove dal pool"""
+        with self.entries_lock:
+            if self.entries.get(entry.nickname) is entry:
+                del self.entries[entry.nickname]
+
+        try:
+            if entry.client.is_connected():
+                await entry.client.disconnect()
+            session_manager.release(entry.client.session)
+            log_info(f"Connessione chiusa nel pool per {entry.nickname}", "connection_pool.log")
+        except Exception as e:
+            log_error(f"Errore durante la disconnessione del client del pool {entry.nickname}: {e}")
+
+    async def _maintenance(self):
+        """Chiude periodicamente le connessioni inattive"""
+        while True:
+            await asyncio.sleep(POOL_MAINTENANCE_INTERVAL)
+
+            now = time.time()
+            with self.entries_lock:
+                idle_entries = [
+                    entry for entry in self.entries.values()
+                    if entry.leases == 0 and now - entry.last_used > self.idle_timeout
+                ]
+
+            for entry in idle_entries:
+                lock = self._connect_locks.setdefault(entry.nickname, asyncio.Lock())
+                async with lock:
+                    # Ricontrolla: la connessione potrebbe essere stata presa nel frattempo
+                    if entry.leases == 0 and time.time() - entry.last_used > self.idle_timeout:
+                        await self._close_entry(entry)
+
+            # Anche le connessioni verso altri DC hanno un timeout di inattività
+            await exported_senders.clean_idle()
+
+    def evict(self, nickname, timeout=10):
+        """
+        Chiude la connessione di un account, ad esempio dopo la sua rimozione
+
+        Args:
+            nickname: Nome utente di cui chiudere la connessione
+            timeout: Secondi massimi di attesa per la disconnessione
+        """
+        with self.entries_lock:
+            entry = self.entries.get(nickname)
+
+        if entry is None or not telegram_engine.is_running():
+            return
+
+        try:
+            telegram_engine.run(self._close_entry(entry), timeout)
+        except Exception as e:
+            log_error(f"Errore durante la chiusura della connessione di {nickname}: {e}")
+
+    async def _close_all(self):
+        """Disconnette tutti i client del pool e ferma la manutenzione"""
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+
+        with self.entries_lock:
+            entries = list(self.entries.values())
+
+        for entry in entries:
+            await self._close_entry(entry)
+
+        await exported_senders.close_all()
+        self._connect_locks = {}
+
+    def close(self, timeout=10):
+        """
+        Chiude tutte le connessioni del pool
+
+        Args:
+            timeout: Secondi massimi di attesa per le disconnessioni
+        """
+        if not telegram_engine.is_running():
+            return
+
+        try:
+            telegram_engine.run(self._close_all(), timeout)
+        except Exception as e:
+            log_error(f"Errore durante la chiusura del pool di connessioni: {e}")
+
+    async def warm_up(self):
+        """
+        Prepara in parallelo le connessioni di tutti gli account configurati
+
+        Per ogni account apre la connessione, risolve get_me e carica le
+        entità dei gruppi salvati in user_groups.json, così le prime
+        richieste API non pagano il costo della connessione a freddo.
+
+        Returns:
+            True se tutti gli account sono pronti
+        """
+        phone_numbers = load_json(PHONE_NUMBERS_FILE)
+        user_groups = load_json(USER_GROUPS_FILE)
+
+        with self.entries_lock:
+            self.warmup = {
+                'status': 'warming',
+                'started_at': time.time(),
+                'accounts': {nickname: {'ready': False} for nickname in phone_numbers}
+            }
+
+        results = await asyncio.gather(*[
+            self._warm_up_account(nickname, user_groups.get(nickname, []))
+            for nickname in phone_numbers
+        ])
+
+        with self.entries_lock:
+            self.warmup['status'] = 'ready'
+            self.warmup['completed_at'] = time.time()
+
+        ready = sum(1 for result in results if result)
+        log_info(
+            f"Preriscaldamento completato: {ready}/{len(results)} account pronti "
+            f"in {self.warmup['completed_at'] - self.warmup['started_at']:.1f}s",
+            "connection_pool.log"
+        )
+        return ready == len(results)
+
+    async def _warm_up_account(self, nickname, groups):
+        """Connette un account e ne carica le entità dei gruppi"""
+        start_time = time.time()
+
+        try:
+            async with self.lease(nickname) as client:
+                me = await client.get_me()
+
+                # Entità dei gruppi salvati; se mancano, una sola lettura dei dialoghi
+                missing = 0
+                for group in groups:
+                    try:
+                        await client.get_input_entity(group['id'])
+                    except ValueError:
+                        missing += 1
+                if missing:
+                    await client.get_dialogs()
+
+                # Latenza di una richiesta a connessione già aperta
+                probe_start = time.time()
+                await client(functions.updates.GetStateRequest())
+
+            state = {
+                'ready': True,
+                'user_id': me.id,
+                'groups': len(groups),
+                'warmup_time': round(time.time() - start_time, 3),
+                'latency': round(time.time() - probe_start, 3)
+            }
+            return True
+        except Exception as e:
+            state = {'ready': False, 'error': str(e)}
+            log_error(f"Preriscaldamento non riuscito per {nickname}: {e}")
+            return False
+        finally:
+            with self.entries_lock:
+                self.warmup['accounts'][nickname] = state
+
+    def start_warm_up(self):
+        """Avvia il preriscaldamento in background sul motore Telegram"""
+        with self.entries_lock:
+            self.warmup = {'status': 'warming', 'accounts': {}}
+        return telegram_engine.submit(self.warm_up(), name="warmup", task_type="warmup")
+
+    def get_warmup_status(self):
+        """Ottiene una copia dello stato del preriscaldamento"""
+        with self.entries_lock:
+            return {
+                **self.warmup,
+                'accounts': {nickname: dict(state) for nickname, state in self.warmup['accounts'].items()}
+            }
+
+    def is_ready(self):
+        """Verifica se il pool è pronto a servire le richieste (preriscaldamento concluso o disattivato)"""
+        return self.warmup['status'] in ('disabled', 'ready')
+
+    def get_status(self):
+        """
+        Ottiene lo stato delle connessioni del pool
+
+        Returns:
+            Dictionary nickname -> informazioni sulla connessione
+        """
+        with self.entries_lock:
+            return {
+                nickname: {
+                    'connected': entry.client.is_connected(),
+                    'leases': entry.leases,
+                    'created_at': entry.created_at,
+                    'last_used': entry.last_used
+                }
+                for nickname, entry in self.entries.items()
+            }
+
+# Singleton globale del ConnectionPool
+connection_pool = ConnectionPool()
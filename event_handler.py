@@ -1,11 +1,13 @@
 import asyncio
 import os
-import random
 import time
-from telethon import TelegramClient, events, utils
+from telethon import events
+from rate_limiter import ScheduledTelegramClient
 
 # Importa il session manager
 from session_manager import session_manager
+from exported_senders import exported_senders
+from user_cache import user_cache, get_unknown_user_info
 
 from config import API_ID, API_HASH, PHONE_NUMBERS_FILE
 from utils import load_json, log_error, format_user_info
@@ -19,25 +21,10 @@ from media_handler import (
 active_clients = {}
 
 async def get_user_info(client, user_id):
-    """Ottiene informazioni dettagliate su un utente."""
-    try:
-        user = await client.get_entity(user_id)
-        username = user.username if getattr(user, 'username', None) else None
-        first_name = getattr(user, 'first_name', None)
-        last_name = getattr(user, 'last_name', None)
-        
-        # Costruisci un dizionario con le informazioni disponibili
-        user_info = {
-            "id": user_id,
-            "username": username,
-            "first_name": first_name,
-            "last_name": last_name,
-            "display_name": utils.get_display_name(user)
-        }
-        return user_info
-    except Exception as e:
-        log_error(f"Impossibile ottenere informazioni sull'utente {user_id}: {e}")
-        return {"id": user_id, "display_name": f"User_{user_id}"}
+    """Ottiene informazioni dettagliate su un utente, dalla cache condivisa se disponibili."""
+    users = await user_cache.resolve(client, [user_id])
+    # Post dei canali e amministratori anonimi non hanno un mittente (user_id None)
+    return users.get(user_id) or get_unknown_user_info(user_id)
 
 async def handle_event(client, bot_entity, event, nickname):
     """Gestisce gli eventi dei messaggi in arrivo."""
@@ -50,7 +37,7 @@ async def handle_event(client, bot_entity, event, nickname):
 
     try:
         # Ottieni informazioni sul mittente
-        sender_info = await get_user_info(client, sender_id)
+        sender_info = user_cache.from_message(event.message) or await get_user_info(client, sender_id)
         user_display = format_user_info(sender_info)
         
         # Messaggi da gruppi o canali
@@ -65,16 +52,18 @@ async def handle_event(client, bot_entity, event, nickname):
                 group_name = str(chat_id)
                 group_display = f"Gruppo {chat_id}"
 
+            media_path = None
             if event.message.media:
                 print(f"📥 Ricevuto media in {group_display} da {user_display}")
                 media_path = await download_media(event.message, group_name, nickname, sender_info=sender_info)
                 if media_path:
                     print(f"✅ Media salvato: {media_path}")
             
-            # Salva il contenuto del messaggio se presente
-            if event.message.text or event.message.message:
+            # Salva il messaggio (testo e media collegato) nell'archivio dei messaggi
+            if event.message.text or event.message.message or media_path:
                 print(f"💬 Messaggio in {group_display} da {user_display}")
-                await save_message_content(group_name, event.message, nickname, sender_info=sender_info)
+                await save_message_content(group_name, event.message, nickname, sender_info=sender_info,
+                                           media_path=media_path)
 
         # Messaggi privati con media
         elif event.is_private and event.message.media:
@@ -132,7 +121,7 @@ async def start_monitoring(instance_id=None):
     try:
         for nickname, phone_number in phone_numbers.items():
             # Crea una sessione dedicata per questo monitoraggio
-            _, session_path = session_manager.create_session(nickname, operation_id)
+            _, session = session_manager.create_session(nickname, operation_id)
             
             # Utilizza un client univoco per ogni istanza+nickname
             client_key = f"{operation_id}_{nickname}"
@@ -148,8 +137,8 @@ async def start_monitoring(instance_id=None):
                     pass
             
             # Crea un nuovo client con la sessione dedicata
-            client = TelegramClient(
-                session_path,
+            client = ScheduledTelegramClient(
+                session,
                 API_ID, 
                 API_HASH,
                 connection_retries=10,
@@ -166,24 +155,14 @@ async def start_monitoring(instance_id=None):
             active_clients[client_key] = client
 
             async def run_client(nickname, phone_number, client, client_key):
+                # Connessioni verso altri DC attive per tutta la durata del monitoraggio
+                exported_senders.hold(nickname)
                 try:
-                    # Attendi un po' per evitare conflitti tra istanze
-                    await asyncio.sleep(random.uniform(0.3, 1.0))
+                    async with session_manager.use(nickname):
+                        await client.start(phone_number)
                     
                     async with client:
                         client_id = id(client)
-                        # Aggiungi tentativi multipli per il login
-                        max_attempts = 5
-                        for attempt in range(max_attempts):
-                            try:
-                                await client.start(phone_number)
-                                break
-                            except Exception as e:
-                                if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                                    print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                                    await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                                else:
-                                    raise
                         
                         bot_entity = await client.get_me()
                         bot_info = await get_user_info(client, bot_entity.id)
@@ -209,6 +188,8 @@ async def start_monitoring(instance_id=None):
                     except Exception as e:
                         log_error(f"Errore durante la disconnessione del client {nickname}: {e}")
                     
+                    exported_senders.release_hold(nickname)
+                    
                     # Rimuovi il client dalla lista dei client attivi
                     if client_key in active_clients:
                         c_id = id(active_clients[client_key])
@@ -237,9 +218,6 @@ async def start_monitoring(instance_id=None):
             except Exception as e:
                 log_error(f"Errore durante la disconnessione del client: {e}")
         
-        # Pulisci le sessioni solo dopo aver disconnesso tutti i client
-        time.sleep(2)  # Breve attesa per permettere alle disconnessioni di completarsi
-        
         # Rilascia le sessioni per questa operazione
         print(f"Rilascio sessioni per operazione di monitoraggio: {operation_id}")
         session_manager.release_session(operation_id)
@@ -0,0 +1,215 @@
+"""
+Cache delle connessioni verso data center esterni
+
+I media di un gruppo possono trovarsi su un data center (DC) diverso da
+quello dell'account. Telethon crea per ogni client una connessione
+"esportata" verso quel DC (esportazione e importazione dell'autorizzazione
+comprese) e la chiude dopo un minuto di inattività. Questo modulo conserva
+queste connessioni per account e DC, condivise da tutti i client dello
+stesso account sullo stesso loop, e le mantiene attive finché ci sono
+archivi o monitoraggi in corso o fino al timeout di inattività.
+"""
+
+import asyncio
+import threading
+import time
+from utils import log_error, log_info
+from config import EXPORTED_SENDER_IDLE_TIMEOUT
+
+class ExportedSender:
+    """Connessione esportata verso un DC con le informazioni sul suo utilizzo"""
+
+    def __init__(self, nickname, dc_id, sender, loop):
+        self.nickname = nickname
+        self.dc_id = dc_id
+        self.sender = sender
+        self.loop = loop
+        self.borrows = 0
+        self.reuses = 0
+        self.created_at = time.time()
+        self.last_used = self.created_at
+
+class ExportedSenderCache:
+    """
+    Gestisce le connessioni esportate di tutti gli account
+
+    Le connessioni sono legate al loop di eventi su cui sono state create,
+    quindi la chiave comprende anche il loop. Durante un'operazione
+    registrata con hold() le connessioni dell'account non vengono chiuse.
+    """
+
+    def __init__(self, idle_timeout=EXPORTED_SENDER_IDLE_TIMEOUT):
+        """Inizializza la cache delle connessioni esportate"""
+        self.idle_timeout = idle_timeout
+        self.entries = {}
+        self.holds = {}
+        self.entries_lock = threading.RLock()
+        self._senders = {}
+        self._locks = {}
+
+    async def borrow(self, client, nickname, dc_id):
+        """
+        Prende in prestito la connessione esportata dell'account verso un DC
+
+        Args:
+            client: Client che richiede la connessione (usato per crearla)
+            nickname: Nome utente
+            dc_id: ID del data center
+
+        Returns:
+            MTProtoSender connesso al DC
+        """
+        loop = asyncio.get_running_loop()
+        key = (nickname, dc_id, loop)
+
+        with self.entries_lock:
+            lock = self._locks.setdefault(key, asyncio.Lock())
+
+        async with lock:
+            with self.entries_lock:
+                entry = self.entries.get(key)
+
+            if entry is None:
+                sender = await client._create_exported_sender(dc_id)
+                sender.dc_id = dc_id
+                entry = ExportedSender(nickname, dc_id, sender, loop)
+                with self.entries_lock:
+                    self.entries[key] = entry
+                    self._senders[id(sender)] = entry
+                log_info(f"Connessione esportata aperta per {nickname} verso il DC {dc_id}", "exported_senders.log")
+            elif not entry.sender.is_connected():
+                # Riconnessione con la stessa autorizzazione, senza esportarla di nuovo
+                dc = await client._get_dc(dc_id)
+                await entry.sender.connect(client._connection(
+                    dc.ip_address,
+                    dc.port,
+                    dc.id,
+                    loggers=client._log,
+                    proxy=client._proxy,
+                    local_addr=client._local_addr
+                ))
+            else:
+                entry.reuses += 1
+
+            with self.entries_lock:
+                entry.borrows += 1
+                entry.last_used = time.time()
+
+            return entry.sender
+
+    async def release(self, sender):
+        """Restituisce una connessione presa in prestito (resta aperta nella cache)"""
+        with self.entries_lock:
+            entry = self._senders.get(id(sender))
+            if entry is not None:
+                entry.borrows = max(0, entry.borrows - 1)
+                entry.last_used = time.time()
+
+    def hold(self, nickname):
+        """
+        Mantiene aperte le connessioni esportate dell'account durante un'operazione
+
+        Ogni chiamata deve essere seguita da release_hold() al termine.
+
+        Args:
+            nickname: Nome utente
+        """
+        with self.entries_lock:
+            self.holds[nickname] = self.holds.get(nickname, 0) + 1
+
+    def release_hold(self, nickname):
+        """
+        Segnala la fine di un'operazione iniziata con hold()
+
+        Args:
+            nickname: Nome utente
+        """
+        with self.entries_lock:
+            if nickname not in self.holds:
+                return
+            self.holds[nickname] -= 1
+            if self.holds[nickname] <= 0:
+                del self.holds[nickname]
+
+            # Il timeout di inattività parte dalla fine dell'operazione
+            now = time.time()
+            for entry in self.entries.values():
+                if entry.nickname == nickname:
+                    entry.last_used = max(entry.last_used, now)
+
+    async def _close(self, entry):
+        """Disconnette una connessione esportata e la rimuove dalla cache"""
+        with self.entries_lock:
+            key = (entry.nickname, entry.dc_id, entry.loop)
+            if self.entries.get(key) is entry:
+                del self.entries[key]
+                self._locks.pop(key, None)
+            self._senders.pop(id(entry.sender), None)
+
+        try:
+            # La disconnessione di Telethon non solleva eccezioni
+            await entry.sender.disconnect()
+            log_info(f"Connessione esportata chiusa per {entry.nickname} verso il DC {entry.dc_id}", "exported_senders.log")
+        except Exception as e:
+            log_error(f"Errore durante la chiusura della connessione esportata di {entry.nickname}: {e}")
+
+    def _entries_on_current_loop(self, predicate):
+        """Connessioni del loop corrente che soddisfano una condizione"""
+        loop = asyncio.get_running_loop()
+        with self.entries_lock:
+            return [
+                entry for entry in self.entries.values()
+                if entry.loop is loop and predicate(entry)
+            ]
+
+    async def clean_idle(self):
+        """Chiude le connessioni inattive del loop corrente"""
+        # Scarta le connessioni di loop ormai chiusi (es. asyncio.run della CLI)
+        with self.entries_lock:
+            for key, entry in list(self.entries.items()):
+                if entry.loop.is_closed():
+                    del self.entries[key]
+                    self._locks.pop(key, None)
+                    self._senders.pop(id(entry.sender), None)
+
+        now = time.time()
+        idle_entries = self._entries_on_current_loop(
+            lambda entry: entry.borrows == 0
+            and entry.nickname not in self.holds
+            and now - entry.last_used > self.idle_timeout
+        )
+        for entry in idle_entries:
+            await self._close(entry)
+
+    async def close_account(self, nickname):
+        """Chiude le connessioni esportate di un account sul loop corrente"""
+        for entry in self._entries_on_current_loop(lambda entry: entry.nickname == nickname):
+            await self._close(entry)
+
+    async def close_all(self):
+        """Chiude tutte le connessioni esportate del loop corrente"""
+        for entry in self._entries_on_current_loop(lambda entry: True):
+            await self._close(entry)
+
+    def get_status(self):
+        """
+        Ottiene lo stato delle connessioni esportate
+
+        Returns:
+            Dictionary nickname -> connessioni per DC
+        """
+        status = {}
+        with self.entries_lock:
+            for entry in self.entries.values():
+                status.setdefault(entry.nickname, []).append({
+                    'dc_id': entry.dc_id,
+                    'connected': entry.sender.is_connected(),
+                    'borrows': entry.borrows,
+                    'reuses': entry.reuses,
+                    'held': entry.nickname in self.holds,
+                    'last_used': entry.last_used
+                })
+        return status
+
+# Singleton globale del ExportedSenderCache
+exported_senders = ExportedSenderCache()
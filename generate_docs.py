@@ -146,12 +146,430 @@ api_docs = {
                     "type": "string",
                     "required": True,
                     "description": "Nome utente associato al gruppo"
+                },
+                {
+                    "name": "sharded",
+                    "type": "boolean",
+                    "required": False,
+                    "description": "Scarica l'archivio in parallelo con tutti gli account che hanno accesso al gruppo (solo supergruppi e canali)"
+                },
+                {
+                    "name": "filters",
+                    "type": "object",
+                    "required": False,
+                    "description": "Filtri applicati da Telegram: media_types (images, videos, audio, voice, documents, stickers, gifs), date_from, date_to (YYYY-MM-DD), senders (ID o username), min_size, max_size (byte)"
+                },
+                {
+                    "name": "lazy",
+                    "type": "boolean",
+                    "required": False,
+                    "description": "Salva solo miniature e metadati dei media: i file completi vengono scaricati alla prima richiesta"
+                },
+                {
+                    "name": "priority",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Priorità nella coda delle operazioni (i valori più alti partono prima, default 0)"
                 }
             ],
             "response": {
-                "status": "started",
-                "operation_id": "archive_1234567890",
-                "message": "Download archivio avviato per il gruppo Example Group"
+                "status": "queued",
+                "operation_id": "archive_3f2c9a7d0b8e4e61a5d4c2b1f0e9d8c7",
+                "position": 2,
+                "message": "Download archivio accodato per il gruppo Example Group"
+            }
+        },
+        {
+            "path": "/archives/{user}/{group}/export",
+            "method": "GET",
+            "description": "Esporta l'archivio di un gruppo come file TAR o ZIP generato in streaming (senza file temporanei). Il TAR supporta l'header Range (bytes=N-) con If-Range sull'ETag",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome utente dell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "group",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome della cartella del gruppo nell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "format",
+                    "type": "string",
+                    "required": False,
+                    "description": "tar (default) o zip",
+                    "in": "query"
+                },
+                {
+                    "name": "types",
+                    "type": "string",
+                    "required": False,
+                    "description": "Tipi di media da includere separati da virgola (images,videos,...)",
+                    "in": "query"
+                },
+                {
+                    "name": "date_from",
+                    "type": "string",
+                    "required": False,
+                    "description": "Includi solo i media da questa data (YYYY-MM-DD)",
+                    "in": "query"
+                },
+                {
+                    "name": "date_to",
+                    "type": "string",
+                    "required": False,
+                    "description": "Includi solo i media fino a questa data (YYYY-MM-DD)",
+                    "in": "query"
+                },
+                {
+                    "name": "filter",
+                    "type": "string",
+                    "required": False,
+                    "description": "ID dei filtri per esportare un archivio filtrato",
+                    "in": "query"
+                },
+                {
+                    "name": "offset",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Byte da cui riprendere un'esportazione interrotta",
+                    "in": "query"
+                }
+            ],
+            "response": "File TAR o ZIP in streaming"
+        },
+        {
+            "path": "/archives/{user}/{group}/media",
+            "method": "GET",
+            "description": "Elenca i media di un archivio lazy con miniature e metadati",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome utente dell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "group",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome della cartella del gruppo nell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "type",
+                    "type": "string",
+                    "required": False,
+                    "description": "Filtra per tipo di media (images, videos, etc.)",
+                    "in": "query"
+                }
+            ],
+            "response": {
+                "media": [
+                    {
+                        "id": 5021,
+                        "group_id": -1001234567890,
+                        "type": "images",
+                        "timestamp": 1704067200,
+                        "size": 2097152,
+                        "mime_type": "image/jpeg",
+                        "name": None,
+                        "sender_id": 123456789,
+                        "thumbnail": "thumbnails/1704067200_5021.jpg",
+                        "file": None,
+                        "available": False
+                    }
+                ]
+            }
+        },
+        {
+            "path": "/archives/{user}/{group}/media/{message_id}",
+            "method": "GET",
+            "description": "Restituisce un media di un archivio lazy: il file completo viene scaricato da Telegram alla prima richiesta",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome utente dell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "group",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome della cartella del gruppo nell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "message_id",
+                    "type": "integer",
+                    "required": True,
+                    "description": "ID del messaggio del media",
+                    "in": "path"
+                },
+                {
+                    "name": "thumbnail",
+                    "type": "boolean",
+                    "required": False,
+                    "description": "Restituisce la miniatura invece del file completo",
+                    "in": "query"
+                }
+            ],
+            "response": "File binario"
+        },
+        {
+            "path": "/archives/{user}/{group}/messages.ndjson.gz",
+            "method": "GET",
+            "description": "Scarica i messaggi di un archivio in NDJSON compresso a blocchi gzip indipendenti (supporta Range per leggere singoli blocchi)",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome utente dell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "group",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome della cartella del gruppo nell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "filter",
+                    "type": "string",
+                    "required": False,
+                    "description": "ID dei filtri di un archivio filtrato",
+                    "in": "query"
+                },
+                {
+                    "name": "refresh",
+                    "type": "boolean",
+                    "required": False,
+                    "description": "Aggiunge prima i messaggi salvati dopo l'ultima esportazione",
+                    "in": "query"
+                }
+            ],
+            "response": "File NDJSON compresso (un messaggio JSON per riga)"
+        },
+        {
+            "path": "/archives/{user}/{group}/messages/index",
+            "method": "GET",
+            "description": "Indice dei blocchi dell'esportazione NDJSON: posizione, lunghezza, intervallo di ID e di date di ogni blocco",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome utente dell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "group",
+                    "type": "string",
+                    "required": True,
+                    "description": "Nome della cartella del gruppo nell'archivio",
+                    "in": "path"
+                },
+                {
+                    "name": "filter",
+                    "type": "string",
+                    "required": False,
+                    "description": "ID dei filtri di un archivio filtrato",
+                    "in": "query"
+                },
+                {
+                    "name": "refresh",
+                    "type": "boolean",
+                    "required": False,
+                    "description": "Aggiunge prima i messaggi salvati dopo l'ultima esportazione",
+                    "in": "query"
+                },
+                {
+                    "name": "date_from",
+                    "type": "string",
+                    "required": False,
+                    "description": "Solo i blocchi con messaggi a partire da questa data (YYYY-MM-DD)",
+                    "in": "query"
+                },
+                {
+                    "name": "date_to",
+                    "type": "string",
+                    "required": False,
+                    "description": "Solo i blocchi con messaggi fino a questa data inclusa (YYYY-MM-DD)",
+                    "in": "query"
+                }
+            ],
+            "response": {
+                "version": 1,
+                "chat_id": -1001234567890,
+                "accounts": ["example_user"],
+                "filters": None,
+                "chunk_size": 5000,
+                "max_id": 12480,
+                "messages": 12000,
+                "size": 1048576,
+                "chunks": [
+                    {
+                        "offset": 0,
+                        "length": 524288,
+                        "count": 5000,
+                        "first_id": 1,
+                        "last_id": 5120,
+                        "date_from": 1704067200,
+                        "date_to": 1706745600
+                    }
+                ]
+            }
+        },
+        {
+            "path": "/messages/search",
+            "method": "GET",
+            "description": "Cerca nei messaggi salvati da monitoraggi e archivi (indice full-text)",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "q",
+                    "type": "string",
+                    "required": False,
+                    "description": "Ricerca full-text (parole, \"frasi\", prefissi*, AND/OR/NOT)",
+                    "in": "query"
+                },
+                {
+                    "name": "user",
+                    "type": "string",
+                    "required": False,
+                    "description": "Cerca solo nei messaggi di questo utente",
+                    "in": "query"
+                },
+                {
+                    "name": "chat_id",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Filtra per ID della chat",
+                    "in": "query"
+                },
+                {
+                    "name": "sender_id",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Filtra per ID del mittente",
+                    "in": "query"
+                },
+                {
+                    "name": "date_from",
+                    "type": "string",
+                    "required": False,
+                    "description": "Messaggi da questa data (YYYY-MM-DD)",
+                    "in": "query"
+                },
+                {
+                    "name": "date_to",
+                    "type": "string",
+                    "required": False,
+                    "description": "Messaggi fino a questa data (YYYY-MM-DD)",
+                    "in": "query"
+                },
+                {
+                    "name": "media_type",
+                    "type": "string",
+                    "required": False,
+                    "description": "Filtra per tipo di media (images, videos, etc.)",
+                    "in": "query"
+                },
+                {
+                    "name": "limit",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Numero massimo di risultati (default 50, massimo 500)",
+                    "in": "query"
+                },
+                {
+                    "name": "offset",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Risultati da saltare (paginazione)",
+                    "in": "query"
+                }
+            ],
+            "response": {
+                "messages": [
+                    {
+                        "account": "example_user",
+                        "chat_id": -1001234567890,
+                        "id": 5021,
+                        "chat_name": "Example Group",
+                        "sender_id": 123456789,
+                        "sender_name": "Mario Rossi (@mario)",
+                        "date": 1704067200,
+                        "text": "Ci vediamo domani in stazione",
+                        "reply_to": None,
+                        "fwd_from": None,
+                        "fwd_name": None,
+                        "media_type": "images",
+                        "media_path": "downloads/example_user/Example_Group/images/1704067200_5021.jpg",
+                        "media_size": 2097152,
+                        "snippet": "Ci vediamo domani in [stazione]"
+                    }
+                ],
+                "took_ms": 2.4
+            }
+        },
+        {
+            "path": "/operations/{operation_id}",
+            "method": "GET",
+            "description": "Ottiene lo stato di un'operazione, anche se ancora in coda",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "operation_id",
+                    "type": "string",
+                    "required": True,
+                    "description": "ID dell'operazione",
+                    "in": "path"
+                }
+            ],
+            "response": {
+                "operation": {
+                    "id": "archive_3f2c9a7d0b8e4e61a5d4c2b1f0e9d8c7",
+                    "type": "archive",
+                    "status": "queued",
+                    "priority": 0,
+                    "position": 2
+                }
+            }
+        },
+        {
+            "path": "/operations/{operation_id}",
+            "method": "DELETE",
+            "description": "Annulla un'operazione in coda o in esecuzione",
+            "auth_required": True,
+            "params": [
+                {
+                    "name": "operation_id",
+                    "type": "string",
+                    "required": True,
+                    "description": "ID dell'operazione",
+                    "in": "path"
+                }
+            ],
+            "response": {
+                "status": "cancelling",
+                "operation_id": "archive_3f2c9a7d0b8e4e61a5d4c2b1f0e9d8c7",
+                "message": "Operazione in fase di annullamento"
             }
         },
         {
@@ -205,7 +623,7 @@ api_docs = {
         {
             "path": "/media",
             "method": "GET",
-            "description": "Ottiene la lista dei file media",
+            "description": "Ottiene la lista dei file media dall'indice dei media scaricati (dal più recente), esclusi i file non più presenti sul disco",
             "auth_required": True,
             "params": [
                 {
@@ -225,16 +643,61 @@ api_docs = {
                     "type": "string",
                     "required": False,
                     "description": "Filtra per tipo di media (images, videos, etc.)"
+                },
+                {
+                    "name": "sender_id",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Filtra per ID del mittente"
+                },
+                {
+                    "name": "message_id",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Filtra per ID del messaggio"
+                },
+                {
+                    "name": "date_from",
+                    "type": "string",
+                    "required": False,
+                    "description": "Media a partire da questa data (YYYY-MM-DD)"
+                },
+                {
+                    "name": "date_to",
+                    "type": "string",
+                    "required": False,
+                    "description": "Media fino a questa data inclusa (YYYY-MM-DD)"
+                },
+                {
+                    "name": "limit",
+                    "type": "integer",
+                    "required": False,
+                    "description": "Numero massimo di file restituiti (default 100, massimo 1000)"
+                },
+                {
+                    "name": "offset",
+                    "type": "integer",
+                    "required": False,
+                    "description": "File da saltare, per la paginazione (default: 0)"
                 }
             ],
             "response": {
                 "files": [
                     {
-                        "name": "example_image.jpg",
-                        "path": "example_user/Example_Group/images/example_image.jpg",
+                        "name": "1700000000_12345.jpg",
+                        "path": "example_user/Example_Group/images/1700000000_12345.jpg",
                         "size": 12345,
                         "type": "jpg",
-                        "last_modified": "YYYY-MM-DD HH:MM:SS"
+                        "last_modified": "YYYY-MM-DD HH:MM:SS",
+                        "user": "example_user",
+                        "group": "Example_Group",
+                        "group_id": -1001234567890,
+                        "media_type": "images",
+                        "sender_id": 123456789,
+                        "sender": "Example User (@example_user)",
+                        "message_id": 12345,
+                        "date": 1700000000,
+                        "file_id": "AgACAgQAAxkBAAI..."
                     }
                 ]
             }
@@ -283,6 +746,22 @@ api_docs = {
                 "status": "downloading",
                 "time": "YYYY-MM-DD HH:MM:SS"
             }
+        },
+        {
+            "event": "archive_progress",
+            "description": "Avanzamento del download archivio (al massimo ogni 2 secondi)",
+            "data": {
+                "operation_id": "archive_1234567890",
+                "messages": 1200,
+                "messages_per_second": 85.3,
+                "files_completed": 140,
+                "files_in_flight": [{"message_id": 5021, "bytes": 524288, "total": 2097152, "remaining": 1572864}],
+                "bytes_downloaded": 73400320,
+                "bytes_per_second": 2621440,
+                "progress": 0.42,
+                "elapsed": 60,
+                "eta_seconds": 83
+            }
         }
     ]
 }
@@ -1,49 +1,24 @@
 import asyncio
-import os
-import random
-import shutil
-from telethon import TelegramClient, errors
+from contextlib import asynccontextmanager
+from telethon import errors
+from rate_limiter import ScheduledTelegramClient
+from session_manager import session_manager
+from path_resolver import path_resolver
 from utils import load_json, save_json, sanitize_group_name, log_error
 from config import API_ID, API_HASH, USER_GROUPS_FILE, PHONE_NUMBERS_FILE
 
 async def create_client_for_instance(nickname, instance_id=None):
     """Crea un client con sessione dedicata per questa istanza."""
-    # Sessione originale
-    original_session = f'session_{nickname}.session'
+    # Sessione in memoria dedicata, senza copiare il file originale
+    _, session = session_manager.create_session(nickname, instance_id)
     
-    if instance_id:
-        # Crea una sessione dedicata per questa istanza
-        instance_session = f'session_{nickname}_{instance_id}.session'
-        
-        # Copia il file di sessione originale per creare una sessione dedicata
-        if os.path.exists(original_session) and not os.path.exists(instance_session):
-            try:
-                shutil.copy2(original_session, instance_session)
-            except Exception as e:
-                log_error(f"Errore nella copia del file di sessione: {e}")
-                # Se non riusciamo a copiare, continuiamo comunque con il file originale
-                instance_session = original_session
-        elif not os.path.exists(original_session):
-            # Se il file originale non esiste, usalo comunque (verrà creato)
-            instance_session = original_session
-            
-        # Crea il client con la sessione dell'istanza
-        client = TelegramClient(
-            instance_session.replace('.session', ''),  # Rimuovi l'estensione
-            API_ID, 
-            API_HASH,
-            connection_retries=10,
-            retry_delay=3
-        )
-    else:
-        # Se non c'è ID istanza, usa la sessione originale
-        client = TelegramClient(
-            original_session.replace('.session', ''),
-            API_ID, 
-            API_HASH,
-            connection_retries=10,
-            retry_delay=3
-        )
+    client = ScheduledTelegramClient(
+        session,
+        API_ID, 
+        API_HASH,
+        connection_retries=10,
+        retry_delay=3
+    )
     
     return client
 
@@ -69,12 +44,33 @@ async def list_chats(client, nickname):
         log_error(f"Errore durante il recupero dei gruppi per {nickname}: {e}")
         return []
 
-async def get_all_user_groups(instance_id=None):
+@asynccontextmanager
+async def connected_client(nickname, phone_number, instance_id=None, pool=None):
+    """Fornisce un client connesso per l'utente, preso dal pool se disponibile."""
+    if pool is not None:
+        # Il client del pool resta connesso dopo l'uso
+        async with pool.lease(nickname) as client:
+            yield client
+        return
+
+    # Utilizza il client migliorato
+    client = await create_client_for_instance(nickname, instance_id)
+    try:
+        async with session_manager.use(nickname):
+            await client.start(phone_number)
+        
+        yield client
+    finally:
+        if client.is_connected():
+            await client.disconnect()
+        if instance_id:
+            session_manager.release_session(instance_id, nickname)
+
+async def get_all_user_groups(instance_id=None, pool=None):
     """Recupera tutti i gruppi per tutti gli utenti."""
     phone_numbers = load_json(PHONE_NUMBERS_FILE)
     user_groups = {}
     tasks = []
-    temp_sessions = []
 
     if not phone_numbers:
         print("❌ Nessun utente salvato. Aggiungi almeno un utente.")
@@ -82,127 +78,58 @@ async def get_all_user_groups(instance_id=None):
 
     for nickname, phone_number in phone_numbers.items():
         async def get_groups_for_user(nickname, phone_number):
-            # Utilizza il client migliorato
-            user_client = await create_client_for_instance(nickname, instance_id)
-            if instance_id:
-                temp_sessions.append(f'session_{nickname}_{instance_id}.session')
-                
             try:
-                # Evita conflitti con altre istanze
-                await asyncio.sleep(random.uniform(0.2, 0.5))
-                
-                # Aggiungi tentativi multipli per l'avvio
-                max_attempts = 5
-                for attempt in range(max_attempts):
-                    try:
-                        await user_client.start(phone_number)
-                        break
-                    except Exception as e:
-                        if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                            print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                            await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                        else:
-                            raise
-                
-                groups = await list_chats(user_client, nickname)
-                await user_client.disconnect()
+                async with connected_client(nickname, phone_number, instance_id, pool) as user_client:
+                    groups = await list_chats(user_client, nickname)
                 return nickname, groups
             except Exception as e:
                 log_error(f"Errore per l'utente {nickname}: {e}")
-                if user_client.is_connected():
-                    await user_client.disconnect()
                 return nickname, []
 
         tasks.append(get_groups_for_user(nickname, phone_number))
 
-    try:
-        results = await asyncio.gather(*tasks)
-        
-        for nickname, groups in results:
-            if groups:
-                user_groups[nickname] = groups
+    results = await asyncio.gather(*tasks)
+    
+    for nickname, groups in results:
+        if groups:
+            user_groups[nickname] = groups
+    
+    if not user_groups:
+        print("❌ Nessun gruppo trovato per nessun utente.")
+        return False
         
-        if not user_groups:
-            print("❌ Nessun gruppo trovato per nessun utente.")
-            return False
-            
-        save_json(USER_GROUPS_FILE, user_groups)
-        print(f"✅ Gruppi salvati in {USER_GROUPS_FILE}")
-        return True
-    finally:
-        # Pulizia delle sessioni temporanee
-        for session_file in temp_sessions:
-            if os.path.exists(session_file):
-                try:
-                    os.remove(session_file)
-                except:
-                    pass
+    save_json(USER_GROUPS_FILE, user_groups)
+    # Le cartelle dei gruppi vengono risolte di nuovo con i nomi aggiornati
+    path_resolver.invalidate()
+    print(f"✅ Gruppi salvati in {USER_GROUPS_FILE}")
+    return True
 
-async def get_group_link(chat_id, instance_id=None):
+async def get_group_link(chat_id, instance_id=None, pool=None):
     """Ottiene il link di un gruppo dato il chat_id."""
     phone_numbers = load_json(PHONE_NUMBERS_FILE)
-    temp_sessions = []
     
     if not phone_numbers:
         print("❌ Nessun utente salvato. Aggiungi almeno un utente.")
         return None
     
     for nickname, phone_number in phone_numbers.items():
-        # Utilizza il client migliorato
-        client = await create_client_for_instance(nickname, instance_id)
-        if instance_id:
-            temp_sessions.append(f'session_{nickname}_{instance_id}.session')
-            
         try:
-            # Evita conflitti con altre istanze
-            await asyncio.sleep(random.uniform(0.2, 0.5))
-            
-            # Aggiungi tentativi multipli per l'avvio
-            max_attempts = 5
-            connected = False
-            
-            for attempt in range(max_attempts):
-                try:
-                    await client.start(phone_number)
-                    connected = True
-                    break
-                except Exception as e:
-                    if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                        print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                        await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                    else:
-                        raise
-            
-            if connected:
+            async with connected_client(nickname, phone_number, instance_id, pool) as client:
                 try:
                     group = await client.get_entity(int(chat_id))
                     if hasattr(group, 'username') and group.username:
                         link = f"https://t.me/{group.username}"
                         print(f"🔗 Link del gruppo trovato con {nickname}: {link}")
-                        await client.disconnect()
                         return link
                     else:
                         print(f"⚠️ Il gruppo ({chat_id}) trovato da {nickname} non ha un link pubblico.")
                 except Exception as e:
                     print(f"⚠️ Utente {nickname} non può accedere al gruppo: {e}")
-                finally:
-                    if client.is_connected():
-                        await client.disconnect()
         except Exception as e:
             print(f"❌ Errore di connessione con l'utente {nickname}: {e}")
-            if client.is_connected():
-                await client.disconnect()
-        finally:
-            # Pulizia delle sessioni temporanee
-            for session_file in temp_sessions:
-                if os.path.exists(session_file):
-                    try:
-                        os.remove(session_file)
-                    except:
-                        pass
-        
-        print("❌ Nessun utente ha accesso a questo gruppo.")
-        return None
+    
+    print("❌ Nessun utente ha accesso a questo gruppo.")
+    return None
 
 def display_all_groups():
     """Mostra tutti i gruppi disponibili in formato numerato."""
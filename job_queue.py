@@ -0,0 +1,266 @@
+"""
+Coda persistente delle operazioni di lunga durata
+
+Ogni richiesta di archivio diventa un job con un ID univoco, salvato su
+disco con i suoi parametri. I job partono in ordine di priorità (e di
+arrivo) solo se c'è posto sia nel limite globale sia nel limite di ogni
+account coinvolto, così una raffica di richieste resta in coda invece di
+sovraccaricare gli account. Al riavvio del server i job in coda e quelli
+interrotti ripartono; gli archivi riprendono dal proprio checkpoint.
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from telegram_engine import telegram_engine
+from utils import log_error, log_info
+from config import JOBS_FILE, JOBS_MAX_RUNNING, JOBS_MAX_PER_ACCOUNT, JOBS_HISTORY_LIMIT
+
+# Stati dei job: quelli finali non vengono più eseguiti
+QUEUED = "queued"
+RUNNING = "running"
+FINAL_STATUSES = ("completed", "failed", "error", "cancelled")
+
+class JobQueue:
+    """
+    Coda dei job con priorità e limiti di concorrenza
+
+    I tipi di job vengono registrati con register(): la funzione del job
+    riceve il dizionario del job e restituisce lo stato finale.
+    """
+
+    def __init__(self, jobs_file=JOBS_FILE, max_running=JOBS_MAX_RUNNING, max_per_account=JOBS_MAX_PER_ACCOUNT):
+        """Inizializza la coda dei job"""
+        self.jobs_file = jobs_file
+        self.max_running = max_running
+        self.max_per_account = max_per_account
+        self.jobs = {}
+        self.runners = {}
+        self.lock = threading.RLock()
+        self.stopping = False
+        self._load()
+
+    def _load(self):
+        """Legge i job salvati"""
+        if not os.path.exists(self.jobs_file):
+            return
+        try:
+            with open(self.jobs_file, "r", encoding="utf-8") as f:
+                self.jobs = {job["id"]: job for job in json.load(f)}
+        except Exception as e:
+            log_error(f"Impossibile leggere la coda dei job {self.jobs_file}: {e}")
+
+    def _save(self):
+        """Salva i job in modo atomico, mantenendo solo gli ultimi job conclusi"""
+        with self.lock:
+            finished = sorted(
+                (job for job in self.jobs.values() if job["status"] in FINAL_STATUSES),
+                key=lambda job: job.get("ended") or 0
+            )
+            for job in finished[:max(0, len(finished) - JOBS_HISTORY_LIMIT)]:
+                del self.jobs[job["id"]]
+
+            temp_file = f"{self.jobs_file}.tmp"
+            try:
+                with open(temp_file, "w", encoding="utf-8") as f:
+                    json.dump(list(self.jobs.values()), f, indent=2)
+                os.replace(temp_file, self.jobs_file)
+            except Exception as e:
+                log_error(f"Errore durante il salvataggio della coda dei job: {e}")
+
+    def register(self, job_type, runner, get_accounts):
+        """
+        Registra un tipo di job
+
+        Args:
+            job_type: Nome del tipo (es. "archive")
+            runner: Coroutine function che riceve il job e restituisce lo stato finale
+            get_accounts: Funzione che dai parametri restituisce gli account usati dal job
+        """
+        self.runners[job_type] = (runner, get_accounts)
+
+    def submit(self, job_type, params, priority=0):
+        """
+        Aggiunge un job alla coda
+
+        Args:
+            job_type: Tipo del job registrato
+            params: Parametri del job (serializzabili in JSON)
+            priority: Priorità (i valori più alti partono prima)
+
+        Returns:
+            Dictionary del job
+        """
+        if job_type not in self.runners:
+            raise ValueError(f"Tipo di job non registrato: {job_type}")
+
+        job = {
+            "id": f"{job_type}_{uuid.uuid4().hex}",
+            "type": job_type,
+            "params": params,
+            "priority": priority,
+            "accounts": self.runners[job_type][1](params),
+            "status": QUEUED,
+            "created": time.time(),
+            "started": None,
+            "ended": None,
+            "attempts": 0
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self._save()
+        self._schedule()
+        return dict(job)
+
+    def _can_start(self, job, running):
+        """Verifica i limiti di concorrenza globale e per account"""
+        if len(running) >= self.max_running:
+            return False
+        for account in job["accounts"]:
+            if sum(account in other["accounts"] for other in running) >= self.max_per_account:
+                return False
+        return True
+
+    def _schedule(self):
+        """Avvia i job in coda per cui c'è posto"""
+        with self.lock:
+            if self.stopping:
+                return
+
+            running = [job for job in self.jobs.values() if job["status"] == RUNNING]
+            queued = sorted(
+                (job for job in self.jobs.values() if job["status"] == QUEUED),
+                key=lambda job: (-job["priority"], job["created"])
+            )
+            started = []
+            for job in queued:
+                if self._can_start(job, running):
+                    job["status"] = RUNNING
+                    job["started"] = time.time()
+                    job["attempts"] += 1
+                    running.append(job)
+                    started.append(job)
+
+            if started:
+                self._save()
+
+            # Il task viene registrato prima di rilasciare il lock: cancel() lo trova sempre
+            for job in started:
+                telegram_engine.submit(self._run(job), name=job["id"], task_type=job["type"])
+
+    async def _run(self, job):
+        """Esegue un job, ne registra lo stato finale e avvia i job successivi"""
+        runner = self.runners[job["type"]][0]
+        log_info(f"Job {job['id']} avviato (tentativo {job['attempts']})", "jobs.log")
+
+        try:
+            status = await runner(job)
+        except asyncio.CancelledError:
+            with self.lock:
+                if job.get("cancel_requested"):
+                    job["status"] = "cancelled"
+                    job["ended"] = time.time()
+                # Altrimenti è l'arresto del server: il job resta in esecuzione e riparte al riavvio
+                self._save()
+            self._schedule()
+            raise
+        except Exception as e:
+            log_error(f"Errore nel job {job['id']}: {e}")
+            status = "error"
+            job["error"] = str(e)
+
+        with self.lock:
+            job["status"] = status if status in FINAL_STATUSES else "completed"
+            job["ended"] = time.time()
+            self._save()
+        log_info(f"Job {job['id']} concluso: {job['status']}", "jobs.log")
+        self._schedule()
+
+    def resume(self):
+        """
+        Riavvia i job rimasti in coda o interrotti dall'ultimo arresto
+
+        Returns:
+            Numero di job rimessi in coda
+        """
+        with self.lock:
+            resumed = 0
+            for job in self.jobs.values():
+                if job["status"] == RUNNING:
+                    job["status"] = QUEUED
+                if job["status"] == QUEUED:
+                    # Un annullamento non riuscito non vale per la nuova esecuzione
+                    job.pop("cancel_requested", None)
+                    resumed += 1
+            self._save()
+
+        if resumed:
+            log_info(f"{resumed} job ripresi dopo il riavvio", "jobs.log")
+        self._schedule()
+        return resumed
+
+    def cancel(self, job_id):
+        """
+        Annulla un job in coda o in esecuzione
+
+        Returns:
+            True se il job è stato annullato
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job["status"] in FINAL_STATUSES:
+                return False
+
+            # Il flag deve essere impostato prima di annullare il task, che lo legge
+            # in _run; se l'annullamento non riesce viene tolto
+            job["cancel_requested"] = True
+            if job["status"] == RUNNING and not telegram_engine.cancel(job_id):
+                del job["cancel_requested"]
+                return False
+
+            # Il posto del job si libera subito, anche se il task non era ancora partito
+            job["status"] = "cancelled"
+            job["ended"] = time.time()
+            self._save()
+
+        self._schedule()
+        return True
+
+    def get(self, job_id):
+        """Restituisce una copia di un job, con la posizione in coda se non è ancora partito"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+            if job["status"] == QUEUED:
+                queued = sorted(
+                    (other for other in self.jobs.values() if other["status"] == QUEUED),
+                    key=lambda other: (-other["priority"], other["created"])
+                )
+                job["position"] = [other["id"] for other in queued].index(job_id) + 1
+            return job
+
+    def stop(self):
+        """Impedisce l'avvio di nuovi job (all'arresto del server)"""
+        with self.lock:
+            self.stopping = True
+
+    def get_status(self):
+        """Restituisce lo stato della coda"""
+        with self.lock:
+            counts = {}
+            for job in self.jobs.values():
+                counts[job["status"]] = counts.get(job["status"], 0) + 1
+            return {
+                "max_running": self.max_running,
+                "max_per_account": self.max_per_account,
+                "counts": counts,
+                "jobs": [dict(job) for job in sorted(self.jobs.values(), key=lambda job: job["created"])]
+            }
+
+# Singleton globale della coda dei job
+job_queue = JobQueue()
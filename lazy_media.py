@@ -0,0 +1,217 @@
+"""
+Media degli archivi scaricati su richiesta
+
+In modalità "lazy" l'archivio di un gruppo salva per ogni media solo una
+miniatura (in thumbnails/) e i metadati (tipo, dimensione, nome, mittente,
+chiave nell'archivio condiviso). Il file completo viene scaricato la prima
+volta che viene richiesto tramite l'API e da quel momento resta nella
+cartella dell'archivio, come in un archivio completo.
+
+I riferimenti ai file di Telegram scadono dopo poche ore: al momento del
+download il messaggio viene letto di nuovo tramite il suo ID, così il
+riferimento è sempre valido. Un media già presente nell'archivio condiviso
+viene solo collegato, senza richieste a Telegram.
+
+L'indice va caricato fuori dal loop di eventi (get_lazy_index legge il
+file); le righe nuove vengono scritte tramite il text_writer.
+"""
+
+import asyncio
+import json
+import os
+import threading
+from utils import log_error
+from text_writer import text_writer
+from media_handler import get_media_type, download_shared_media
+from media_store import get_media_key, media_store
+from connection_pool import connection_pool
+from message_store import message_store
+from config import LAZY_THUMBNAIL_SIZE
+
+LAZY_INDEX_FILE = "lazy_media.jsonl"
+THUMBNAILS_DIR = "thumbnails"
+
+def select_thumbnail(message, max_size=LAZY_THUMBNAIL_SIZE):
+    """
+    Sceglie la miniatura da salvare per un media
+
+    Returns:
+        La miniatura più grande entro max_size pixel (o la più piccola disponibile), None se non ce ne sono
+    """
+    if message.photo:
+        sizes = message.photo.sizes or []
+    elif message.document:
+        sizes = message.document.thumbs or []
+    else:
+        sizes = []
+
+    # Le miniature compresse (senza dimensioni) sono usate solo se non c'è altro
+    measured = [size for size in sizes if getattr(size, 'w', None) and getattr(size, 'h', None)]
+    if not measured:
+        return sizes[0] if sizes else None
+
+    fitting = [size for size in measured if max(size.w, size.h) <= max_size]
+    if fitting:
+        return max(fitting, key=lambda size: size.w * size.h)
+    return min(measured, key=lambda size: size.w * size.h)
+
+def describe_media(message):
+    """Metadati di un media necessari per mostrarlo e scaricarlo in seguito"""
+    file = message.file
+    return {
+        "id": message.id,
+        "group_id": message.chat_id,
+        "type": get_media_type(message),
+        "key": get_media_key(message),
+        "timestamp": int(message.date.timestamp()),
+        "size": file.size if file else None,
+        "mime_type": file.mime_type if file else None,
+        "name": file.name if file else None,
+        "sender_id": message.sender_id,
+        "thumbnail": None,
+        "file": None
+    }
+
+class LazyMediaIndex:
+    """
+    Indice dei media di un archivio in modalità lazy
+
+    Ogni riga di lazy_media.jsonl descrive un media; in caso di più righe
+    per lo stesso messaggio vale l'ultima (ad esempio dopo il download).
+    """
+
+    def __init__(self, archive_path):
+        """Carica l'indice dalla cartella dell'archivio"""
+        self.archive_path = archive_path
+        self.index_file = os.path.join(archive_path, LAZY_INDEX_FILE)
+        self.entries = {}
+        self.lock = threading.RLock()
+        self.thumbnails_ready = False
+        self._load()
+
+    def _load(self):
+        """Legge l'indice, se esiste"""
+        # Righe di un'esecuzione precedente ancora in coda
+        text_writer.flush(timeout=60)
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["id"]] = entry
+                except (ValueError, KeyError):
+                    # Riga troncata da un'interruzione
+                    continue
+
+    def _record(self, entry):
+        """Aggiunge o aggiorna un media nell'indice"""
+        with self.lock:
+            self.entries[entry["id"]] = entry
+        text_writer.append(self.index_file, json.dumps(entry) + "\n")
+
+    def has(self, message_id):
+        """Verifica se un media è già nell'indice"""
+        with self.lock:
+            return message_id in self.entries
+
+    def get(self, message_id):
+        """Restituisce una copia dei metadati di un media (None se non presente)"""
+        with self.lock:
+            entry = self.entries.get(message_id)
+            return dict(entry) if entry else None
+
+    def list(self, media_type=None):
+        """Elenco dei media in ordine di ID, eventualmente di un solo tipo"""
+        with self.lock:
+            return [
+                dict(entry) for _, entry in sorted(self.entries.items())
+                if media_type is None or entry["type"] == media_type
+            ]
+
+    def path(self, entry, field):
+        """Percorso assoluto della miniatura o del file di un media (None se non salvato)"""
+        if not entry.get(field):
+            return None
+        path = os.path.join(self.archive_path, entry[field])
+        return path if os.path.exists(path) else None
+
+    async def save_preview(self, message):
+        """
+        Registra un media salvandone solo la miniatura
+
+        Returns:
+            Dictionary con i metadati del media
+        """
+        entry = describe_media(message)
+
+        thumbnail = select_thumbnail(message)
+        if thumbnail is not None:
+            thumb_dir = os.path.join(self.archive_path, THUMBNAILS_DIR)
+            if not self.thumbnails_ready:
+                await asyncio.get_running_loop().run_in_executor(None, lambda: os.makedirs(thumb_dir, exist_ok=True))
+                self.thumbnails_ready = True
+            try:
+                thumb_path = await message.download_media(
+                    file=os.path.join(thumb_dir, f"{entry['timestamp']}_{message.id}"), thumb=thumbnail
+                )
+                if thumb_path:
+                    entry["thumbnail"] = os.path.relpath(thumb_path, self.archive_path)
+            except Exception as e:
+                # Il media resta consultabile anche senza miniatura
+                log_error(f"Miniatura non scaricata per il messaggio {message.id}: {e}")
+
+        self._record(entry)
+        return entry
+
+    async def materialise(self, nickname, message_id):
+        """
+        Scarica il file completo di un media, se non è già presente
+
+        Args:
+            nickname: Account con accesso al gruppo (la connessione viene presa dal pool)
+            message_id: ID del messaggio del media
+
+        Returns:
+            Percorso del file, None se il media non è disponibile
+        """
+        entry = self.get(message_id)
+        if entry is None:
+            return None
+
+        loop = asyncio.get_running_loop()
+        path = await loop.run_in_executor(None, self.path, entry, "file")
+        if path:
+            return path
+
+        target = os.path.join(self.archive_path, entry["type"], f"{entry['timestamp']}_{message_id}")
+        await loop.run_in_executor(None, lambda: os.makedirs(os.path.dirname(target), exist_ok=True))
+
+        # Senza Telegram se il media è già nell'archivio condiviso
+        path = await media_store.link(entry["key"], target)
+        if not path:
+            async with connection_pool.lease(nickname) as client:
+                message = await client.get_messages(entry["group_id"], ids=message_id)
+                if not message or not message.media:
+                    log_error(f"Media non più disponibile su Telegram (messaggio {message_id})")
+                    return None
+                path = await download_shared_media(message, target)
+            if not path:
+                return None
+
+        entry["file"] = os.path.relpath(path, self.archive_path)
+        self._record(entry)
+        message_store.set_media(nickname, entry["group_id"], message_id, path)
+        return path
+
+# Indici caricati, condivisi tra pipeline e API
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def get_lazy_index(archive_path):
+    """Restituisce l'indice dei media lazy di un archivio, caricandolo una sola volta (legge il disco)"""
+    key = os.path.abspath(archive_path)
+    with _indexes_lock:
+        if key not in _indexes:
+            _indexes[key] = LazyMediaIndex(archive_path)
+        return _indexes[key]
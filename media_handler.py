@@ -3,15 +3,24 @@ import time
 import asyncio
 import mimetypes
 import traceback
-import shutil
 import random
 from datetime import datetime
-from telethon import TelegramClient, utils
+from telethon import utils
+from rate_limiter import ScheduledTelegramClient
 
 # Importa il session manager
 from session_manager import session_manager
+from exported_senders import exported_senders
+from parallel_download import (
+    download_in_parallel, download_resumable, should_download_in_parallel, get_document, get_download_path,
+    get_part_file
+)
+from media_store import media_store, get_media_key
+from media_index import media_index
+from path_resolver import path_resolver
+from text_writer import text_writer
 
-from utils import log_error, retry_operation, sanitize_group_name, format_user_info, sanitize_username
+from utils import log_error, retry_operation, format_user_info, sanitize_username
 from config import (
     API_ID, API_HASH, DOWNLOADS_DIR, TEMP_DIR, ARCHIVE_DIR,
     MAX_DOWNLOAD_RETRIES, DOWNLOAD_RETRY_DELAY, VERBOSE
@@ -19,8 +28,13 @@ from config import (
 
 def get_media_type(message):
     """Determina il tipo di media di un messaggio."""
+    # Sticker e GIF sono documenti (le GIF anche video): vanno riconosciuti per primi
     if message.photo:
         return "images"
+    elif message.sticker:
+        return "stickers"
+    elif message.gif:
+        return "gifs"
     elif message.video:
         return "videos"
     elif message.audio:
@@ -29,19 +43,53 @@ def get_media_type(message):
         return "voice"
     elif message.document:
         return "documents"
-    elif message.sticker:
-        return "stickers"
-    elif message.gif:
-        return "gifs"
     else:
         return "others"
 
-async def safe_download_media(message, file_path, retries=MAX_DOWNLOAD_RETRIES):
-    """Scarica un media con tentativi multipli."""
+async def download_large_media(message, file=None, progress_callback=None):
+    """Scarica un file di grandi dimensioni a blocchi paralleli, con il download a blocchi singoli come riserva."""
+    try:
+        return await download_in_parallel(message, file, progress_callback=progress_callback)
+    except Exception as e:
+        # Il download a blocchi singoli riprende dal .part lasciato da quello parallelo
+        log_error(f"Download parallelo non riuscito (ID: {message.id}), uso il download standard: {e}")
+        return await download_resumable(message, file, progress_callback=progress_callback)
+
+async def download_photo(message, file, progress_callback=None):
+    """Scarica una foto nel file .part e la rinomina solo se il download è completo."""
+    part_file = get_part_file(file)
+    downloaded = await message.download_media(file=part_file, progress_callback=progress_callback)
+    if not downloaded:
+        return None
+    # Le foto non hanno una dimensione esatta nota in anticipo: basta che il file non sia vuoto
+    if os.path.getsize(downloaded) == 0:
+        os.remove(downloaded)
+        raise IOError(f"Foto vuota (ID: {message.id})")
+    os.replace(downloaded, file)
+    return file
+
+async def safe_download_media(message, file_path, retries=MAX_DOWNLOAD_RETRIES, progress_callback=None):
+    """
+    Scarica un media con tentativi multipli (progress_callback: funzione (byte scaricati, byte totali)).
+
+    Il media viene scritto in un file .part e rinominato dopo aver verificato la dimensione; i tentativi
+    successivi (anche dopo un riavvio) riprendono i documenti dal .part invece di ricominciare da zero.
+    """
+    file_path = get_download_path(message, file_path)
+
+    # Oltre la soglia il file viene scaricato a blocchi paralleli
+    if should_download_in_parallel(message):
+        download = lambda file, progress_callback: download_large_media(message, file, progress_callback)
+    elif get_document(message) is not None:
+        download = lambda file, progress_callback: download_resumable(message, file, progress_callback)
+    else:
+        download = lambda file, progress_callback: download_photo(message, file, progress_callback)
+
     try:
         return await retry_operation(
-            message.download_media,
+            download,
             file=file_path,
+            progress_callback=progress_callback,
             retries=retries,
             delay=DOWNLOAD_RETRY_DELAY
         )
@@ -49,7 +97,23 @@ async def safe_download_media(message, file_path, retries=MAX_DOWNLOAD_RETRIES):
         log_error(f"Download fallito definitivamente: {e}")
         return None
 
-async def download_media(message, group_name, app_nickname=None, base_dir=DOWNLOADS_DIR, sender_info=None):
+async def download_shared_media(message, file_path, progress_callback=None):
+    """Scarica un media usando l'archivio condiviso: se è già presente viene solo collegato."""
+    key = get_media_key(message)
+    async with media_store.reserve(key):
+        linked = await media_store.link(key, file_path)
+        if linked:
+            if VERBOSE:
+                print(f"♻️ Media già presente nell'archivio condiviso (ID: {message.id})")
+            return linked
+
+        downloaded = await safe_download_media(message, file_path, progress_callback=progress_callback)
+        if downloaded:
+            downloaded = await media_store.add(key, downloaded)
+        return downloaded
+
+async def download_media(message, group_name, app_nickname=None, base_dir=DOWNLOADS_DIR, sender_info=None,
+                         progress_callback=None):
     """Scarica il media da un messaggio e lo salva nella cartella appropriata."""
     media_type = get_media_type(message)
     if media_type == "others":
@@ -58,48 +122,43 @@ async def download_media(message, group_name, app_nickname=None, base_dir=DOWNLO
         log_error(f"Media non supportato ID: {message.id}")
         return None
 
-    # Prepara informazioni sull'utente
-    if not sender_info:
-        user_folder = "unknown_user"
-        user_id = message.sender_id if hasattr(message, 'sender_id') else "unknown"
-        sender_display = f"User_{user_id}"
-    else:
-        if sender_info.get("username"):
-            user_folder = sanitize_username(sender_info["username"])
-        elif sender_info.get("id"):
-            user_folder = f"user_{sender_info['id']}"
-        else:
-            user_folder = "unknown_user"
-        sender_display = format_user_info(sender_info)
-
-    # Crea percorso per il salvataggio
-    sanitized_group_name = sanitize_group_name(group_name)
-    
-    # Struttura: Downloads/[utente]/[gruppo]/[tipo_media]/
-    group_dir = os.path.join(base_dir, app_nickname, sanitized_group_name, media_type)
-    os.makedirs(group_dir, exist_ok=True)
+    # Struttura: Downloads/[utente]/[gruppo]/[tipo_media]/ (cartelle create una sola volta per gruppo)
+    group_dir = path_resolver.media_dir(group_name, media_type, app_nickname, base_dir, message.chat_id)
 
     # Genera un nome file unico basato sul timestamp e ID del messaggio
     timestamp = int(message.date.timestamp() if hasattr(message, 'date') else time.time())
     file_name = f"{timestamp}_{message.id}"
     file_path = os.path.join(group_dir, file_name)
 
-    # Scarica il media
-    downloaded = await safe_download_media(message, file_path)
+    # Scarica il media (o lo collega dall'archivio condiviso)
+    downloaded = await download_shared_media(message, file_path, progress_callback)
     
     if downloaded:
-        # Registra info sul media in un file JSON di metadati
-        metadata_file = os.path.join(os.path.dirname(os.path.dirname(group_dir)), "media_metadata.txt")
-        with open(metadata_file, "a", encoding="utf-8") as f:
-            date_str = message.date.strftime('%Y-%m-%d %H:%M:%S') if hasattr(message, 'date') else time.strftime('%Y-%m-%d %H:%M:%S')
-            media_size = os.path.getsize(downloaded) if os.path.exists(downloaded) else "unknown"
-            f.write(f"[{date_str}] File: {os.path.basename(downloaded)} | Gruppo: {group_name} | " +
-                    f"Tipo: {media_type} | Da: {sender_display} | Dimensione: {media_size} bytes\n")
+        # Registra il media nell'indice (consultabile tramite l'API)
+        group_folder = os.path.basename(os.path.dirname(group_dir))
+        media_index.add(base_dir, downloaded, app_nickname, group_folder, media_type, message, sender_info)
+    elif not os.path.isdir(group_dir):
+        # La cartella è stata cancellata: verrà ricreata al prossimo media
+        path_resolver.forget(group_name, app_nickname, base_dir, message.chat_id)
     
     return downloaded
 
-async def save_message_content(group_name, message, app_nickname=None, base_dir=DOWNLOADS_DIR, sender_info=None):
-    """Salva il contenuto testuale di un messaggio."""
+def get_messages_file(group_name, app_nickname=None, base_dir=DOWNLOADS_DIR, chat_id=None):
+    """Restituisce il file dei messaggi di testo di un gruppo, creando la cartella se necessario."""
+    # Struttura: Downloads/[utente]/[gruppo]/
+    return os.path.join(path_resolver.group_dir(group_name, app_nickname, base_dir, chat_id), "messages.txt")
+
+def format_message_line(message, sender_display):
+    """Formatta un messaggio di testo come riga di messages.txt."""
+    text = message.text or message.message or "<vuoto>"
+    date_str = message.date.strftime('%Y-%m-%d %H:%M:%S') if hasattr(message, 'date') else "unknown_date"
+    return f"[{date_str}] {sender_display}: {text}\n"
+
+async def save_message_content(group_name, message, app_nickname=None, base_dir=DOWNLOADS_DIR, sender_info=None,
+                               media_path=None):
+    """Salva un messaggio nell'archivio dei messaggi dell'account (con il media scaricato, se presente)."""
+    from message_store import message_store
+    
     # Prepara informazioni sull'utente
     if not sender_info:
         user_id = message.sender_id if hasattr(message, 'sender_id') else "unknown"
@@ -107,19 +166,9 @@ async def save_message_content(group_name, message, app_nickname=None, base_dir=
     else:
         sender_display = format_user_info(sender_info)
 
-    sanitized_group_name = sanitize_group_name(group_name)
-    
-    # Struttura: Downloads/[utente]/[gruppo]/
-    user_group_dir = os.path.join(base_dir, app_nickname, sanitized_group_name)
-    os.makedirs(user_group_dir, exist_ok=True)
-
-    # File per i messaggi di testo per questo gruppo e utente
-    file_path = os.path.join(user_group_dir, "messages.txt")
     try:
-        with open(file_path, 'a', encoding='utf-8') as f:
-            text = message.text or message.message or "<vuoto>"
-            date_str = message.date.strftime('%Y-%m-%d %H:%M:%S') if hasattr(message, 'date') else "unknown_date"
-            f.write(f"[{date_str}] {sender_display}: {text}\n")
+        # La scrittura su disco avviene a blocchi nel thread dell'archivio dei messaggi
+        message_store.add(app_nickname, message, sender_info, group_name, media_path)
         
         if VERBOSE:
             print(f"💬 Salvato messaggio da {sender_display}")
@@ -202,41 +251,103 @@ def log_saved_media(sender_id, recipient_id, file_path, app_nickname=None, sende
     """Registra l'operazione di inoltro media."""
     if app_nickname:
         # Personalizza la cartella di log per questo utente
-        log_dir = os.path.join(TEMP_DIR, app_nickname)
-        os.makedirs(log_dir, exist_ok=True)
-        log_file = os.path.join(log_dir, "media_log.txt")
+        log_file = os.path.join(TEMP_DIR, app_nickname, "media_log.txt")
     else:
-        os.makedirs(TEMP_DIR, exist_ok=True)
         log_file = os.path.join(TEMP_DIR, "media_log.txt")
     
     sender_display = format_user_info(sender_info) if sender_info else f"User_{sender_id}"
     recipient_display = format_user_info(recipient_info) if recipient_info else f"User_{recipient_id}"
     
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"{time.strftime('%Y-%m-%d %H:%M:%S')} | Da: {sender_display} | A: {recipient_display} | File: {file_path}\n")
+    text_writer.append(log_file, f"{time.strftime('%Y-%m-%d %H:%M:%S')} | Da: {sender_display} | A: {recipient_display} | File: {file_path}\n")
 
 async def create_client_for_operation(nickname, operation_id=None):
     """Crea un client Telegram per un'operazione specifica."""
-    if operation_id:
-        # Usa il session manager per creare o ottenere una sessione dedicata
-        _, session_path = session_manager.create_session(nickname, "op")
-    else:
-        # Se non c'è operation_id, usa la sessione standard
-        session_path = f'session_{nickname}'
+    # Usa il session manager per ottenere una sessione in memoria dedicata
+    # (senza operation_id restituisce la sessione standard)
+    _, session = session_manager.create_session(nickname, operation_id)
     
     # Crea il client con la sessione
-    client = TelegramClient(
-        session_path,
+    client = ScheduledTelegramClient(
+        session,
         API_ID, 
         API_HASH,
         connection_retries=10,
         retry_delay=3
     )
     
-    return client, session_path
+    return client, session
+
+def write_archive_report(archive_path, group_name, group_id, stats, user_cache, duration):
+    """Salva l'elenco degli utenti e le statistiche finali di un archivio."""
+    total_messages = stats['total_messages']
+    media_count = stats['media_count']
+    text_count = stats['text_count']
+    
+    # Salva informazioni sugli utenti, mantenendo quelli delle esecuzioni precedenti
+    users_file = os.path.join(archive_path, "users.txt")
+    user_lines = []
+    if os.path.exists(users_file):
+        with open(users_file, "r", encoding="utf-8") as f:
+            user_lines = [line for line in f if line.startswith("- ")]
+    for user_id in sorted(user_cache.keys()):
+        user_line = f"- {format_user_info(user_cache[user_id])}\n"
+        if user_line not in user_lines:
+            user_lines.append(user_line)
+    with open(users_file, "w", encoding="utf-8") as f:
+        f.write(f"Utenti nel gruppo {group_name} ({group_id}):\n")
+        f.write("=" * 50 + "\n")
+        f.writelines(user_lines)
+    
+    # Statistiche finali
+    print(f"\n✅ Download completato in {duration:.1f} secondi")
+    print(f"📊 Statistiche:")
+    print(f"   - Messaggi totali: {total_messages}")
+    print(f"   - Media scaricati: {media_count}")
+    print(f"   - Media già presenti: {stats['media_skipped']}")
+    if stats.get('media_previews'):
+        print(f"   - Media in anteprima (scaricati su richiesta): {stats['media_previews']}")
+    print(f"   - Messaggi di testo: {text_count}")
+    print(f"   - Utenti trovati: {len(user_cache)}")
+    print(f"📁 Archivio salvato in: {os.path.abspath(archive_path)}")
+    print(f"👥 Elenco degli utenti salvato in: {os.path.abspath(users_file)}")
+    
+    # Aggiorna il log
+    log_file = os.path.join(archive_path, "download_log.txt")
+    report = [
+        f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Download completato\n",
+        f"Messaggi totali: {total_messages}\n",
+        f"Media scaricati: {media_count}\n",
+        f"Media già presenti: {stats['media_skipped']}\n"
+    ]
+    if stats.get('media_previews'):
+        report.append(f"Media in anteprima: {stats['media_previews']}\n")
+    report.extend([
+        f"Messaggi di testo: {text_count}\n",
+        f"Utenti trovati: {len(user_cache)}\n",
+        f"Durata: {duration:.1f} secondi\n"
+    ])
+    text_writer.append(log_file, "".join(report))
+
+async def update_message_export(archive_path, group_id, nicknames, filters=None):
+    """Aggiorna l'esportazione NDJSON dei messaggi di un archivio, fuori dal loop di eventi."""
+    from message_export import build_message_export
+    try:
+        index = await asyncio.get_running_loop().run_in_executor(
+            None, build_message_export, archive_path, group_id, nicknames, filters
+        )
+        print(f"🗜️ Esportazione NDJSON aggiornata: {index['messages']} messaggi in {len(index['chunks'])} blocchi")
+    except Exception as e:
+        # L'archivio resta valido anche senza esportazione
+        log_error(f"Errore durante l'esportazione NDJSON di {archive_path}: {e}\n{traceback.format_exc()}")
 
-async def download_group_archive(selected_group, instance_id=None, operation_id=None):
-    """Scarica tutti i media disponibili di un gruppo selezionato."""
+async def download_group_archive(selected_group, instance_id=None, operation_id=None, filters=None, progress=None,
+                                 lazy=False):
+    """
+    Scarica tutti i media disponibili di un gruppo selezionato.
+    
+    filters: ArchiveFilter opzionale; progress: ArchiveProgress opzionale per l'avanzamento in tempo reale;
+    lazy: salva solo miniature e metadati dei media (i file completi vengono scaricati su richiesta).
+    """
     if not selected_group:
         print("❌ Nessun gruppo selezionato.")
         return False
@@ -249,16 +360,17 @@ async def download_group_archive(selected_group, instance_id=None, operation_id=
     print(f"\n📥 Avvio download archivio completo per: {group_name}")
     print(f"👤 Utente: {nickname}")
     print(f"🆔 ID Gruppo: {group_id}")
+    if filters:
+        print(f"🔎 Filtri: {filters.to_dict()}")
     
     # Crea directory per l'archivio, organizzata per utente dell'applicazione
-    sanitized_group_name = sanitize_group_name(group_name)
-    archive_path = os.path.join(ARCHIVE_DIR, nickname, sanitized_group_name)
-    os.makedirs(archive_path, exist_ok=True)
+    # (gli archivi filtrati hanno una directory separata per ogni combinazione di filtri)
+    base_dir = filters.base_dir if filters else ARCHIVE_DIR
+    archive_path = path_resolver.group_dir(group_name, nickname, base_dir, group_id)
     
     # File di log per questo specifico archivio
     log_file = os.path.join(archive_path, "download_log.txt")
-    with open(log_file, "a", encoding="utf-8") as f:
-        f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Avvio download archivio per {group_name} (ID: {group_id})\n")
+    text_writer.append(log_file, f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Avvio download archivio per {group_name} (ID: {group_id})\n")
     
     # Se non è stato fornito un operation_id, ne creiamo uno nuovo
     if not operation_id:
@@ -266,30 +378,20 @@ async def download_group_archive(selected_group, instance_id=None, operation_id=
     
     client = None
     
+    # Connessioni verso altri DC attive per tutta la durata dell'archivio
+    exported_senders.hold(nickname)
+    
     try:
         # Crea un client con una sessione dedicata per questa operazione
-        client, session_path = await create_client_for_operation(nickname, operation_id)
+        client, session = await create_client_for_operation(nickname, operation_id)
         
         # Stampa l'ID del client per debug
         client_id = id(client)
         print(f"Debug: Client ID per download_group_archive: {client_id}")
         
-        # Evita conflitti con altre istanze
-        await asyncio.sleep(random.uniform(0.2, 0.5))
-        
-        # Tenta la connessione con retry
-        max_attempts = 5
-        for attempt in range(max_attempts):
-            try:
-                await client.start()
-                print("✅ Client connesso per download archivio")
-                break
-            except Exception as e:
-                if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                    print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                    await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                else:
-                    raise
+        async with session_manager.use(nickname):
+            await client.start()
+        print("✅ Client connesso per download archivio")
         
         # Ottieni l'entità del gruppo
         try:
@@ -302,100 +404,38 @@ async def download_group_archive(selected_group, instance_id=None, operation_id=
                 print(f"🔌 Client disconnesso (ID: {client_id})")
             return False
         
-        # Statistiche
-        total_messages = 0
-        media_count = 0
-        text_count = 0
-        users_found = set()
-        
         # Timestamp per monitoraggio
         start_time = time.time()
-        last_update = start_time
         
         print("\n⏳ Download in corso... (potrebbe richiedere tempo)")
         
-        # Cache degli utenti per evitare richieste ripetute
-        user_cache = {}
+        # Riprende dall'ultimo messaggio archiviato, se l'archivio esiste già
+        from archive_checkpoint import ArchiveCheckpoint
+        # Il caricamento verifica i file del manifest: fuori dal loop di eventi
+        checkpoint = await asyncio.get_running_loop().run_in_executor(None, ArchiveCheckpoint, archive_path)
+        if checkpoint.max_id:
+            print(f"🔁 Archivio esistente: download dei messaggi successivi all'ID {checkpoint.max_id}")
+            text_writer.append(log_file, f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Ripresa dal messaggio {checkpoint.max_id}\n")
         
-        # Scarica tutti i messaggi
-        async for message in client.iter_messages(target_group):
-            total_messages += 1
-            
-            # Aggiorna lo stato ogni 50 messaggi o ogni 10 secondi
-            current_time = time.time()
-            if total_messages % 50 == 0 or current_time - last_update > 10:
-                print(f"💬 Messaggi processati: {total_messages} (Media: {media_count}, Testo: {text_count}, Utenti: {len(users_found)})")
-                last_update = current_time
-            
-            # Ottieni informazioni sul mittente
-            sender_id = message.sender_id
-            if sender_id:
-                if sender_id not in user_cache:
-                    try:
-                        sender = await client.get_entity(sender_id)
-                        user_cache[sender_id] = {
-                            "id": sender_id,
-                            "username": getattr(sender, 'username', None),
-                            "first_name": getattr(sender, 'first_name', None),
-                            "last_name": getattr(sender, 'last_name', None),
-                            "display_name": utils.get_display_name(sender)
-                        }
-                        users_found.add(sender_id)
-                    except Exception:
-                        user_cache[sender_id] = {"id": sender_id, "display_name": f"User_{sender_id}"}
-                
-                sender_info = user_cache[sender_id]
-                sender_display = format_user_info(sender_info)
-            else:
-                sender_info = None
-                sender_display = "Mittente sconosciuto"
-            
-            # Salva il testo del messaggio
-            if message.text or message.message:
-                await save_message_content(group_name, message, nickname, ARCHIVE_DIR, sender_info=sender_info)
-                text_count += 1
-                if VERBOSE:
-                    print(f"💬 Salvato messaggio di {sender_display}")
-            
-            # Scarica il media se presente
-            if message.media:
-                media_type = get_media_type(message)
-                if media_type != "others":
-                    result = await download_media(message, group_name, nickname, ARCHIVE_DIR, sender_info=sender_info)
-                    if result:
-                        media_count += 1
-                        if VERBOSE:
-                            print(f"📥 Salvato {media_type} di {sender_display}")
-        
-        # Salva informazioni sugli utenti
-        users_file = os.path.join(archive_path, "users.txt")
-        with open(users_file, "w", encoding="utf-8") as f:
-            f.write(f"Utenti nel gruppo {group_name} ({group_id}):\n")
-            f.write("=" * 50 + "\n")
-            for user_id in sorted(user_cache.keys()):
-                user = user_cache[user_id]
-                user_display = format_user_info(user)
-                f.write(f"- {user_display}\n")
+        # Lettura della cronologia, download dei media e scrittura del testo in parallelo
+        from archive_pipeline import ArchivePipeline
+        # Intervallo di ID da leggere, per stimare il tempo rimanente
+        if progress:
+            latest = await client.get_messages(target_group, limit=1)
+            progress.set_range(checkpoint.max_id, latest[0].id if latest else checkpoint.max_id)
         
-        # Statistiche finali
-        duration = time.time() - start_time
-        print(f"\n✅ Download completato in {duration:.1f} secondi")
-        print(f"📊 Statistiche:")
-        print(f"   - Messaggi totali: {total_messages}")
-        print(f"   - Media scaricati: {media_count}")
-        print(f"   - Messaggi di testo: {text_count}")
-        print(f"   - Utenti trovati: {len(users_found)}")
-        print(f"📁 Archivio salvato in: {os.path.abspath(archive_path)}")
-        print(f"👥 Elenco degli utenti salvato in: {os.path.abspath(users_file)}")
+        history = filters.iter_messages(client, target_group, min_id=checkpoint.max_id) if filters else None
+        lazy_media = None
+        if lazy:
+            from lazy_media import get_lazy_index
+            lazy_media = await asyncio.get_running_loop().run_in_executor(None, get_lazy_index, archive_path)
+        pipeline = ArchivePipeline(client, target_group, group_name, nickname, base_dir,
+                                   checkpoint=checkpoint, history=history, progress=progress,
+                                   lazy_media=lazy_media)
+        stats = await pipeline.run()
         
-        # Aggiorna il log
-        with open(log_file, "a", encoding="utf-8") as f:
-            f.write(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Download completato\n")
-            f.write(f"Messaggi totali: {total_messages}\n")
-            f.write(f"Media scaricati: {media_count}\n")
-            f.write(f"Messaggi di testo: {text_count}\n")
-            f.write(f"Utenti trovati: {len(users_found)}\n")
-            f.write(f"Durata: {duration:.1f} secondi\n")
+        write_archive_report(archive_path, group_name, group_id, stats, pipeline.user_cache, time.time() - start_time)
+        await update_message_export(archive_path, group_id, [nickname], filters)
         
         return True
     except Exception as e:
@@ -412,6 +452,8 @@ async def download_group_archive(selected_group, instance_id=None, operation_id=
         except Exception as e:
             log_error(f"Errore durante la disconnessione del client: {e}")
             
+        exported_senders.release_hold(nickname)
+        
         # Rilascia la sessione
         if operation_id:
             session_manager.release_session(operation_id, nickname)
\ No newline at end of file
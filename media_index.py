@@ -0,0 +1,300 @@
+"""
+Indice dei media scaricati
+
+Ogni file salvato da download_media ha una riga nel database
+MEDIA_INDEX_DB con percorso, account, gruppo, tipo di media, mittente, ID
+del messaggio, data, dimensione e file ID di Telegram. L'API elenca e
+filtra i media interrogando l'indice invece di percorrere le cartelle
+con os.listdir, e media_metadata.txt non viene più scritto.
+
+I media scaricati prima dell'indice vengono aggiunti con una sola
+scansione della cartella, la prima volta che viene consultata; i file
+cancellati dal disco vengono rimossi dall'indice quando vengono elencati.
+
+Come per l'archivio dei messaggi, le scritture vengono accodate e
+applicate a blocchi da un unico thread scrittore (sqlite_writer).
+"""
+
+import atexit
+import os
+import re
+import threading
+import time
+from utils import format_user_info
+from media_store import get_media_key
+from sqlite_writer import SQLiteWriter, connect_wal
+from config import (
+    MEDIA_INDEX_DB, MESSAGE_STORE_FLUSH_INTERVAL, MESSAGE_STORE_BATCH_SIZE, MEDIA_LIST_DEFAULT_LIMIT, MEDIA_LIST_MAX_LIMIT
+)
+
+SCHEMA = [
+    """create table if not exists media (
+        base_dir text not null,
+        path text not null,
+        account text,
+        group_name text,
+        group_id integer,
+        media_type text,
+        sender_id integer,
+        sender text,
+        message_id integer,
+        date integer,
+        size integer,
+        file_id text,
+        media_key text,
+        saved integer,
+        unique(base_dir, path)
+    )""",
+    "create index if not exists media_folder on media(base_dir, account, group_name, media_type)",
+    "create index if not exists media_message on media(group_id, message_id)",
+    "create index if not exists media_sender on media(sender_id, date)",
+    "create index if not exists media_date on media(date)",
+    # Cartelle già scansionate per i media scaricati prima dell'indice
+    "create table if not exists media_roots (base_dir text primary key, scanned integer)"
+]
+
+COLUMNS = ("base_dir", "path", "account", "group_name", "group_id", "media_type", "sender_id", "sender",
+           "message_id", "date", "size", "file_id", "media_key", "saved")
+
+# Un file già indicizzato viene aggiornato senza perdere i dati noti solo da Telegram
+UPSERT_SQL = f"""insert into media ({', '.join(COLUMNS)}) values ({', '.join('?' * len(COLUMNS))})
+    on conflict(base_dir, path) do update set
+        account = excluded.account, group_name = excluded.group_name, media_type = excluded.media_type,
+        group_id = coalesce(excluded.group_id, media.group_id),
+        sender_id = coalesce(excluded.sender_id, media.sender_id),
+        sender = coalesce(excluded.sender, media.sender),
+        message_id = coalesce(excluded.message_id, media.message_id),
+        date = coalesce(excluded.date, media.date), size = coalesce(excluded.size, media.size),
+        file_id = coalesce(excluded.file_id, media.file_id),
+        media_key = coalesce(excluded.media_key, media.media_key), saved = excluded.saved"""
+
+ROOT_SQL = "insert or replace into media_roots (base_dir, scanned) values (?, ?)"
+
+DELETE_SQL = "delete from media where base_dir = ? and path = ?"
+
+# I media sono salvati come <timestamp>_<id messaggio>.<estensione>
+MEDIA_NAME_PATTERN = re.compile(r"^(\d+)_(\d+)")
+
+def get_file_id(message):
+    """File ID di Telegram di un media (None se non disponibile)"""
+    try:
+        return message.file.id if message.file else None
+    except Exception:
+        # Telethon non sa rappresentare tutti i media nel vecchio formato dei bot
+        return None
+
+class MediaIndex:
+    """
+    Indice dei media di tutti gli account
+
+    I percorsi sono salvati relativi alla cartella base (DOWNLOADS_DIR,
+    ARCHIVE_DIR...), così restano validi se la cartella viene spostata.
+    """
+
+    def __init__(self, db_file=MEDIA_INDEX_DB):
+        """Inizializza l'indice dei media"""
+        self.db_file = db_file
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = False
+        self._scanned = set()
+        self._writer = SQLiteWriter(
+            "media-index-writer", lambda key: self._connect(), MESSAGE_STORE_FLUSH_INTERVAL,
+            MESSAGE_STORE_BATCH_SIZE, "nell'indice dei media", on_commit=self._on_commit
+        )
+        self.stats = {'indexed': 0, 'batches': 0, 'removed': 0}
+
+    def _connect(self):
+        """Apre una connessione al database in modalità WAL, creando le tabelle"""
+        conn = connect_wal(self.db_file)
+
+        with self._lock:
+            if not self._initialized:
+                with conn:
+                    for statement in SCHEMA:
+                        conn.execute(statement)
+                self._initialized = True
+        return conn
+
+    def _reader(self):
+        """Restituisce la connessione di lettura del thread corrente"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def _enqueue(self, sql, rows):
+        """Accoda una scrittura per il thread scrittore"""
+        self._writer.enqueue(sql, rows)
+
+    def _on_commit(self, key, statements):
+        """Aggiorna le statistiche dopo una transazione del thread scrittore"""
+        self.stats['indexed'] += sum(len(rows) for sql, rows in statements if sql == UPSERT_SQL)
+        self.stats['batches'] += 1
+
+    def flush(self, timeout=10):
+        """
+        Attende che tutte le scritture accodate siano salvate
+
+        Returns:
+            True se le scritture sono state salvate entro il timeout
+        """
+        return self._writer.flush(timeout)
+
+    def add(self, base_dir, file_path, account, group_name, media_type, message, sender_info=None):
+        """
+        Accoda la registrazione di un media scaricato
+
+        Args:
+            base_dir: Cartella base del download (DOWNLOADS_DIR, ARCHIVE_DIR...)
+            file_path: Percorso del file salvato
+            account: Account che ha scaricato il media
+            group_name: Nome della cartella del gruppo
+            media_type: Tipo di media (images, videos, ...)
+            message: Messaggio Telegram del media
+            sender_info: Informazioni sul mittente, se note
+        """
+        file = message.file
+        self._enqueue(UPSERT_SQL, [(
+            os.path.normpath(base_dir),
+            os.path.relpath(file_path, base_dir),
+            account,
+            group_name,
+            message.chat_id,
+            media_type,
+            message.sender_id,
+            format_user_info(sender_info) if sender_info else None,
+            message.id,
+            int(message.date.timestamp()) if message.date else None,
+            file.size if file else None,
+            get_file_id(message),
+            get_media_key(message),
+            int(time.time())
+        )])
+
+    def _scan(self, base_dir):
+        """
+        Aggiunge all'indice i media già presenti in una cartella base
+
+        Vengono considerati solo i file in <account>/<gruppo>/<tipo>/, la
+        struttura creata da download_media.
+        """
+        rows = []
+        now = int(time.time())
+        for directory, subdirs, names in os.walk(base_dir):
+            parts = os.path.relpath(directory, base_dir).split(os.sep)
+            if len(parts) < 3 or parts[0] == ".":
+                continue
+            subdirs[:] = []
+            if len(parts) != 3:
+                continue
+
+            account, group_name, media_type = parts
+            for name in names:
+                if name.endswith(".part"):
+                    # Download non ancora completato
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                match = MEDIA_NAME_PATTERN.match(name)
+                rows.append((
+                    os.path.normpath(base_dir), os.path.relpath(path, base_dir), account, group_name, None,
+                    media_type, None, None,
+                    int(match.group(2)) if match else None,
+                    int(match.group(1)) if match else int(stat.st_mtime),
+                    stat.st_size, None, None, now
+                ))
+
+        self._enqueue(UPSERT_SQL, rows)
+        self._enqueue(ROOT_SQL, [(os.path.normpath(base_dir), now)])
+        self.flush(timeout=60)
+        return len(rows)
+
+    def ensure_scanned(self, base_dir):
+        """Esegue una sola volta la scansione dei media scaricati prima dell'indice"""
+        base_dir = os.path.normpath(base_dir)
+        if base_dir in self._scanned:
+            return
+
+        row = self._reader().execute("select 1 from media_roots where base_dir = ?", (base_dir,)).fetchone()
+        if row is None and os.path.isdir(base_dir):
+            count = self._scan(base_dir)
+            print(f"🗂️ Indice dei media: {count} file esistenti aggiunti da {base_dir}")
+        self._scanned.add(base_dir)
+
+    def list(self, base_dir, account=None, group_name=None, media_type=None, sender_id=None, message_id=None,
+             date_from=None, date_to=None, limit=None, offset=0):
+        """
+        Elenca i media di una cartella base
+
+        Args:
+            base_dir: Cartella base (DOWNLOADS_DIR, ARCHIVE_DIR...)
+            account, group_name, media_type: Filtri per cartella
+            sender_id, message_id: Filtri per mittente e messaggio
+            date_from, date_to: Intervallo di date (timestamp Unix, date_to escluso)
+            limit, offset: Paginazione (dal media più recente); limit vale
+                MEDIA_LIST_DEFAULT_LIMIT se non indicato e al massimo MEDIA_LIST_MAX_LIMIT
+
+        Returns:
+            Lista di dictionary con i campi dell'indice, senza i file non più
+            presenti sul disco (le loro righe vengono rimosse dall'indice)
+        """
+        self.ensure_scanned(base_dir)
+
+        conditions = ["base_dir = ?"]
+        params = [os.path.normpath(base_dir)]
+        for column, value in (("account", account), ("group_name", group_name), ("media_type", media_type),
+                              ("sender_id", sender_id), ("message_id", message_id)):
+            if value is not None:
+                conditions.append(f"{column} = ?")
+                params.append(value)
+        if date_from is not None:
+            conditions.append("date >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("date < ?")
+            params.append(date_to)
+
+        sql = (f"select {', '.join(COLUMNS)} from media where {' and '.join(conditions)} "
+               f"order by date desc, path limit ? offset ?")
+        params.extend([min(limit or MEDIA_LIST_DEFAULT_LIMIT, MEDIA_LIST_MAX_LIMIT), offset])
+
+        while True:
+            entries = []
+            missing = []
+            for row in self._reader().execute(sql, params):
+                entry = dict(zip(COLUMNS, row))
+                if os.path.exists(os.path.join(entry["base_dir"], entry["path"])):
+                    entries.append(entry)
+                else:
+                    # File cancellato o spostato fuori dal programma
+                    missing.append((entry["base_dir"], entry["path"]))
+
+            if not missing:
+                return entries
+
+            # Le righe vengono rimosse prima di rileggere la pagina: così la pagina
+            # resta piena e le pagine successive non saltano né ripetono media
+            self._enqueue(DELETE_SQL, missing)
+            self.flush(timeout=60)
+            self.stats['removed'] += len(missing)
+
+    def get_status(self):
+        """Restituisce lo stato dell'indice dei media"""
+        return {
+            "pending": self._writer.pending(),
+            **self.stats
+        }
+
+    def close(self, timeout=10):
+        """Salva le scritture in sospeso prima della chiusura del programma"""
+        self.flush(timeout)
+
+# Singleton globale del MediaIndex
+media_index = MediaIndex()
+
+# Le scritture accodate non devono andare perse all'uscita
+atexit.register(media_index.close)
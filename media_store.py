@@ -0,0 +1,260 @@
+"""
+Archivio dei media indirizzato per contenuto
+
+Lo stesso file inoltrato in più gruppi, o visto da più account, veniva
+scaricato e salvato di nuovo per ogni gruppo. Ogni media scaricato viene
+ora conservato una sola volta in MEDIA_STORE_DIR, identificato dall'ID
+Telegram della foto o del documento e dall'hash SHA-256 del contenuto.
+I file nelle cartelle dei gruppi sono collegamenti fisici (hardlink) ai
+file dell'archivio: un media già presente non viene scaricato di nuovo.
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import threading
+from contextlib import asynccontextmanager
+from utils import log_error
+from config import MEDIA_STORE_DIR
+
+INDEX_FILE = "index.jsonl"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+def get_media_key(message):
+    """
+    Restituisce la chiave di un media basata sul suo ID Telegram
+
+    Returns:
+        "photo_<id>" o "document_<id>", None se il media non ha un ID
+    """
+    if getattr(message, 'photo', None) is not None and getattr(message.photo, 'id', None):
+        return f"photo_{message.photo.id}"
+    if getattr(message, 'document', None) is not None and getattr(message.document, 'id', None):
+        return f"document_{message.document.id}"
+    return None
+
+def hash_file(path):
+    """Calcola l'hash SHA-256 di un file"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class MediaStore:
+    """
+    Gestisce l'archivio condiviso dei media
+
+    - blobs: hash SHA-256 -> {"file", "size"} (file relativo alla directory dell'archivio)
+    - keys: chiave Telegram (photo_<id>/document_<id>) -> hash SHA-256
+    """
+
+    def __init__(self, base_dir=MEDIA_STORE_DIR):
+        """Carica l'indice dell'archivio dei media"""
+        self.base_dir = base_dir
+        self.index_file = os.path.join(base_dir, INDEX_FILE)
+        self.blobs = {}
+        self.keys = {}
+        self.stats = {'hits': 0, 'bytes_saved': 0, 'duplicates': 0}
+        self.lock = threading.RLock()
+        self._reservations = {}
+        self._load()
+
+    def _load(self):
+        """Legge l'indice, se esiste, e lo compatta se contiene righe superate"""
+        if not os.path.exists(self.index_file):
+            return
+
+        lines = 0
+        with open(self.index_file, "r", encoding="utf-8") as f:
+            for line in f:
+                lines += 1
+                try:
+                    entry = json.loads(line)
+                    self.blobs[entry["sha256"]] = {"file": entry["file"], "size": entry["size"]}
+                    if entry.get("key"):
+                        self.keys[entry["key"]] = entry["sha256"]
+                except (ValueError, KeyError):
+                    # Riga troncata da un'interruzione
+                    continue
+
+        entries = self._entries()
+        if lines > len(entries):
+            self._rewrite_index(entries)
+
+    def _entries(self):
+        """Voci dell'indice senza duplicati: una per chiave, più i file senza chiave"""
+        entries = [{"key": key, "sha256": digest, **self.blobs[digest]}
+                   for key, digest in self.keys.items() if digest in self.blobs]
+        with_key = {entry["sha256"] for entry in entries}
+        entries.extend({"key": None, "sha256": digest, **blob}
+                       for digest, blob in self.blobs.items() if digest not in with_key)
+        return entries
+
+    def _rewrite_index(self, entries):
+        """Riscrive l'indice su disco in modo atomico"""
+        temp_file = f"{self.index_file}.tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                for entry in entries:
+                    f.write(json.dumps(entry) + "\n")
+            os.replace(temp_file, self.index_file)
+        except Exception as e:
+            log_error(f"Impossibile compattare l'indice dell'archivio dei media {self.index_file}: {e}")
+
+    def _append_index(self, entry):
+        """Aggiunge una voce all'indice su disco"""
+        with open(self.index_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
+
+    def _blob_path(self, blob):
+        """Percorso assoluto di un file dell'archivio, se esiste ed è integro"""
+        path = os.path.join(self.base_dir, blob["file"])
+        if os.path.exists(path) and os.path.getsize(path) == blob["size"]:
+            return path
+        return None
+
+    def has(self, key):
+        """Verifica in memoria se una chiave Telegram è nell'archivio (senza controllare il file)"""
+        with self.lock:
+            return key is not None and self.keys.get(key) in self.blobs
+
+    def lookup(self, key):
+        """Restituisce il file dell'archivio associato a una chiave Telegram, se presente (legge il disco)"""
+        if key is None:
+            return None
+        with self.lock:
+            digest = self.keys.get(key)
+            blob = self.blobs.get(digest)
+        return self._blob_path(blob) if blob else None
+
+    @staticmethod
+    def _link(source, destination):
+        """Collega un file a una nuova posizione, copiandolo se il collegamento non è possibile"""
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            # File system diversi o senza supporto per gli hardlink
+            shutil.copy2(source, destination)
+
+    def _link_from_store(self, key, file_path):
+        """Collega un media dell'archivio al percorso di un gruppo (eseguito fuori dal loop di eventi)"""
+        source = self.lookup(key)
+        if source is None:
+            return None
+
+        destination = file_path + os.path.splitext(source)[1]
+        self._link(source, destination)
+        with self.lock:
+            self.stats['hits'] += 1
+            self.stats['bytes_saved'] += os.path.getsize(source)
+        return destination
+
+    async def link(self, key, file_path):
+        """
+        Collega un media già presente nell'archivio al percorso di un gruppo
+
+        Args:
+            key: Chiave Telegram del media
+            file_path: Percorso di destinazione senza estensione
+
+        Returns:
+            Percorso del file collegato, None se il media non è nell'archivio
+        """
+        if not self.has(key):
+            return None
+
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._link_from_store, key, file_path)
+        except Exception as e:
+            log_error(f"Errore durante il collegamento dall'archivio dei media di {file_path}: {e}")
+            return None
+
+    def _store(self, key, path):
+        """Aggiunge un file scaricato all'archivio (eseguito fuori dal loop di eventi)"""
+        digest = hash_file(path)
+        size = os.path.getsize(path)
+
+        with self.lock:
+            blob = self.blobs.get(digest)
+            existing = self._blob_path(blob) if blob else None
+            if existing is None:
+                relative = os.path.join(digest[:2], digest + os.path.splitext(path)[1])
+                blob_path = os.path.join(self.base_dir, relative)
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                self._link(path, blob_path)
+                self.blobs[digest] = {"file": relative, "size": size}
+            else:
+                # Stesso contenuto con un altro ID: il file del gruppo diventa un collegamento
+                self._link(existing, path)
+                self.stats['duplicates'] += 1
+                self.stats['bytes_saved'] += size
+
+            if key:
+                self.keys[key] = digest
+            self._append_index({"key": key, "sha256": digest, **self.blobs[digest]})
+
+        return path
+
+    async def add(self, key, path):
+        """
+        Registra nell'archivio un media appena scaricato
+
+        Args:
+            key: Chiave Telegram del media (None se non disponibile)
+            path: Percorso del file scaricato nella cartella del gruppo
+
+        Returns:
+            Percorso del file nella cartella del gruppo
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(None, self._store, key, path)
+        except Exception as e:
+            log_error(f"Errore durante l'aggiunta all'archivio dei media di {path}: {e}")
+            return path
+
+    @asynccontextmanager
+    async def reserve(self, key):
+        """
+        Impedisce di scaricare contemporaneamente lo stesso media
+
+        Chi arriva per secondo attende il primo e trova il media nell'archivio.
+        """
+        if key is None:
+            yield
+            return
+
+        reservation_key = (asyncio.get_running_loop(), key)
+        with self.lock:
+            reservation = self._reservations.get(reservation_key)
+            if reservation is None:
+                reservation = self._reservations[reservation_key] = [asyncio.Lock(), 0]
+            reservation[1] += 1
+
+        try:
+            async with reservation[0]:
+                yield
+        finally:
+            with self.lock:
+                reservation[1] -= 1
+                if reservation[1] == 0:
+                    del self._reservations[reservation_key]
+
+    def get_status(self):
+        """Restituisce lo stato dell'archivio dei media"""
+        with self.lock:
+            return {
+                "blobs": len(self.blobs),
+                "keys": len(self.keys),
+                "size": sum(blob["size"] for blob in self.blobs.values()),
+                **self.stats
+            }
+
+# Singleton globale dell'archivio dei media
+media_store = MediaStore()
@@ -0,0 +1,234 @@
+"""
+Esportazione NDJSON compressa dei messaggi di un archivio
+
+Accanto a messages.txt, pensato per la lettura, ogni archivio produce
+messages.ndjson.gz: un messaggio per riga in JSON con tutti i campi
+dell'archivio dei messaggi (mittente, testo su più righe, risposta,
+inoltro, tipo e file del media).
+
+Il file è formato da blocchi gzip indipendenti di MESSAGE_EXPORT_CHUNK_SIZE
+messaggi, concatenati: resta un normale file .gz (zcat lo legge per
+intero), ma l'indice messages.ndjson.index.json riporta per ogni blocco
+posizione, lunghezza, intervallo di ID e di date. Chi analizza i dati può
+leggere solo i blocchi di un intervallo di date (seek + lettura di
+"length" byte + gzip.decompress) o distribuire i blocchi tra più processi.
+
+Ogni esecuzione dell'archivio aggiunge solo i messaggi nuovi fino al suo
+checkpoint (i messaggi dei monitoraggi più recenti restano fuori finché
+l'archivio non li raggiunge): l'ultimo blocco incompleto viene riscritto e
+i blocchi precedenti restano invariati.
+"""
+
+import gzip
+import heapq
+import json
+import os
+from datetime import datetime, timezone
+from utils import log_error
+from message_store import message_store
+from user_cache import user_cache
+from archive_checkpoint import ArchiveCheckpoint
+from config import MESSAGE_EXPORT_CHUNK_SIZE, MESSAGE_EXPORT_COMPRESSION
+
+EXPORT_FILE = "messages.ndjson.gz"
+EXPORT_INDEX_FILE = "messages.ndjson.index.json"
+EXPORT_VERSION = 1
+
+def export_record(row):
+    """Riga dell'archivio dei messaggi come record NDJSON"""
+    record = dict(row)
+    record["date"] = (
+        datetime.fromtimestamp(row["date"], timezone.utc).isoformat() if row["date"] is not None else None
+    )
+    record["timestamp"] = row["date"]
+    return record
+
+def filter_rows(rows, filters, sizes=None):
+    """
+    Applica a righe dell'archivio dei messaggi i filtri di un archivio filtrato
+
+    Come ArchiveFilter.matches: tipo di media, date, mittenti e dimensione.
+    Gli username vengono convertiti in ID con la cache degli utenti; la
+    dimensione è quella salvata nella riga o, per i messaggi archiviati
+    prima della colonna media_size, quella del manifest dell'archivio.
+
+    Args:
+        rows: Righe dell'archivio dei messaggi
+        filters: ArchiveFilter dell'archivio
+        sizes: Dictionary ID messaggio -> dimensione del media scaricato
+    """
+    media_types = set(filters.media_types)
+    sender_ids = {sender for sender in filters.senders if isinstance(sender, int)}
+    usernames = [sender for sender in filters.senders if not isinstance(sender, int)]
+    if usernames:
+        found = user_cache.find_usernames(usernames)
+        sender_ids.update(found.values())
+        unknown = [username for username in usernames if username.lstrip("@").lower() not in found]
+        if unknown:
+            # Nessun messaggio può essere attribuito con certezza a questi mittenti
+            log_error(f"Username non presenti nella cache degli utenti, esclusi dall'esportazione: {', '.join(unknown)}")
+    start = filters.start_date.timestamp() if filters.start_date else None
+    end = filters.end_date.timestamp() if filters.end_date else None
+    check_size = filters.min_size is not None or filters.max_size is not None
+    sizes = sizes or {}
+
+    for row in rows:
+        if media_types and row["media_type"] not in media_types:
+            continue
+        if filters.senders and row["sender_id"] not in sender_ids:
+            continue
+        if start is not None and (row["date"] is None or row["date"] < start):
+            continue
+        if end is not None and (row["date"] is None or row["date"] >= end):
+            continue
+        if check_size:
+            size = row["media_size"] if row["media_size"] is not None else sizes.get(row["id"])
+            if size is None:
+                continue
+            if filters.min_size is not None and size < filters.min_size:
+                continue
+            if filters.max_size is not None and size > filters.max_size:
+                continue
+        yield row
+
+def merge_accounts(nicknames, chat_id, min_id=0, max_id=None):
+    """Messaggi di una chat salvati da più account, in ordine di ID e senza duplicati"""
+    iterators = [message_store.iter_chat(nickname, chat_id, min_id, max_id) for nickname in dict.fromkeys(nicknames)]
+    last_id = None
+    for row in heapq.merge(*iterators, key=lambda row: row["id"]):
+        if row["id"] != last_id:
+            last_id = row["id"]
+            yield row
+
+def load_export_index(archive_path):
+    """Legge l'indice dell'esportazione di un archivio (None se non esiste)"""
+    index_file = os.path.join(archive_path, EXPORT_INDEX_FILE)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, "r", encoding="utf-8") as f:
+            index = json.load(f)
+        return index if index.get("version") == EXPORT_VERSION else None
+    except Exception as e:
+        log_error(f"Indice dell'esportazione NDJSON non leggibile {index_file}: {e}")
+        return None
+
+def _write_chunk(f, rows):
+    """Comprime e scrive un blocco, restituendone la voce dell'indice"""
+    data = "".join(json.dumps(export_record(row), ensure_ascii=False) + "\n" for row in rows).encode("utf-8")
+    compressed = gzip.compress(data, compresslevel=MESSAGE_EXPORT_COMPRESSION, mtime=0)
+    offset = f.tell()
+    f.write(compressed)
+    dates = [row["date"] for row in rows if row["date"] is not None]
+    return {
+        "offset": offset,
+        "length": len(compressed),
+        "count": len(rows),
+        "first_id": rows[0]["id"],
+        "last_id": rows[-1]["id"],
+        "date_from": min(dates) if dates else None,
+        "date_to": max(dates) if dates else None
+    }
+
+def build_message_export(archive_path, chat_id, nicknames, filters=None, rebuild=False):
+    """
+    Aggiorna l'esportazione NDJSON dei messaggi di un archivio
+
+    Args:
+        archive_path: Cartella dell'archivio
+        chat_id: ID del gruppo
+        nicknames: Account che hanno archiviato il gruppo (i loro messaggi vengono uniti)
+        filters: ArchiveFilter dell'archivio, se filtrato
+        rebuild: Riscrive l'esportazione da zero (ad esempio dopo messaggi modificati)
+
+    Returns:
+        Dictionary dell'indice
+    """
+    # Attendi che i messaggi appena archiviati siano nel database
+    message_store.flush(timeout=60)
+
+    # Il database contiene anche i messaggi dei monitoraggi: vengono esportati
+    # solo quelli fino al checkpoint, già archiviati senza buchi, così i
+    # blocchi successivi non possono saltare ID più bassi archiviati dopo
+    checkpoint = ArchiveCheckpoint(archive_path)
+    max_id = checkpoint.max_id
+
+    export_file = os.path.join(archive_path, EXPORT_FILE)
+    index = None if rebuild else load_export_index(archive_path)
+    if index is None or index.get("chat_id") != chat_id or not os.path.exists(export_file):
+        index = {"version": EXPORT_VERSION, "chat_id": chat_id, "chunks": []}
+
+    # L'ultimo blocco incompleto viene riscritto insieme ai messaggi nuovi
+    chunks = index["chunks"]
+    if chunks and chunks[-1]["count"] < MESSAGE_EXPORT_CHUNK_SIZE:
+        chunks.pop()
+    if chunks and chunks[-1]["last_id"] > max_id:
+        # Esportazione con messaggi oltre il checkpoint: va riscritta da zero
+        chunks.clear()
+    end = chunks[-1]["offset"] + chunks[-1]["length"] if chunks else 0
+    min_id = chunks[-1]["last_id"] if chunks else 0
+
+    rows = merge_accounts(nicknames, chat_id, min_id, max_id)
+    if filters:
+        sizes = {message_id: entry["size"] for message_id, entry in checkpoint.manifest.items()}
+        rows = filter_rows(rows, filters, sizes)
+
+    with open(export_file, "r+b" if chunks else "wb") as f:
+        # Scarta i dati oltre l'ultimo blocco indicizzato (blocco incompleto o scrittura interrotta)
+        f.seek(end)
+        f.truncate()
+
+        pending = []
+        for row in rows:
+            pending.append(row)
+            if len(pending) >= MESSAGE_EXPORT_CHUNK_SIZE:
+                chunks.append(_write_chunk(f, pending))
+                pending = []
+        if pending:
+            chunks.append(_write_chunk(f, pending))
+        f.flush()
+        os.fsync(f.fileno())
+
+    index.update({
+        "accounts": list(dict.fromkeys(nicknames)),
+        "filters": filters.to_dict() if filters else None,
+        "chunk_size": MESSAGE_EXPORT_CHUNK_SIZE,
+        "max_id": max_id,
+        "messages": sum(chunk["count"] for chunk in chunks),
+        "size": chunks[-1]["offset"] + chunks[-1]["length"] if chunks else 0
+    })
+
+    index_file = os.path.join(archive_path, EXPORT_INDEX_FILE)
+    temp_file = f"{index_file}.tmp"
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(index, f, indent=2)
+    os.replace(temp_file, index_file)
+    return index
+
+def refresh_message_export(archive_path, rebuild=False):
+    """
+    Aggiorna l'esportazione di un archivio con i parametri salvati nel suo indice
+
+    Returns:
+        Dictionary dell'indice, None se l'archivio non ha ancora un'esportazione
+    """
+    index = load_export_index(archive_path)
+    if index is None:
+        return None
+
+    from archive_filters import ArchiveFilter
+    filters = ArchiveFilter.from_dict(index["filters"]) if index.get("filters") else None
+    return build_message_export(archive_path, index["chat_id"], index["accounts"], filters, rebuild)
+
+def select_chunks(index, date_from=None, date_to=None):
+    """
+    Blocchi dell'indice che possono contenere messaggi di un intervallo di date
+
+    Args:
+        date_from, date_to: Timestamp Unix (date_to escluso)
+    """
+    return [
+        chunk for chunk in index["chunks"]
+        if (date_from is None or chunk["date_to"] is None or chunk["date_to"] >= date_from)
+        and (date_to is None or chunk["date_from"] is None or chunk["date_from"] < date_to)
+    ]
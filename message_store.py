@@ -0,0 +1,290 @@
+"""
+Archivio dei messaggi con ricerca full-text
+
+I messaggi dei monitoraggi e degli archivi vengono salvati in un database
+SQLite per account (MESSAGES_DB_DIR/<utente>.db) invece di essere solo
+aggiunti riga per riga a messages.txt. Per ogni messaggio vengono
+conservati chat, mittente, data, testo, risposta, inoltro e il media
+collegato; il testo è indicizzato con FTS5, così le ricerche su milioni
+di messaggi richiedono pochi millisecondi.
+
+Come per l'archivio delle sessioni, le scritture vengono accodate e
+applicate a blocchi da un unico thread scrittore (sqlite_writer): il loop
+di eventi non attende mai il disco.
+"""
+
+import atexit
+import os
+import threading
+from telethon import utils
+from utils import format_user_info
+from sqlite_writer import SQLiteWriter, connect_wal
+from media_handler import get_media_type
+from config import MESSAGES_DB_DIR, MESSAGE_STORE_FLUSH_INTERVAL, MESSAGE_STORE_BATCH_SIZE
+
+SCHEMA = [
+    """create table if not exists messages (
+        chat_id integer not null,
+        id integer not null,
+        chat_name text,
+        sender_id integer,
+        sender_name text,
+        date integer,
+        text text,
+        reply_to integer,
+        fwd_from integer,
+        fwd_name text,
+        media_type text,
+        media_path text,
+        media_size integer,
+        unique(chat_id, id)
+    )""",
+    "create index if not exists messages_chat_date on messages(chat_id, date)",
+    "create index if not exists messages_sender_date on messages(sender_id, date)",
+    "create index if not exists messages_date on messages(date)",
+    # Indice full-text del testo, mantenuto allineato dai trigger
+    "create virtual table if not exists messages_fts using fts5(text, content='messages', content_rowid='rowid')",
+    """create trigger if not exists messages_ai after insert on messages begin
+        insert into messages_fts(rowid, text) values (new.rowid, new.text);
+    end""",
+    """create trigger if not exists messages_ad after delete on messages begin
+        insert into messages_fts(messages_fts, rowid, text) values ('delete', old.rowid, old.text);
+    end""",
+    """create trigger if not exists messages_au after update of text on messages begin
+        insert into messages_fts(messages_fts, rowid, text) values ('delete', old.rowid, old.text);
+        insert into messages_fts(rowid, text) values (new.rowid, new.text);
+    end"""
+]
+
+COLUMNS = ("chat_id", "id", "chat_name", "sender_id", "sender_name", "date", "text",
+           "reply_to", "fwd_from", "fwd_name", "media_type", "media_path", "media_size")
+
+# Un messaggio già presente viene aggiornato senza perdere il media già collegato
+UPSERT_SQL = f"""insert into messages ({', '.join(COLUMNS)}) values ({', '.join('?' * len(COLUMNS))})
+    on conflict(chat_id, id) do update set
+        chat_name = excluded.chat_name, sender_id = excluded.sender_id, sender_name = excluded.sender_name,
+        date = excluded.date, text = excluded.text, reply_to = excluded.reply_to, fwd_from = excluded.fwd_from,
+        fwd_name = excluded.fwd_name, media_type = excluded.media_type,
+        media_path = coalesce(excluded.media_path, messages.media_path),
+        media_size = coalesce(excluded.media_size, messages.media_size)"""
+
+MEDIA_SQL = "update messages set media_path = ? where chat_id = ? and id = ?"
+
+def search_order_key(result):
+    """Chiave dell'ordine dei risultati di search() (da usare con reverse=True), come nella query SQL"""
+    return (result["date"] is not None, result["date"] or 0, result["id"], result["chat_id"])
+
+def message_row(message, sender_info=None, chat_name=None, media_path=None):
+    """Converte un messaggio Telegram in una riga del database"""
+    fwd_from = fwd_name = None
+    if message.fwd_from:
+        fwd_name = message.fwd_from.from_name
+        if message.fwd_from.from_id:
+            fwd_from = utils.get_peer_id(message.fwd_from.from_id)
+
+    return (
+        message.chat_id,
+        message.id,
+        chat_name,
+        message.sender_id,
+        format_user_info(sender_info) if sender_info else None,
+        int(message.date.timestamp()) if message.date else None,
+        message.message or "",
+        message.reply_to_msg_id,
+        fwd_from,
+        fwd_name,
+        get_media_type(message) if message.media else None,
+        media_path,
+        message.file.size if message.file else None
+    )
+
+class MessageStore:
+    """
+    Database dei messaggi di tutti gli account
+
+    Le scritture vengono accodate e applicate in blocco dal thread scrittore;
+    flush() permette di attendere che quelle già accodate siano su disco.
+    """
+
+    def __init__(self, db_dir=MESSAGES_DB_DIR):
+        """Inizializza l'archivio dei messaggi"""
+        self.db_dir = db_dir
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._initialized = set()
+        self._writer = SQLiteWriter(
+            "message-store-writer", self._connect, MESSAGE_STORE_FLUSH_INTERVAL, MESSAGE_STORE_BATCH_SIZE,
+            "nell'archivio dei messaggi", on_commit=self._on_commit
+        )
+        self.stats = {'written': 0, 'batches': 0}
+
+    def _db_file(self, nickname):
+        return os.path.join(self.db_dir, f"{nickname}.db")
+
+    def _connect(self, nickname):
+        """Apre una connessione al database di un account in modalità WAL, creando le tabelle"""
+        os.makedirs(self.db_dir, exist_ok=True)
+        conn = connect_wal(self._db_file(nickname))
+
+        with self._lock:
+            if nickname not in self._initialized:
+                with conn:
+                    for statement in SCHEMA:
+                        conn.execute(statement)
+                    # Database creati prima della colonna della dimensione dei media
+                    columns = {row[1] for row in conn.execute("pragma table_info(messages)")}
+                    if "media_size" not in columns:
+                        conn.execute("alter table messages add column media_size integer")
+                self._initialized.add(nickname)
+        return conn
+
+    def _reader(self, nickname):
+        """Restituisce la connessione di lettura del thread corrente per un account"""
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        conn = connections.get(nickname)
+        if conn is None:
+            conn = connections[nickname] = self._connect(nickname)
+        return conn
+
+    def _enqueue(self, nickname, sql, rows):
+        """Accoda una scrittura per il thread scrittore"""
+        self._writer.enqueue(sql, rows, key=nickname)
+
+    def _on_commit(self, nickname, statements):
+        """Aggiorna le statistiche dopo una transazione del thread scrittore"""
+        self.stats['written'] += sum(len(rows) for sql, rows in statements if sql == UPSERT_SQL)
+        self.stats['batches'] += 1
+
+    def flush(self, timeout=10):
+        """
+        Attende che tutte le scritture accodate siano salvate
+
+        Returns:
+            True se le scritture sono state salvate entro il timeout
+        """
+        return self._writer.flush(timeout)
+
+    def add(self, nickname, message, sender_info=None, chat_name=None, media_path=None):
+        """Accoda il salvataggio di un messaggio"""
+        self._enqueue(nickname, UPSERT_SQL, [message_row(message, sender_info, chat_name, media_path)])
+
+    def add_many(self, nickname, rows):
+        """Accoda il salvataggio di più righe create con message_row()"""
+        if rows:
+            self._enqueue(nickname, UPSERT_SQL, list(rows))
+
+    def set_media(self, nickname, chat_id, message_id, media_path):
+        """Collega il file di un media scaricato al suo messaggio"""
+        self._enqueue(nickname, MEDIA_SQL, [(media_path, chat_id, message_id)])
+
+    def accounts(self):
+        """Account che hanno un database dei messaggi"""
+        if not os.path.isdir(self.db_dir):
+            return []
+        return sorted(name[:-3] for name in os.listdir(self.db_dir) if name.endswith(".db"))
+
+    def search(self, nickname, query=None, chat_id=None, sender_id=None, date_from=None, date_to=None,
+               media_type=None, limit=50, offset=0):
+        """
+        Cerca i messaggi di un account
+
+        Args:
+            nickname: Account di cui cercare i messaggi
+            query: Ricerca full-text (sintassi FTS5: parole, "frasi", prefissi*, AND/OR/NOT)
+            chat_id, sender_id: Filtri per chat e mittente
+            date_from, date_to: Intervallo di date (timestamp Unix, date_to escluso)
+            media_type: Tipo di media dei messaggi
+            limit, offset: Paginazione (dal messaggio più recente)
+
+        Returns:
+            Lista di dictionary, con un estratto evidenziato se query è indicata
+
+        Raises:
+            sqlite3.OperationalError: Se la query full-text non è valida
+        """
+        if not os.path.exists(self._db_file(nickname)):
+            return []
+
+        columns = ", ".join(f"m.{column}" for column in COLUMNS)
+        conditions = []
+        params = []
+        if query:
+            sql = (f"select {columns}, snippet(messages_fts, 0, '[', ']', '…', 16) "
+                   f"from messages_fts join messages m on m.rowid = messages_fts.rowid")
+            conditions.append("messages_fts match ?")
+            params.append(query)
+        else:
+            sql = f"select {columns}, null from messages m"
+
+        for column, value in (("chat_id", chat_id), ("sender_id", sender_id), ("media_type", media_type)):
+            if value is not None:
+                conditions.append(f"m.{column} = ?")
+                params.append(value)
+        if date_from is not None:
+            conditions.append("m.date >= ?")
+            params.append(date_from)
+        if date_to is not None:
+            conditions.append("m.date < ?")
+            params.append(date_to)
+
+        if conditions:
+            sql += " where " + " and ".join(conditions)
+        # Stesso ordine con e senza ricerca full-text: la paginazione tra più account
+        # unisce i risultati con questa chiave (vedi search_order_key)
+        sql += " order by m.date desc, m.id desc, m.chat_id desc limit ? offset ?"
+        params.extend([limit, offset])
+
+        results = []
+        for row in self._reader(nickname).execute(sql, params):
+            result = dict(zip(COLUMNS, row))
+            result["account"] = nickname
+            if query:
+                result["snippet"] = row[-1]
+            results.append(result)
+        return results
+
+    def iter_chat(self, nickname, chat_id, min_id=0, max_id=None):
+        """
+        Messaggi di una chat in ordine di ID, letti a blocchi
+
+        Args:
+            nickname: Account di cui leggere i messaggi
+            chat_id: Chat dei messaggi
+            min_id: Vengono restituiti solo i messaggi con ID successivo
+            max_id: Ultimo ID restituito (None = nessun limite)
+
+        Yields:
+            Dictionary con le colonne del messaggio
+        """
+        if not os.path.exists(self._db_file(nickname)):
+            return
+
+        sql = f"select {', '.join(COLUMNS)} from messages where chat_id = ? and id > ? and id <= ? order by id limit 1000"
+        last_id = max_id if max_id is not None else 2 ** 63 - 1
+        while True:
+            rows = self._reader(nickname).execute(sql, (chat_id, min_id, last_id)).fetchall()
+            for row in rows:
+                yield dict(zip(COLUMNS, row))
+            if len(rows) < 1000:
+                return
+            min_id = rows[-1][1]
+
+    def get_status(self):
+        """Restituisce lo stato dell'archivio dei messaggi"""
+        return {
+            "accounts": self.accounts(),
+            "pending": self._writer.pending(),
+            **self.stats
+        }
+
+    def close(self, timeout=10):
+        """Salva le scritture in sospeso prima della chiusura del programma"""
+        self.flush(timeout)
+
+# Singleton globale del MessageStore
+message_store = MessageStore()
+
+# Le scritture accodate non devono andare perse all'uscita
+atexit.register(message_store.close)
@@ -0,0 +1,207 @@
+"""
+Download a blocchi dei documenti, paralleli e riprendibili
+
+message.download_media richiede le parti di un file una alla volta, quindi
+la velocità di un video di grandi dimensioni è limitata dalla latenza di
+ogni singola richiesta. Questo modulo richiede più parti contemporaneamente
+e le aggiunge in ordine al file.
+
+I documenti vengono scritti in <file>.part e rinominati solo dopo aver
+verificato la dimensione, quindi un file con il nome finale è sempre
+completo. La lunghezza del .part è sempre un prefisso valido del file:
+un nuovo tentativo (o un job ripreso dopo il riavvio) continua da lì
+invece di scaricare di nuovo tutto il file.
+"""
+
+import asyncio
+import os
+from telethon import functions, types, utils
+from config import (
+    PARALLEL_DOWNLOAD_THRESHOLD, PARALLEL_DOWNLOAD_WORKERS, PARALLEL_DOWNLOAD_LARGE_FILE
+)
+
+# Limiti di Telegram: parti multiple di 4 KB e mai a cavallo di un blocco da 1 MB
+MAX_PART_SIZE = 1024 * 1024
+SMALL_PART_SIZE = 512 * 1024
+
+def get_document(message):
+    """Restituisce il documento di un messaggio, se presente"""
+    media = getattr(message, 'media', None)
+    if isinstance(media, types.MessageMediaDocument) and isinstance(media.document, types.Document):
+        return media.document
+    return None
+
+def should_download_in_parallel(message):
+    """Verifica se il media del messaggio supera la soglia per il download parallelo"""
+    document = get_document(message)
+    return document is not None and document.size >= PARALLEL_DOWNLOAD_THRESHOLD
+
+def get_part_size(file_size):
+    """Dimensione delle parti in base alla dimensione del file"""
+    return MAX_PART_SIZE if file_size >= PARALLEL_DOWNLOAD_LARGE_FILE else SMALL_PART_SIZE
+
+def get_part_file(path):
+    """File temporaneo in cui viene scaricato un file"""
+    return f"{path}.part"
+
+def get_resume_offset(part_file, size, alignment=SMALL_PART_SIZE):
+    """
+    Byte già scaricati in un file .part, da cui riprendere il download
+
+    Il file viene troncato a un multiplo di alignment (le richieste a
+    Telegram devono partire da posizioni allineate); un .part più grande
+    del documento non è valido e viene ricominciato.
+    """
+    try:
+        current = os.path.getsize(part_file)
+    except OSError:
+        return 0
+
+    offset = current - current % alignment if current <= size else 0
+    if offset != current:
+        with open(part_file, 'r+b') as f:
+            f.truncate(offset)
+    return offset
+
+def finish_part(part_file, path, size):
+    """
+    Verifica la dimensione del file scaricato e lo rinomina con il nome finale
+
+    Raises:
+        IOError: Se la dimensione non corrisponde (il .part viene eliminato)
+    """
+    actual = os.path.getsize(part_file)
+    if size is not None and actual != size:
+        os.remove(part_file)
+        raise IOError(f"Download incompleto: {actual} byte invece di {size}")
+    os.replace(part_file, path)
+    return path
+
+def get_download_path(message, file):
+    """Percorso finale di un media, con l'estensione che aggiungerebbe message.download_media"""
+    if os.path.splitext(file)[1]:
+        return file
+    return file + utils.get_extension(message.media)
+
+async def download_resumable(message, file, progress_callback=None):
+    """
+    Scarica il documento di un messaggio una parte alla volta, riprendendo da un .part esistente
+
+    Args:
+        message: Messaggio con il documento
+        file: Percorso di destinazione (con estensione)
+        progress_callback: Funzione (byte scaricati, byte totali) chiamata dopo ogni parte
+
+    Returns:
+        Percorso del file scaricato
+    """
+    document = get_document(message)
+    if document is None:
+        raise ValueError(f"Il messaggio {message.id} non contiene un documento")
+
+    size = document.size
+    part_file = get_part_file(file)
+    offset = get_resume_offset(part_file, size)
+    loop = asyncio.get_running_loop()
+
+    with open(part_file, 'ab') as f:
+        if offset < size:
+            async for chunk in message.client.iter_download(
+                    document, offset=offset, request_size=SMALL_PART_SIZE, file_size=size):
+                await loop.run_in_executor(None, f.write, chunk)
+                offset += len(chunk)
+                if progress_callback:
+                    progress_callback(offset, size)
+
+    return await loop.run_in_executor(None, finish_part, part_file, file, size)
+
+async def download_in_parallel(message, file=None, workers=PARALLEL_DOWNLOAD_WORKERS, progress_callback=None):
+    """
+    Scarica il documento di un messaggio richiedendo più parti contemporaneamente
+
+    Il nome del file finale segue le stesse regole di message.download_media
+    (estensione aggiunta se manca).
+
+    Args:
+        message: Messaggio con il documento
+        file: Percorso di destinazione
+        workers: Numero di parti richieste contemporaneamente
+        progress_callback: Funzione (byte scaricati, byte totali) chiamata dopo ogni parte
+
+    Returns:
+        Percorso del file scaricato
+    """
+    client = message.client
+    document = get_document(message)
+    if document is None:
+        raise ValueError(f"Il messaggio {message.id} non contiene un documento")
+
+    kind, possible_names = client._get_kind_and_names(document.attributes)
+    path = client._get_proper_filename(
+        file, kind, utils.get_extension(document),
+        date=message.date, possible_names=possible_names
+    )
+
+    dc_id, location = utils.get_input_location(document)
+    size = document.size
+    part_size = get_part_size(size)
+    part_file = get_part_file(path)
+    start = get_resume_offset(part_file, size, part_size)
+    offsets = asyncio.Queue()
+    for offset in range(start, size, part_size):
+        offsets.put_nowait(offset)
+
+    # I file su un altro DC usano la connessione esportata condivisa dell'account
+    exported = dc_id and dc_id != client.session.dc_id
+    sender = await client._borrow_exported_sender(dc_id) if exported else client._sender
+
+    # Le parti arrivate in anticipo attendono in memoria di essere scritte in ordine;
+    # la finestra limita quanto i worker possono andare avanti rispetto al file
+    output = open(part_file, 'ab')
+    window = max(1, workers) * 2 * part_size
+    written = start
+    pending = {}
+    ready = asyncio.Condition()
+    loop = asyncio.get_running_loop()
+
+    async def fetch_parts():
+        nonlocal written
+        while not offsets.empty():
+            offset = offsets.get_nowait()
+            async with ready:
+                await ready.wait_for(lambda: offset < written + window)
+
+            request = functions.upload.GetFileRequest(location, offset=offset, limit=part_size)
+            result = await client._call(sender, request)
+            if isinstance(result, types.upload.FileCdnRedirect):
+                raise RuntimeError("Redirect CDN non supportato dal download parallelo")
+
+            async with ready:
+                pending[offset] = result.bytes
+                while written in pending:
+                    data = pending.pop(written)
+                    if not data:
+                        raise IOError(f"Parte vuota alla posizione {written}")
+                    await loop.run_in_executor(None, output.write, data)
+                    written += len(data)
+                ready.notify_all()
+
+            if progress_callback:
+                progress_callback(written, size)
+
+    try:
+        tasks = [asyncio.ensure_future(fetch_parts()) for _ in range(max(1, workers))]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+    finally:
+        # Il .part resta su disco: il prossimo tentativo riprende da dove si è fermato
+        output.close()
+        if exported:
+            await client._return_exported_sender(sender)
+
+    return await loop.run_in_executor(None, finish_part, part_file, path, size)
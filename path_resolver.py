@@ -0,0 +1,116 @@
+"""
+Cache dei percorsi di salvataggio per account e gruppo
+
+Ogni media salvato richiedeva la sanitizzazione del nome del gruppo
+(emoji.demojize e un'espressione regolare), la ricostruzione del percorso
+e un os.makedirs. La cartella di ogni coppia (account, gruppo) viene ora
+risolta una sola volta: il nome ASCII è quello già calcolato da list_chats
+in user_groups.json (sanitize_group_name solo per i gruppi non elencati)
+e le sottocartelle dei tipi di media vengono create tutte insieme. Le
+richieste successive restituiscono il percorso senza chiamate di sistema.
+"""
+
+import os
+import threading
+from utils import load_json, sanitize_group_name
+from config import USER_GROUPS_FILE
+
+# Tipi restituiti da get_media_type (escluso "others", che non viene salvato)
+MEDIA_TYPES = ("images", "videos", "audio", "voice", "documents", "stickers", "gifs")
+
+class PathResolver:
+    """
+    Risolve e memorizza le cartelle dei gruppi di ogni account
+
+    Le chiavi sono (cartella base, account, ID del gruppo) oppure, se l'ID
+    non è noto, (cartella base, account, nome del gruppo).
+    """
+
+    def __init__(self, groups_file=USER_GROUPS_FILE):
+        """Inizializza la cache (user_groups.json viene letto al primo utilizzo)"""
+        self.groups_file = groups_file
+        self.lock = threading.Lock()
+        self.group_dirs = {}
+        self.ascii_names = {}
+        self.groups_mtime = None
+        self.stats = {'hits': 0, 'misses': 0}
+
+    def _load_ascii_names(self):
+        """Legge i nomi ASCII dei gruppi da user_groups.json, se è cambiato"""
+        try:
+            mtime = os.path.getmtime(self.groups_file)
+        except OSError:
+            return
+        if mtime == self.groups_mtime:
+            return
+
+        ascii_names = {}
+        for nickname, groups in (load_json(self.groups_file) or {}).items():
+            for group in groups:
+                if not group.get("ascii_name"):
+                    continue
+                ascii_names[(nickname, str(group["id"]))] = group["ascii_name"]
+                ascii_names.setdefault((nickname, group["name"]), group["ascii_name"])
+        self.ascii_names = ascii_names
+        self.groups_mtime = mtime
+
+    def ascii_name(self, group_name, nickname=None, chat_id=None):
+        """Nome della cartella di un gruppo: quello salvato da list_chats o il nome sanitizzato"""
+        with self.lock:
+            self._load_ascii_names()
+            name = None
+            if chat_id is not None:
+                name = self.ascii_names.get((nickname, str(chat_id)))
+            if name is None:
+                name = self.ascii_names.get((nickname, group_name))
+        return name or sanitize_group_name(group_name)
+
+    def group_dir(self, group_name, nickname=None, base_dir=None, chat_id=None):
+        """
+        Cartella di un gruppo, creata con le sottocartelle dei media alla prima richiesta
+
+        Args:
+            group_name: Nome del gruppo
+            nickname: Account che salva i file
+            base_dir: Cartella base (DOWNLOADS_DIR, ARCHIVE_DIR...)
+            chat_id: ID del gruppo, se noto (rende la cartella indipendente dai cambi di nome)
+        """
+        key = (base_dir, nickname, chat_id if chat_id is not None else group_name)
+        path = self.group_dirs.get(key)
+        if path is not None:
+            self.stats['hits'] += 1
+            return path
+
+        self.stats['misses'] += 1
+        path = os.path.join(base_dir, nickname, self.ascii_name(group_name, nickname, chat_id))
+        for media_type in MEDIA_TYPES:
+            os.makedirs(os.path.join(path, media_type), exist_ok=True)
+        self.group_dirs[key] = path
+        return path
+
+    def media_dir(self, group_name, media_type, nickname=None, base_dir=None, chat_id=None):
+        """Cartella di un tipo di media di un gruppo"""
+        path = os.path.join(self.group_dir(group_name, nickname, base_dir, chat_id), media_type)
+        if media_type not in MEDIA_TYPES:
+            os.makedirs(path, exist_ok=True)
+        return path
+
+    def forget(self, group_name, nickname=None, base_dir=None, chat_id=None):
+        """Rimuove una cartella dalla cache (ad esempio se è stata cancellata dal disco)"""
+        self.group_dirs.pop((base_dir, nickname, chat_id if chat_id is not None else group_name), None)
+
+    def invalidate(self):
+        """Svuota la cache (dopo l'aggiornamento di user_groups.json)"""
+        with self.lock:
+            self.group_dirs.clear()
+            self.groups_mtime = None
+
+    def get_status(self):
+        """Restituisce lo stato della cache"""
+        return {
+            "groups": len(self.group_dirs),
+            **self.stats
+        }
+
+# Singleton globale del PathResolver
+path_resolver = PathResolver()
@@ -0,0 +1,298 @@
+"""
+Pianificazione delle richieste Telegram per account
+
+Questo modulo fa passare ogni chiamata Telethon da un token bucket
+per account, condiviso da tutti i client dello stesso account (pool,
+monitoraggio, archivi); le richieste delle parti dei file hanno un
+bucket separato, così i download paralleli non sono limitati dalle
+altre chiamate. Quando Telegram risponde con un FloodWait, il
+limite del metodo viene stimato dalle chiamate recenti e dalla durata
+dell'attesa, così le richieste successive vengono distribuite in anticipo
+invece di sbattere di nuovo contro il limite.
+"""
+
+import asyncio
+import threading
+import time
+from collections import deque
+from telethon import TelegramClient, errors
+from telethon.utils import is_list_like
+from exported_senders import exported_senders
+from utils import log_info
+from config import (
+    RATE_LIMIT_ACCOUNT_RATE, RATE_LIMIT_ACCOUNT_BURST, RATE_LIMIT_TRANSFER_RATE, RATE_LIMIT_TRANSFER_BURST,
+    RATE_LIMIT_MIN_RATE, RATE_LIMIT_RECOVERY, RATE_LIMIT_WINDOW, FLOOD_WAIT_MAX_SLEEP
+)
+
+# Richieste delle parti dei file: con parti da 512 KiB il bucket dell'account
+# limiterebbe i download a pochi MB/s, quindi hanno un bucket proprio
+TRANSFER_METHODS = frozenset({
+    "GetFileRequest", "GetCdnFileRequest", "GetWebFileRequest",
+    "SaveFilePartRequest", "SaveBigFilePartRequest"
+})
+
+class TokenBucket:
+    """
+    Token bucket con prenotazione
+
+    Ogni chiamata prenota un token anche se il bucket è vuoto (il saldo
+    diventa negativo) e riceve il tempo da attendere, così le chiamate
+    concorrenti vengono servite in ordine senza ricontrollare.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        """Aggiunge i token maturati dall'ultimo aggiornamento"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now):
+        """
+        Prenota un token
+
+        Returns:
+            Secondi da attendere prima di usare il token
+        """
+        self._refill(now)
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def set_rate(self, rate, now):
+        """Cambia la velocità del bucket mantenendo i token maturati"""
+        self._refill(now)
+        self.rate = rate
+        self.capacity = max(1, min(self.capacity, rate * RATE_LIMIT_WINDOW))
+        self.tokens = min(self.tokens, self.capacity)
+
+class MethodLimit:
+    """Limite appreso per un singolo metodo dell'API"""
+
+    def __init__(self):
+        self.bucket = None
+        self.blocked_until = 0
+        self.calls = deque()
+        self.flood_waits = 0
+        self.last_flood_wait = None
+
+class AccountScheduler:
+    """
+    Pianificatore delle richieste di un singolo account
+
+    Tutte le richieste passano dal bucket dell'account, tranne quelle delle
+    parti dei file (TRANSFER_METHODS) che hanno un bucket separato più
+    ampio; i metodi che hanno ricevuto un FloodWait hanno anche un bucket
+    proprio con il limite appreso, che risale lentamente finché le
+    chiamate vanno a buon fine.
+    """
+
+    def __init__(self, nickname):
+        self.nickname = nickname
+        self.bucket = TokenBucket(RATE_LIMIT_ACCOUNT_RATE, RATE_LIMIT_ACCOUNT_BURST)
+        self.transfer_bucket = TokenBucket(RATE_LIMIT_TRANSFER_RATE, RATE_LIMIT_TRANSFER_BURST)
+        self.methods = {}
+        self.lock = threading.Lock()
+
+    def _method(self, method):
+        """Restituisce il limite del metodo, creandolo se necessario"""
+        limit = self.methods.get(method)
+        if limit is None:
+            limit = self.methods[method] = MethodLimit()
+        return limit
+
+    def _bucket(self, method):
+        """Bucket comune del metodo: quello dei trasferimenti o quello dell'account"""
+        return self.transfer_bucket if method in TRANSFER_METHODS else self.bucket
+
+    async def acquire(self, method):
+        """
+        Attende il turno per una chiamata del metodo
+
+        Args:
+            method: Nome della richiesta Telethon
+        """
+        while True:
+            with self.lock:
+                limit = self._method(method)
+                blocked = limit.blocked_until - time.monotonic()
+            if blocked <= 0:
+                break
+            await asyncio.sleep(blocked)
+
+        with self.lock:
+            now = time.monotonic()
+            delay = self._bucket(method).reserve(now)
+            if limit.bucket is not None:
+                delay = max(delay, limit.bucket.reserve(now))
+
+            limit.calls.append(now)
+            while limit.calls and now - limit.calls[0] > RATE_LIMIT_WINDOW:
+                limit.calls.popleft()
+
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def on_success(self, method):
+        """Aumenta gradualmente il limite di un metodo dopo una chiamata riuscita"""
+        with self.lock:
+            limit = self.methods.get(method)
+            if limit is None or limit.bucket is None:
+                return
+
+            rate = limit.bucket.rate + RATE_LIMIT_RECOVERY
+            if rate >= self._bucket(method).rate:
+                # Il metodo è tornato al limite dell'account
+                limit.bucket = None
+            else:
+                limit.bucket.set_rate(rate, time.monotonic())
+
+    def on_flood_wait(self, method, seconds):
+        """
+        Registra un FloodWait e stima il limite del metodo
+
+        Args:
+            method: Nome della richiesta Telethon
+            seconds: Secondi di attesa imposti da Telegram
+        """
+        with self.lock:
+            now = time.monotonic()
+            limit = self._method(method)
+
+            # Attesa già nota (ad esempio da un'altra chiamata concorrente)
+            if limit.blocked_until >= now + seconds - 1:
+                return
+
+            limit.blocked_until = now + seconds
+            limit.flood_waits += 1
+            limit.last_flood_wait = seconds
+
+            # Chiamate recenti distribuite sulla finestra più l'attesa imposta
+            span = (now - limit.calls[0]) if limit.calls else 0
+            rate = len(limit.calls) / (span + seconds)
+            if limit.bucket is not None:
+                rate = min(rate, limit.bucket.rate / 2)
+            rate = max(RATE_LIMIT_MIN_RATE, rate)
+
+            if limit.bucket is None:
+                limit.bucket = TokenBucket(rate, 1)
+                limit.bucket.tokens = 0
+            else:
+                limit.bucket.set_rate(rate, now)
+
+        log_info(
+            f"FloodWait di {seconds}s per {self.nickname} su {method}: "
+            f"limite stimato {rate:.3f} richieste/s",
+            "rate_limiter.log"
+        )
+
+    def blocked_for(self):
+        """Secondi di attesa per FloodWait del metodo più bloccato dell'account"""
+        with self.lock:
+            now = time.monotonic()
+            return max([limit.blocked_until - now for limit in self.methods.values()] + [0])
+
+    def get_status(self):
+        """Ottiene i limiti appresi per l'account"""
+        with self.lock:
+            now = time.monotonic()
+            return {
+                method: {
+                    'rate': limit.bucket.rate if limit.bucket else None,
+                    'blocked_for': max(0, round(limit.blocked_until - now, 1)),
+                    'flood_waits': limit.flood_waits,
+                    'last_flood_wait': limit.last_flood_wait
+                }
+                for method, limit in self.methods.items()
+                if limit.flood_waits
+            }
+
+class RequestScheduler:
+    """Raccolta dei pianificatori di tutti gli account"""
+
+    def __init__(self):
+        """Inizializza il pianificatore delle richieste"""
+        self.accounts = {}
+        self.accounts_lock = threading.RLock()
+
+    def get(self, nickname):
+        """
+        Ottiene il pianificatore di un account
+
+        Args:
+            nickname: Nome utente
+
+        Returns:
+            AccountScheduler dell'account
+        """
+        with self.accounts_lock:
+            scheduler = self.accounts.get(nickname)
+            if scheduler is None:
+                scheduler = self.accounts[nickname] = AccountScheduler(nickname)
+            return scheduler
+
+    def get_status(self):
+        """
+        Ottiene i limiti appresi per tutti gli account
+
+        Returns:
+            Dictionary nickname -> limiti dei metodi
+        """
+        with self.accounts_lock:
+            accounts = dict(self.accounts)
+        return {nickname: scheduler.get_status() for nickname, scheduler in accounts.items()}
+
+# Singleton globale del RequestScheduler
+request_scheduler = RequestScheduler()
+
+def _request_name(request):
+    """Nome del metodo di una richiesta (o della prima di una lista)"""
+    if is_list_like(request):
+        request = request[0] if request else None
+    return type(request).__name__
+
+class ScheduledTelegramClient(TelegramClient):
+    """
+    TelegramClient le cui chiamate passano dal pianificatore dell'account
+
+    I FloodWait non vengono gestiti da Telethon ma dal pianificatore, che
+    attende il tempo richiesto e ripete la chiamata; solo le attese più
+    lunghe di FLOOD_WAIT_MAX_SLEEP vengono propagate al chiamante.
+    """
+
+    def __init__(self, session, api_id, api_hash, nickname=None, **kwargs):
+        kwargs.setdefault('connection_retries', 10)
+        kwargs.setdefault('retry_delay', 3)
+        kwargs['flood_sleep_threshold'] = 0
+        super().__init__(session, api_id, api_hash, **kwargs)
+        self.nickname = nickname or getattr(session, 'nickname', None) or str(session)
+
+    async def _call(self, sender, request, ordered=False, flood_sleep_threshold=None):
+        scheduler = request_scheduler.get(self.nickname)
+        method = _request_name(request)
+
+        while True:
+            await scheduler.acquire(method)
+            try:
+                result = await super()._call(sender, request, ordered=ordered, flood_sleep_threshold=0)
+            except (errors.FloodWaitError, errors.FloodPremiumWaitError) as e:
+                scheduler.on_flood_wait(method, e.seconds)
+                if e.seconds > FLOOD_WAIT_MAX_SLEEP:
+                    raise
+                continue
+
+            scheduler.on_success(method)
+            return result
+
+    async def _borrow_exported_sender(self, dc_id):
+        # Connessioni verso altri DC condivise tra i client dell'account
+        return await exported_senders.borrow(self, self.nickname, dc_id)
+
+    async def _return_exported_sender(self, sender):
+        await exported_senders.release(sender)
+
+    async def _clean_exported_senders(self):
+        await exported_senders.clean_idle()
@@ -5,271 +5,543 @@ Questo modulo fornisce funzionalità per gestire le sessioni Telethon
 in modo centralizzato, evitando conflitti tra operazioni parallele.
 """
 
+import asyncio
 import os
-import json
-import shutil
 import threading
 import time
-import random
-from utils import log_error, log_info
+import uuid
+from collections import deque
+from contextlib import asynccontextmanager
+from telethon import utils
+from telethon.crypto import AuthKey
+from telethon.sessions import MemorySession
+from telethon.tl.types import PeerUser, PeerChat, PeerChannel
+from session_storage import session_store
+from utils import load_json, log_error, log_info
+from config import PHONE_NUMBERS_FILE
+
+class SessionSnapshot:
+    """
+    Dati di autorizzazione di un account letti una sola volta dall'archivio
+
+    L'istantanea è condivisa da tutte le viste dello stesso account: quando
+    una vista cambia data center o chiave, l'aggiornamento vale per tutte.
+    """
+
+    def __init__(self, nickname, dc_id=0, server_address=None, port=None, auth_key=None, takeout_id=None):
+        self.nickname = nickname
+        self.dc_id = dc_id or 0
+        self.server_address = server_address
+        self.port = port
+        self.auth_key = auth_key
+        self.takeout_id = takeout_id
+        self.loaded_at = time.time()
+
+    def save(self):
+        """Salva i dati di autorizzazione nell'archivio condiviso"""
+        session_store.save_account(
+            self.nickname, self.dc_id, self.server_address, self.port,
+            self.auth_key.key if self.auth_key else None, self.takeout_id
+        )
+
+class SessionView(MemorySession):
+    """
+    Sessione in memoria dedicata a una singola operazione
+
+    Parte dai dati di autorizzazione condivisi dell'account senza copiare
+    alcun file. Le entità e lo stato degli aggiornamenti vengono cercati
+    nell'archivio condiviso e vi vengono scritti in blocco.
+    """
+
+    def __init__(self, snapshot, session_id=None):
+        super().__init__()
+        self.snapshot = snapshot
+        self.nickname = snapshot.nickname
+        self.session_id = session_id
+        self._dc_id = snapshot.dc_id
+        self._server_address = snapshot.server_address
+        self._port = snapshot.port
+        self._auth_key = snapshot.auth_key
+        self._takeout_id = snapshot.takeout_id
+
+    def _save_auth(self):
+        """Propaga all'istantanea e all'archivio un cambio di autorizzazione"""
+        snapshot = self.snapshot
+        current = (snapshot.dc_id, snapshot.server_address, snapshot.port,
+                   snapshot.auth_key.key if snapshot.auth_key else None, snapshot.takeout_id)
+        updated = (self._dc_id, self._server_address, self._port,
+                   self._auth_key.key if self._auth_key else None, self._takeout_id)
+
+        # Telethon reimposta la stessa chiave a ogni connessione: salva solo i cambiamenti
+        if current == updated:
+            return
+
+        snapshot.dc_id, snapshot.server_address, snapshot.port = self._dc_id, self._server_address, self._port
+        snapshot.auth_key, snapshot.takeout_id = self._auth_key, self._takeout_id
+        snapshot.save()
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._save_auth()
+
+    @MemorySession.auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._save_auth()
+
+    @MemorySession.takeout_id.setter
+    def takeout_id(self, value):
+        self._takeout_id = value
+        self._save_auth()
+
+    def process_entities(self, tlo):
+        rows = self._entities_to_rows(tlo)
+        if rows:
+            self._entities.update(rows)
+            session_store.save_entities(self.nickname, rows)
+
+    def get_entity_rows_by_phone(self, phone):
+        return (super().get_entity_rows_by_phone(phone)
+                or session_store.get_entity_row(self.nickname, 'phone', phone))
+
+    def get_entity_rows_by_username(self, username):
+        return (super().get_entity_rows_by_username(username)
+                or session_store.get_entity_row(self.nickname, 'username', username))
+
+    def get_entity_rows_by_name(self, name):
+        return (super().get_entity_rows_by_name(name)
+                or session_store.get_entity_row(self.nickname, 'name', name))
+
+    def get_entity_rows_by_id(self, id, exact=True):
+        result = super().get_entity_rows_by_id(id, exact)
+        if result:
+            return result
+
+        if exact:
+            return session_store.get_entity_row(self.nickname, 'id', id)
+
+        # Stessa logica di MemorySession: prova tutti i tipi di peer
+        ids = [utils.get_peer_id(peer) for peer in (PeerUser(id), PeerChat(id), PeerChannel(id))]
+        return session_store.get_entity_row_by_ids(self.nickname, ids)
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        session_store.save_update_state(self.nickname, entity_id, state)
+
+    def get_update_state(self, entity_id):
+        state = super().get_update_state(entity_id)
+        if state is None:
+            state = session_store.get_update_states(self.nickname).get(entity_id)
+        return state
+
+    def get_update_states(self):
+        states = session_store.get_update_states(self.nickname)
+        states.update(self._update_states)
+        return states.items()
+
+    def delete(self):
+        # Chiamato da Telethon dopo il logout: l'autorizzazione non è più valida
+        session_manager.delete(self.nickname)
+
+class SessionLock:
+    """
+    Lock condiviso/esclusivo dell'account, utilizzabile da loop diversi
+
+    Più operazioni possono connettersi insieme con lo stesso account
+    (accesso condiviso), mentre login ed eliminazione richiedono l'accesso
+    esclusivo. Le richieste in attesa vengono servite in ordine di arrivo.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self.exclusive = False
+        self.waiters = deque()
+
+    def can_grant(self, exclusive):
+        """Verifica se l'accesso richiesto è compatibile con quelli in corso"""
+        if exclusive:
+            return not self.exclusive and self.shared == 0
+        return not self.exclusive
+
+    def grant(self, exclusive):
+        """Registra un accesso concesso"""
+        if exclusive:
+            self.exclusive = True
+        else:
+            self.shared += 1
+
+    def release(self, exclusive):
+        """Registra la fine di un accesso"""
+        if exclusive:
+            self.exclusive = False
+        else:
+            self.shared = max(0, self.shared - 1)
+
+    def is_idle(self):
+        """Verifica se nessuno usa o attende il lock"""
+        return self.shared == 0 and not self.exclusive and not self.waiters
 
 class SessionManager:
     """
     Gestisce le sessioni Telegram per evitare conflitti
-    
-    Questa classe crea sessioni dedicate per ogni operazione,
-    copiando i dati da una sessione principale quando disponibile.
+
+    Questa classe fornisce a ogni operazione una sessione in memoria
+    dedicata, creata dai dati dell'account letti una sola volta
+    dall'archivio condiviso. Nessun file di sessione viene copiato.
     """
-    
+
     def __init__(self):
         """Inizializza il gestore delle sessioni"""
         self.sessions = {}
+        self.snapshots = {}
+        self.locks = {}
         self.sessions_lock = threading.RLock()
-    
+
     def create_session(self, nickname, operation_id=None):
         """
         Crea una nuova sessione dedicata per un'operazione
-        
+
         Args:
             nickname: Nome utente per cui creare la sessione
-            operation_id: ID operazione, se None usa una sessione standard
-            
+            operation_id: ID operazione, se None la sessione non viene registrata
+
         Returns:
-            (success, session_path): Flag di successo e percorso alla sessione
+            (success, session): Flag di successo e sessione da passare a TelegramClient
         """
         with self.sessions_lock:
             try:
-                # Se non è specificato un operation_id, usa la sessione standard
+                snapshot = self._get_snapshot(nickname)
+
+                # Senza operation_id (es. login) la sessione non appartiene a un'operazione
                 if not operation_id:
-                    session_path = f'session_{nickname}'
-                    return True, session_path
-                
+                    return True, SessionView(snapshot)
+
                 # Genera un ID unico per la sessione
-                session_id = f"{operation_id}_{int(time.time())}_{random.randint(1000, 9999)}"
-                session_path = f'session_{nickname}_{session_id}'
-                
-                # Sessione originale
-                original_session = f'session_{nickname}.session'
-                
-                # Se esiste la sessione originale, copiala per creare la sessione dedicata
-                if os.path.exists(original_session):
-                    try:
-                        # Copia il file di sessione
-                        shutil.copy2(original_session, f'{session_path}.session')
-                        
-                        # Copia anche eventuali file correlati
-                        for ext in ['.session-journal']:
-                            src = f'session_{nickname}{ext}'
-                            if os.path.exists(src):
-                                shutil.copy2(src, f'{session_path}{ext}')
-                    except Exception as e:
-                        log_error(f"Errore nella copia del file di sessione: {e}")
-                
+                session_id = f"{operation_id}_{uuid.uuid4().hex[:12]}"
+                session = SessionView(snapshot, session_id)
+
                 # Registra la sessione
-                self.sessions[session_path] = {
+                self.sessions[session_id] = {
                     'nickname': nickname,
                     'operation_id': operation_id,
                     'created_at': time.time()
                 }
-                
-                log_info(f"Sessione creata: {session_path}", "sessions.log")
-                return True, session_path
-                
+
+                return True, session
+
             except Exception as e:
                 log_error(f"Errore nella creazione della sessione per {nickname}: {e}")
                 return False, None
-    
+
+    def _get_snapshot(self, nickname):
+        """
+        Restituisce i dati di autorizzazione dell'account, leggendoli dall'archivio solo la prima volta
+
+        Args:
+            nickname: Nome utente
+
+        Returns:
+            SessionSnapshot (vuota se l'account non ha ancora effettuato il login)
+        """
+        snapshot = self.snapshots.get(nickname)
+        if snapshot is None:
+            row = session_store.get_account(nickname)
+            if row:
+                dc_id, server_address, port, key, takeout_id = row
+                snapshot = SessionSnapshot(
+                    nickname, dc_id, server_address, port,
+                    AuthKey(data=key) if key else None, takeout_id
+                )
+            else:
+                snapshot = SessionSnapshot(nickname)
+            self.snapshots[nickname] = snapshot
+        return snapshot
+
+    @asynccontextmanager
+    async def use(self, nickname, exclusive=False):
+        """
+        Coordina l'accesso alla sessione di un account
+
+        Senza altre operazioni in corso l'accesso è immediato; altrimenti
+        attende solo finché l'accesso richiesto non è compatibile. La
+        connessione di un account non ancora autorizzato è sempre esclusiva,
+        perché genera una nuova chiave di autorizzazione.
+
+        Args:
+            nickname: Nome utente
+            exclusive: True per login ed eliminazione della sessione
+        """
+        if not exclusive and not self.has_session(nickname):
+            exclusive = True
+
+        await self._acquire_lock(nickname, exclusive)
+        try:
+            yield
+        finally:
+            self._release_lock(nickname, exclusive)
+
+    async def _acquire_lock(self, nickname, exclusive):
+        """Ottiene il lock dell'account, attendendo se necessario"""
+        loop = asyncio.get_running_loop()
+
+        with self.sessions_lock:
+            lock = self.locks.setdefault(nickname, SessionLock())
+            if not lock.waiters and lock.can_grant(exclusive):
+                lock.grant(exclusive)
+                return
+
+            waiter = (exclusive, loop, loop.create_future())
+            lock.waiters.append(waiter)
+
+        log_info(f"Attesa della sessione di {nickname} ({'esclusiva' if exclusive else 'condivisa'})", "sessions.log")
+
+        future = waiter[2]
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self.sessions_lock:
+                if waiter in lock.waiters:
+                    lock.waiters.remove(waiter)
+                    granted = False
+                else:
+                    granted = future.done() and not future.cancelled()
+            if granted:
+                self._release_lock(nickname, exclusive)
+            raise
+
+    def _release_lock(self, nickname, exclusive):
+        """Rilascia il lock dell'account e sveglia le richieste compatibili"""
+        with self.sessions_lock:
+            lock = self.locks.get(nickname)
+            if lock is None:
+                return
+
+            lock.release(exclusive)
+
+            while lock.waiters and lock.can_grant(lock.waiters[0][0]):
+                waiter = lock.waiters.popleft()
+                lock.grant(waiter[0])
+                waiter[1].call_soon_threadsafe(self._wake, nickname, waiter)
+
+            if lock.is_idle():
+                del self.locks[nickname]
+
+    def _wake(self, nickname, waiter):
+        """Sveglia una richiesta in attesa (eseguito sul suo loop)"""
+        exclusive, _, future = waiter
+        if future.cancelled():
+            # La richiesta è stata annullata prima di ricevere il lock
+            self._release_lock(nickname, exclusive)
+        else:
+            future.set_result(True)
+
+    def has_session(self, nickname):
+        """
+        Verifica se l'account ha una sessione autorizzata
+
+        Args:
+            nickname: Nome utente
+        """
+        with self.sessions_lock:
+            return self._get_snapshot(nickname).auth_key is not None
+
+    def invalidate(self, nickname):
+        """
+        Scarta i dati di autorizzazione in memoria di un account
+
+        Da chiamare quando la sessione può essere cambiata fuori da questo
+        processo, così la prossima sessione creata rilegge l'archivio.
+
+        Args:
+            nickname: Nome utente
+        """
+        with self.sessions_lock:
+            self.snapshots.pop(nickname, None)
+
+    def delete(self, nickname):
+        """
+        Elimina la sessione di un account dall'archivio condiviso
+
+        Rimuove anche il vecchio file session_<nickname>.session, altrimenti
+        verrebbe importato di nuovo al prossimo accesso. L'eliminazione
+        dall'archivio viene accodata: chi deve rileggere subito la sessione
+        attende session_store.flush() (fuori dal loop di eventi).
+
+        Args:
+            nickname: Nome utente
+
+        Returns:
+            True se il vecchio file, se presente, è stato rimosso
+        """
+        with self.sessions_lock:
+            session_store.delete_account(nickname)
+            self.snapshots.pop(nickname, None)
+
+            session_file = f'session_{nickname}.session'
+            if os.path.exists(session_file):
+                try:
+                    os.remove(session_file)
+                except Exception as e:
+                    log_error(f"Impossibile rimuovere il file di sessione: {e}")
+                    return False
+            return True
+
     def release_session(self, operation_id, nickname=None):
         """
         Rilascia tutte le sessioni associate a un'operazione
-        
+
         Args:
             operation_id: ID dell'operazione
             nickname: Se specificato, rilascia solo le sessioni di questo utente
-            
+
         Returns:
             count: Numero di sessioni rilasciate
         """
         with self.sessions_lock:
             try:
                 # Trova tutte le sessioni da rilasciare
-                sessions_to_release = []
-                
-                for session_path, info in list(self.sessions.items()):
-                    if info['operation_id'] == operation_id:
-                        if nickname is None or info['nickname'] == nickname:
-                            sessions_to_release.append(session_path)
-                
-                # Rilascia le sessioni
-                count = 0
-                for session_path in sessions_to_release:
-                    self._cleanup_session_files(session_path)
-                    if session_path in self.sessions:
-                        del self.sessions[session_path]
-                        count += 1
-                
-                if count > 0:
-                    log_info(f"Rilasciate {count} sessioni per operazione {operation_id}", "sessions.log")
-                
-                return count
-                
+                sessions_to_release = [
+                    session_id for session_id, info in self.sessions.items()
+                    if info['operation_id'] == operation_id
+                    and (nickname is None or info['nickname'] == nickname)
+                ]
+
+                # Le sessioni sono solo in memoria: basta dimenticarle
+                for session_id in sessions_to_release:
+                    del self.sessions[session_id]
+
+                return len(sessions_to_release)
+
             except Exception as e:
                 log_error(f"Errore nel rilascio delle sessioni per operazione {operation_id}: {e}")
                 return 0
-    
-    def _cleanup_session_files(self, session_path):
+
+    def release(self, session):
         """
-        Pulisce i file associati a una sessione in modo sicuro
-        
+        Rilascia una singola sessione creata da create_session
+
         Args:
-            session_path: Percorso base della sessione (senza estensione)
+            session: Sessione restituita da create_session
         """
-        try:
-            # Aggiungi un ritardo prima di tentare di eliminare il file
-            time.sleep(1)
-            
-            # Ritenta diverse volte in caso di errore
-            max_attempts = 3
-            for attempt in range(max_attempts):
-                try:
-                    # Rimuovi il file di sessione principale
-                    if os.path.exists(f'{session_path}.session'):
-                        os.remove(f'{session_path}.session')
-                    
-                    # Rimuovi eventuali file correlati
-                    for ext in ['.session-journal']:
-                        file_path = f'{session_path}{ext}'
-                        if os.path.exists(file_path):
-                            os.remove(file_path)
-                    
-                    return  # Successo, esci dal ciclo
-                except PermissionError as e:
-                    if attempt < max_attempts - 1:
-                        # Se il file è in uso, attendi e riprova
-                        log_error(f"File di sessione in uso, attendo e riprovo ({attempt+1}/{max_attempts}): {e}")
-                        time.sleep(2 * (attempt + 1))  # Attesa crescente
-                    else:
-                        # Registra l'errore ma non bloccare l'esecuzione
-                        log_error(f"Impossibile eliminare il file di sessione dopo {max_attempts} tentativi: {e}")
-        except Exception as e:
-            log_error(f"Errore durante la pulizia dei file di sessione {session_path}: {e}")
-            
-    
+        session_id = getattr(session, 'session_id', None)
+        if session_id:
+            with self.sessions_lock:
+                self.sessions.pop(session_id, None)
+
     def cleanup_all(self):
         """
         Pulisce tutte le sessioni temporanee
-        
+
         Returns:
             count: Numero di sessioni pulite
         """
         with self.sessions_lock:
             try:
-                # Trova tutte le sessioni da pulire
-                session_paths = list(self.sessions.keys())
-                
-                # Pulisci le sessioni
-                count = 0
-                for session_path in session_paths:
-                    self._cleanup_session_files(session_path)
-                    count += 1
-                
+                count = len(self.sessions)
+
                 # Svuota il dizionario delle sessioni
                 self.sessions.clear()
-                
-                if count > 0:
-                    log_info(f"Pulite {count} sessioni", "sessions.log")
-                
-                # Pulizia aggiuntiva: cerca file di sessione orfani
+
+                # Pulizia aggiuntiva: file copiati dalle versioni precedenti
                 orphan_count = self._cleanup_orphan_sessions()
-                
+
                 return count + orphan_count
-                
+
             except Exception as e:
                 log_error(f"Errore durante la pulizia di tutte le sessioni: {e}")
                 return 0
-    
+
+    def _is_temporary_session_file(self, file, nicknames):
+        """
+        Verifica se un file è una copia temporanea di una sessione
+
+        Args:
+            file: Nome del file
+            nicknames: Nickname configurati, le cui sessioni principali vanno preservate
+        """
+        for ext in ('.session', '.session-journal'):
+            if file.startswith('session_') and file.endswith(ext):
+                return file[len('session_'):-len(ext)] not in nicknames
+        return False
+
     def _cleanup_orphan_sessions(self):
         """
-        Pulisce i file di sessione orfani (non registrati nel gestore)
-        
+        Pulisce i file di sessione orfani lasciati dalle copie delle versioni precedenti
+
         Returns:
             count: Numero di file di sessione orfani rimossi
         """
         try:
             count = 0
-            
-            # Cerca file di sessione che contengono underscore (sessioni temporanee)
+            nicknames = set(load_json(PHONE_NUMBERS_FILE))
+
             for file in os.listdir('.'):
-                if (file.endswith('.session') and '_' in file) or file.endswith('.session-journal'):
-                    session_path = file.replace('.session', '').replace('-journal', '')
-                    
-                    # Se non è registrato nel gestore, è un orfano
-                    if session_path not in self.sessions:
-                        try:
-                            os.remove(file)
-                            count += 1
-                        except:
-                            pass
-            
+                if self._is_temporary_session_file(file, nicknames):
+                    try:
+                        os.remove(file)
+                        count += 1
+                    except:
+                        pass
+
             if count > 0:
                 log_info(f"Rimossi {count} file di sessione orfani", "sessions.log")
-            
+
             return count
-            
+
         except Exception as e:
             log_error(f"Errore durante la pulizia dei file di sessione orfani: {e}")
             return 0
-    
+
     def get_session_status(self):
         """
         Ottiene lo stato di tutte le sessioni
-        
+
         Returns:
             sessions: Dictionary con lo stato delle sessioni
         """
         with self.sessions_lock:
             return self.sessions.copy()
-        
+
     def handle_orphaned_sessions(self):
         """
         Gestisce le sessioni orfane rilevando i file .session lasciati da processi precedenti
-        
+
         Returns:
             orphaned_sessions: Lista di sessioni orfane trovate
         """
         orphaned_sessions = []
-        
+
         try:
-            # Cerca file di sessione con pattern che indicano sessioni temporanee
+            nicknames = set(load_json(PHONE_NUMBERS_FILE))
+
+            # Cerca copie temporanee create dalle versioni precedenti
             for file in os.listdir('.'):
-                if file.endswith('.session') and '_' in file:
+                if file.endswith('.session') and self._is_temporary_session_file(file, nicknames):
                     session_path = file.replace('.session', '')
-                    
-                    # Se non è registrato nel gestore, è una sessione orfana
-                    if session_path not in self.sessions:
-                        # Verifica se il file è utilizzato
-                        try:
-                            # Prova ad aprire il file in modalità scrittura esclusiva
-                            with open(file, 'a+b') as f:
-                                # Se siamo qui, il file non è bloccato
-                                f.close()
-                                
-                                # Tenta di eliminare il file
-                                try:
-                                    os.remove(file)
-                                    # Controlla anche il file journal
-                                    journal_file = f"{file}-journal"
-                                    if os.path.exists(journal_file):
-                                        os.remove(journal_file)
-                                    log_info(f"Sessione orfana rimossa: {file}", "sessions.log")
-                                except Exception as e:
-                                    log_error(f"Impossibile rimuovere la sessione orfana {file}: {e}")
-                                    
-                        except (IOError, PermissionError):
-                            # File in uso
-                            orphaned_sessions.append(session_path)
-                            log_info(f"Sessione orfana in uso rilevata: {file}", "sessions.log")
-            
+
+                    # Verifica se il file è utilizzato
+                    try:
+                        # Prova ad aprire il file in modalità scrittura esclusiva
+                        with open(file, 'a+b') as f:
+                            # Se siamo qui, il file non è bloccato
+                            f.close()
+
+                            # Tenta di eliminare il file
+                            try:
+                                os.remove(file)
+                                # Controlla anche il file journal
+                                journal_file = f"{file}-journal"
+                                if os.path.exists(journal_file):
+                                    os.remove(journal_file)
+                                log_info(f"Sessione orfana rimossa: {file}", "sessions.log")
+                            except Exception as e:
+                                log_error(f"Impossibile rimuovere la sessione orfana {file}: {e}")
+
+                    except (IOError, PermissionError):
+                        # File in uso
+                        orphaned_sessions.append(session_path)
+                        log_info(f"Sessione orfana in uso rilevata: {file}", "sessions.log")
+
             return orphaned_sessions
         except Exception as e:
             log_error(f"Errore durante la gestione delle sessioni orfane: {e}")
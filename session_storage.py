@@ -0,0 +1,365 @@
+"""
+Archivio condiviso delle sessioni Telegram
+
+Questo modulo conserva i dati di tutte le sessioni (chiavi di autorizzazione,
+cache delle entità, stato degli aggiornamenti) in un unico database SQLite
+in modalità WAL. Le letture avvengono in parallelo da qualsiasi thread,
+mentre tutte le scritture passano da un unico thread (sqlite_writer) che
+le raggruppa in transazioni, così le operazioni concorrenti non si
+bloccano a vicenda.
+"""
+
+import atexit
+import datetime
+import os
+import sqlite3
+import threading
+import time
+from telethon.tl import types
+from utils import log_error, log_info
+from sqlite_writer import SQLiteWriter, connect_wal
+from config import SESSIONS_DB_FILE, SESSION_STORE_FLUSH_INTERVAL, SESSION_STORE_BATCH_SIZE
+
+class SessionStore:
+    """
+    Database unico delle sessioni di tutti gli account
+
+    Le scritture vengono accodate e applicate in blocco dal thread scrittore;
+    flush() permette di attendere che quelle già accodate siano su disco.
+    """
+
+    def __init__(self, db_file=SESSIONS_DB_FILE):
+        """Inizializza l'archivio delle sessioni"""
+        self.db_file = db_file
+        self._local = threading.local()
+        self._writer = SQLiteWriter(
+            "session-store-writer", lambda key: self._connect(), SESSION_STORE_FLUSH_INTERVAL,
+            SESSION_STORE_BATCH_SIZE, "nell'archivio delle sessioni"
+        )
+        self._init_lock = threading.Lock()
+        self._initialized = False
+
+    def _connect(self):
+        """Apre una connessione al database in modalità WAL"""
+        return connect_wal(self.db_file)
+
+    def _ensure_initialized(self):
+        """Crea le tabelle al primo utilizzo"""
+        if self._initialized:
+            return
+
+        with self._init_lock:
+            if self._initialized:
+                return
+
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute("""create table if not exists accounts (
+                        nickname text primary key,
+                        dc_id integer,
+                        server_address text,
+                        port integer,
+                        auth_key blob,
+                        takeout_id integer
+                    )""")
+                    conn.execute("""create table if not exists entities (
+                        nickname text,
+                        id integer,
+                        hash integer not null,
+                        username text,
+                        phone integer,
+                        name text,
+                        date integer,
+                        primary key(nickname, id)
+                    )""")
+                    conn.execute("create index if not exists entities_username on entities(nickname, username)")
+                    conn.execute("create index if not exists entities_phone on entities(nickname, phone)")
+                    conn.execute("""create table if not exists users (
+                        id integer primary key,
+                        username text,
+                        first_name text,
+                        last_name text,
+                        display_name text,
+                        date integer
+                    )""")
+                    conn.execute("create index if not exists users_username on users(lower(username))")
+                    conn.execute("""create table if not exists update_state (
+                        nickname text,
+                        id integer,
+                        pts integer,
+                        qts integer,
+                        date integer,
+                        seq integer,
+                        primary key(nickname, id)
+                    )""")
+            finally:
+                conn.close()
+
+            self._initialized = True
+
+    def _reader(self):
+        """Restituisce la connessione di lettura del thread corrente"""
+        self._ensure_initialized()
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+        return conn
+
+    def _fetchone(self, sql, *params):
+        """Esegue una query di lettura e restituisce la prima riga"""
+        return self._reader().execute(sql, params).fetchone()
+
+    def _fetchall(self, sql, *params):
+        """Esegue una query di lettura e restituisce tutte le righe"""
+        return self._reader().execute(sql, params).fetchall()
+
+    def _enqueue(self, sql, rows):
+        """Accoda una scrittura per il thread scrittore"""
+        self._ensure_initialized()
+        self._writer.enqueue(sql, rows)
+
+    def flush(self, timeout=10):
+        """
+        Attende che tutte le scritture accodate siano salvate
+
+        Args:
+            timeout: Secondi massimi di attesa
+
+        Returns:
+            True se le scritture sono state salvate entro il timeout
+        """
+        return self._writer.flush(timeout)
+
+    def get_account(self, nickname):
+        """
+        Ottiene i dati di autorizzazione di un account
+
+        Se l'account non è ancora nel database, importa la vecchia
+        sessione session_<nickname>.session se presente.
+
+        Args:
+            nickname: Nome utente
+
+        Returns:
+            (dc_id, server_address, port, auth_key, takeout_id) o None
+        """
+        row = self._fetchone(
+            "select dc_id, server_address, port, auth_key, takeout_id from accounts where nickname = ?",
+            nickname
+        )
+        if row is None and self.import_legacy_session(nickname):
+            row = self._fetchone(
+                "select dc_id, server_address, port, auth_key, takeout_id from accounts where nickname = ?",
+                nickname
+            )
+        return row
+
+    def has_account(self, nickname):
+        """Verifica se esistono dati di autorizzazione per l'account"""
+        row = self.get_account(nickname)
+        return bool(row and row[3])
+
+    def save_account(self, nickname, dc_id, server_address, port, auth_key, takeout_id=None):
+        """
+        Salva i dati di autorizzazione di un account
+
+        Args:
+            nickname: Nome utente
+            dc_id, server_address, port: Data center dell'account
+            auth_key: Chiave di autorizzazione (bytes) o None
+            takeout_id: ID della sessione di takeout, se presente
+        """
+        self._enqueue(
+            "insert or replace into accounts values (?,?,?,?,?,?)",
+            [(nickname, dc_id, server_address, port, auth_key or b'', takeout_id)]
+        )
+
+    def delete_account(self, nickname):
+        """Elimina tutti i dati salvati di un account"""
+        self._enqueue("delete from accounts where nickname = ?", [(nickname,)])
+        self._enqueue("delete from entities where nickname = ?", [(nickname,)])
+        self._enqueue("delete from update_state where nickname = ?", [(nickname,)])
+
+    def save_entities(self, nickname, rows):
+        """
+        Salva in blocco le entità viste da un account
+
+        Args:
+            nickname: Nome utente
+            rows: Righe (id, hash, username, phone, name)
+        """
+        if not rows:
+            return
+        now = int(time.time())
+        self._enqueue(
+            "insert or replace into entities values (?,?,?,?,?,?,?)",
+            [(nickname, *row, now) for row in rows]
+        )
+
+    def get_entity_row(self, nickname, column, value):
+        """
+        Cerca un'entità dell'account per id, username, phone o name
+
+        Returns:
+            (id, hash) o None
+        """
+        if column not in ('id', 'username', 'phone', 'name'):
+            raise ValueError(f"Colonna non valida: {column}")
+        return self._fetchone(
+            f"select id, hash from entities where nickname = ? and {column} = ? order by date desc",
+            nickname, value
+        )
+
+    def get_entity_row_by_ids(self, nickname, ids):
+        """Cerca la prima entità dell'account tra più ID possibili"""
+        placeholders = ",".join("?" for _ in ids)
+        return self._fetchone(
+            f"select id, hash from entities where nickname = ? and id in ({placeholders})",
+            nickname, *ids
+        )
+
+    def save_users(self, rows):
+        """
+        Salva in blocco le informazioni sugli utenti, condivise da tutti gli account
+
+        Args:
+            rows: Righe (id, username, first_name, last_name, display_name, date)
+        """
+        if rows:
+            self._enqueue("insert or replace into users values (?,?,?,?,?,?)", rows)
+
+    def get_users(self, ids):
+        """
+        Legge le informazioni salvate di più utenti
+
+        Returns:
+            Lista di righe (id, username, first_name, last_name, display_name, date)
+        """
+        ids = list(ids)
+        rows = []
+        # SQLite limita il numero di parametri per query
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            placeholders = ",".join("?" for _ in chunk)
+            rows.extend(self._fetchall(
+                f"select id, username, first_name, last_name, display_name, date from users where id in ({placeholders})",
+                *chunk
+            ))
+        return rows
+
+    def find_users(self, usernames):
+        """
+        Cerca gli utenti salvati per username (senza distinzione tra maiuscole e minuscole)
+
+        Returns:
+            Lista di righe (id, username, first_name, last_name, display_name, date)
+        """
+        usernames = [username.lower() for username in usernames]
+        if not usernames:
+            return []
+        placeholders = ",".join("?" for _ in usernames)
+        return self._fetchall(
+            f"select id, username, first_name, last_name, display_name, date from users where lower(username) in ({placeholders})",
+            *usernames
+        )
+
+    def save_update_state(self, nickname, entity_id, state):
+        """Salva lo stato degli aggiornamenti di un account"""
+        self._enqueue(
+            "insert or replace into update_state values (?,?,?,?,?,?)",
+            [(nickname, entity_id, state.pts, state.qts, state.date.timestamp(), state.seq)]
+        )
+
+    def get_update_states(self, nickname):
+        """
+        Ottiene gli stati degli aggiornamenti salvati per un account
+
+        Returns:
+            Dictionary entity_id -> types.updates.State
+        """
+        rows = self._fetchall(
+            "select id, pts, qts, date, seq from update_state where nickname = ?",
+            nickname
+        )
+        return {
+            row[0]: types.updates.State(
+                pts=row[1],
+                qts=row[2],
+                date=datetime.datetime.fromtimestamp(row[3], tz=datetime.timezone.utc),
+                seq=row[4],
+                unread_count=0
+            )
+            for row in rows
+        }
+
+    def import_legacy_session(self, nickname):
+        """
+        Importa nel database una sessione Telethon salvata nel vecchio formato
+
+        Args:
+            nickname: Nome utente
+
+        Returns:
+            True se la sessione è stata importata
+        """
+        session_file = f'session_{nickname}.session'
+        if not os.path.exists(session_file):
+            return False
+
+        self._ensure_initialized()
+        try:
+            legacy = sqlite3.connect(f'file:{session_file}?mode=ro', uri=True, timeout=10)
+            try:
+                row = legacy.execute("select dc_id, server_address, port, auth_key from sessions").fetchone()
+                if not row:
+                    return False
+
+                try:
+                    entities = legacy.execute("select id, hash, username, phone, name from entities").fetchall()
+                except sqlite3.OperationalError:
+                    entities = []
+
+                try:
+                    states = legacy.execute("select id, pts, qts, date, seq from update_state").fetchall()
+                except sqlite3.OperationalError:
+                    states = []
+            finally:
+                legacy.close()
+
+            # Import sincrono: le letture successive devono trovare l'account
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.execute(
+                        "insert or ignore into accounts values (?,?,?,?,?,?)",
+                        (nickname, *row, None)
+                    )
+                    now = int(time.time())
+                    conn.executemany(
+                        "insert or ignore into entities values (?,?,?,?,?,?,?)",
+                        [(nickname, *entity, now) for entity in entities]
+                    )
+                    conn.executemany(
+                        "insert or ignore into update_state values (?,?,?,?,?,?)",
+                        [(nickname, *state) for state in states]
+                    )
+            finally:
+                conn.close()
+
+            log_info(f"Sessione {session_file} importata nell'archivio condiviso", "sessions.log")
+            return True
+        except Exception as e:
+            log_error(f"Errore durante l'importazione della sessione {session_file}: {e}")
+            return False
+
+    def close(self, timeout=10):
+        """Salva le scritture in sospeso prima della chiusura del programma"""
+        self.flush(timeout)
+
+# Singleton globale del SessionStore
+session_store = SessionStore()
+
+# Le scritture accodate non devono andare perse all'uscita
+atexit.register(session_store.close)
@@ -0,0 +1,410 @@
+"""
+Download di un archivio con più account contemporaneamente
+
+Quando più account hanno accesso allo stesso gruppo, l'intervallo degli
+ID dei messaggi viene diviso in frammenti scaricati in parallelo, ognuno
+con i limiti di richieste del proprio account. Un account che resta senza
+lavoro prende metà del frammento più grande di un altro account, oppure
+tutta la parte rimanente se quell'account è fermo per un FloodWait.
+Media e testo finiscono nella stessa cartella dell'archivio: il testo di
+ogni frammento viene scritto in un file separato e unito in ordine alla fine.
+"""
+
+import asyncio
+import glob
+import os
+import time
+import traceback
+from collections import deque
+from datetime import datetime
+from telethon import types, utils
+
+from archive_checkpoint import ArchiveCheckpoint
+from archive_pipeline import ArchivePipeline
+from exported_senders import exported_senders
+from lazy_media import get_lazy_index
+from media_handler import (
+    create_client_for_operation, get_messages_file, write_archive_report, update_message_export, download_group_archive
+)
+from rate_limiter import request_scheduler
+from path_resolver import path_resolver
+from session_manager import session_manager
+from text_writer import text_writer
+from utils import load_json, log_error, log_info
+from config import ARCHIVE_DIR, USER_GROUPS_FILE, ARCHIVE_SHARD_SIZE, ARCHIVE_SHARD_MIN_STEAL
+
+def find_group_accounts(group_id):
+    """Restituisce gli account che hanno accesso a un gruppo secondo user_groups.json"""
+    user_groups = load_json(USER_GROUPS_FILE) or {}
+    return [
+        nickname for nickname, groups in user_groups.items()
+        if any(str(group['id']) == str(group_id) for group in groups)
+    ]
+
+def is_shardable(group_id):
+    """
+    Verifica se un gruppo può essere diviso tra più account
+
+    Solo canali e supergruppi hanno ID dei messaggi comuni a tutti gli
+    account; nei gruppi base ogni account numera i messaggi a modo suo,
+    quindi un intervallo di ID letto da un altro account contiene altri
+    messaggi.
+    """
+    try:
+        return utils.resolve_id(int(group_id))[1] is types.PeerChannel
+    except (TypeError, ValueError):
+        return False
+
+class Shard:
+    """Intervallo di ID di messaggi assegnato a un account"""
+
+    def __init__(self, index, first_id, last_id):
+        self.index = index
+        self.first_id = first_id
+        self.last_id = last_id
+        self.next_id = first_id
+        self.owner = None
+
+    @property
+    def remaining(self):
+        """ID ancora da leggere nel frammento"""
+        return self.last_id - self.next_id + 1
+
+class ShardCheckpoint:
+    """
+    Checkpoint visto dalla pipeline di un frammento
+
+    I media vengono registrati nel checkpoint dell'archivio, mentre
+    l'avanzamento viene salvato solo quando tutti i frammenti sono completi.
+    """
+
+    def __init__(self, checkpoint, retry_failed=False):
+        self.checkpoint = checkpoint
+        self.max_id = checkpoint.max_id
+        self.text_id = checkpoint.text_id
+        # I media non scaricati in precedenza vengono ritentati da un solo frammento
+        self.failed = checkpoint.failed if retry_failed else set()
+
+    def has_media(self, message_id):
+        return self.checkpoint.has_media(message_id)
+
+    def record_media(self, message_id, file_path):
+        self.checkpoint.record_media(message_id, file_path)
+
+    def record_failure(self, message_id):
+        self.checkpoint.record_failure(message_id)
+
+    def save(self, max_id=None, text_id=None):
+        pass
+
+class ShardedArchive:
+    """Archivio di un gruppo scaricato in parallelo da più account"""
+
+    def __init__(self, selected_group, nicknames, operation_id, base_dir=ARCHIVE_DIR, shard_size=ARCHIVE_SHARD_SIZE,
+                 filters=None, progress=None, lazy=False):
+        """
+        Inizializza l'archivio
+
+        Args:
+            selected_group: Gruppo selezionato ({"user", "group"}); l'archivio
+                viene salvato nella cartella di questo account
+            nicknames: Altri account con accesso al gruppo
+            operation_id: ID dell'operazione
+            filters: ArchiveFilter opzionale
+            progress: ArchiveProgress opzionale, condiviso da tutti i frammenti
+            lazy: Salva solo miniature e metadati dei media
+        """
+        self.nickname = selected_group["user"]
+        self.group = selected_group["group"]
+        self.nicknames = list(dict.fromkeys([self.nickname] + list(nicknames)))
+        self.operation_id = operation_id
+        self.filters = filters
+        self.progress = progress
+        if progress:
+            progress.completion = self._completion
+        self.base_dir = filters.base_dir if filters else base_dir
+        self.shard_size = shard_size
+        self.archive_path = path_resolver.group_dir(self.group["name"], self.nickname, self.base_dir, self.group["id"])
+        self.lazy = lazy
+        self.lazy_media = None
+
+        self.clients = {}
+        self.sessions = []
+        self.shards = []
+        self.pending = deque()
+        self.active = set()
+        self.user_cache = {}
+        self.accounts = {nickname: {'shards': 0, 'messages': 0, 'status': 'connecting'} for nickname in self.nicknames}
+        self.stats = {
+            'total_messages': 0,
+            'media_count': 0,
+            'media_previews': 0,
+            'media_skipped': 0,
+            'text_count': 0,
+            'shards': 0,
+            'steals': 0
+        }
+
+    async def run(self):
+        """
+        Scarica l'archivio con tutti gli account disponibili
+
+        Returns:
+            Dictionary con le statistiche del download
+        """
+        os.makedirs(self.archive_path, exist_ok=True)
+        loop = asyncio.get_running_loop()
+        checkpoint = await loop.run_in_executor(None, ArchiveCheckpoint, self.archive_path)
+        if self.lazy:
+            self.lazy_media = await loop.run_in_executor(None, get_lazy_index, self.archive_path)
+
+        # Il testo di un'esecuzione interrotta viene letto di nuovo
+        self._remove_parts()
+
+        try:
+            await asyncio.gather(*[self._connect(nickname) for nickname in self.nicknames])
+            if not self.clients:
+                raise RuntimeError(f"Nessun account può accedere al gruppo {self.group['name']}")
+
+            last_id = await self._get_last_id()
+            self._split(checkpoint.max_id + 1, last_id)
+            print(f"🧩 {len(self.shards)} frammenti di messaggi per {len(self.clients)} account: {', '.join(self.clients)}")
+
+            await asyncio.gather(*[self._worker(nickname, checkpoint) for nickname in list(self.clients)])
+            if self.pending:
+                raise RuntimeError(f"Archivio incompleto: {len(self.pending)} frammenti non scaricati")
+
+            await loop.run_in_executor(None, self._merge_parts)
+            checkpoint.save(max_id=last_id, text_id=last_id)
+        finally:
+            # Salva comunque i media da ritentare
+            checkpoint.save()
+            await self._disconnect_all()
+
+        self.stats['shards'] = len(self.shards)
+        return self.stats
+
+    async def _connect(self, nickname):
+        """Connette un account e ottiene il gruppo; gli account senza accesso vengono esclusi"""
+        session_id = f"{self.operation_id}_{nickname}"
+        self.sessions.append((session_id, nickname))
+        exported_senders.hold(nickname)
+
+        client = None
+        try:
+            client, _ = await create_client_for_operation(nickname, session_id)
+            async with session_manager.use(nickname):
+                await client.start()
+            entity = await client.get_entity(self.group["id"])
+            self.clients[nickname] = (client, entity)
+            self.accounts[nickname]['status'] = 'ready'
+            print(f"✅ {nickname} connesso a {utils.get_display_name(entity)}")
+        except Exception as e:
+            log_error(f"Account {nickname} escluso dall'archivio di {self.group['name']}: {e}")
+            self.accounts[nickname]['status'] = 'unavailable'
+            if client and client.is_connected():
+                await client.disconnect()
+
+    async def _disconnect_all(self):
+        """Disconnette tutti gli account e rilascia le sessioni"""
+        for nickname, (client, _) in self.clients.items():
+            try:
+                if client.is_connected():
+                    await client.disconnect()
+            except Exception as e:
+                log_error(f"Errore durante la disconnessione di {nickname}: {e}")
+
+        for session_id, nickname in self.sessions:
+            exported_senders.release_hold(nickname)
+            session_manager.release_session(session_id, nickname)
+
+    async def _get_last_id(self):
+        """ID del messaggio più recente del gruppo"""
+        client, entity = self.clients.get(self.nickname) or next(iter(self.clients.values()))
+        messages = await client.get_messages(entity, limit=1)
+        return messages[0].id if messages else 0
+
+    def _split(self, first_id, last_id):
+        """Divide l'intervallo di ID in frammenti"""
+        for start in range(first_id, last_id + 1, self.shard_size):
+            shard = Shard(len(self.shards), start, min(start + self.shard_size - 1, last_id))
+            self.shards.append(shard)
+            self.pending.append(shard)
+
+    def _completion(self):
+        """Frazione degli ID di tutti i frammenti già letti"""
+        total = sum(shard.last_id - shard.first_id + 1 for shard in self.shards)
+        if total <= 0:
+            return None
+        done = sum(min(shard.next_id, shard.last_id + 1) - shard.first_id for shard in self.shards)
+        return done / total
+
+    def _next_shard(self, nickname):
+        """Assegna a un account il prossimo frammento, dividendone uno già assegnato se necessario"""
+        shard = self.pending.popleft() if self.pending else self._steal(nickname)
+        if shard is not None:
+            shard.owner = nickname
+            self.active.add(shard)
+        return shard
+
+    def _steal(self, nickname):
+        """Prende una parte del lavoro rimasto a un altro account"""
+        candidates = [
+            shard for shard in self.active
+            if shard.owner != nickname and shard.remaining > ARCHIVE_SHARD_MIN_STEAL
+        ]
+        if not candidates:
+            return None
+
+        # Prima gli account fermi per FloodWait, poi il frammento con più lavoro rimasto
+        def priority(shard):
+            return (request_scheduler.get(shard.owner).blocked_for() > 0, shard.remaining)
+
+        victim = max(candidates, key=priority)
+        blocked = request_scheduler.get(victim.owner).blocked_for() > 0
+        split_id = victim.next_id if blocked else victim.next_id + victim.remaining // 2
+
+        shard = Shard(len(self.shards), split_id, victim.last_id)
+        victim.last_id = split_id - 1
+        self.shards.append(shard)
+        self.stats['steals'] += 1
+
+        log_info(
+            f"{nickname} prende i messaggi {shard.first_id}-{shard.last_id} da {victim.owner}"
+            f"{' (FloodWait)' if blocked else ''}",
+            "sharded_archive.log"
+        )
+        return shard
+
+    async def _worker(self, nickname, checkpoint):
+        """Scarica frammenti con un account finché c'è lavoro"""
+        client, entity = self.clients[nickname]
+        self.accounts[nickname]['status'] = 'downloading'
+
+        while True:
+            shard = self._next_shard(nickname)
+            if shard is None:
+                if not self.active:
+                    break
+                # Un altro account potrebbe restituire del lavoro
+                await asyncio.sleep(1)
+                continue
+
+            try:
+                await self._download_shard(client, entity, shard, checkpoint)
+            except Exception as e:
+                log_error(f"Errore di {nickname} sui messaggi {shard.first_id}-{shard.last_id}: {e}\n{traceback.format_exc()}")
+                if shard.remaining > 0:
+                    # La parte non scaricata torna agli altri account
+                    rest = Shard(len(self.shards), shard.next_id, shard.last_id)
+                    shard.last_id = shard.next_id - 1
+                    self.shards.append(rest)
+                    self.pending.append(rest)
+                self.accounts[nickname]['status'] = 'failed'
+                return
+            finally:
+                self.active.discard(shard)
+
+        self.accounts[nickname]['status'] = 'completed'
+
+    async def _iter_shard(self, client, entity, shard):
+        """Messaggi di un frammento dal più vecchio al più recente"""
+        if self.filters:
+            history = self.filters.iter_messages(client, entity, min_id=shard.first_id - 1, max_id=shard.last_id + 1)
+        else:
+            history = client.iter_messages(entity, min_id=shard.first_id - 1, max_id=shard.last_id + 1, reverse=True)
+
+        async for message in history:
+            # La parte finale del frammento può essere passata a un altro account
+            if message.id > shard.last_id:
+                break
+            shard.next_id = message.id + 1
+            yield message
+        shard.next_id = shard.last_id + 1
+
+    def _part_file(self, shard):
+        return os.path.join(self.archive_path, f"messages.{shard.index:05d}.part")
+
+    async def _download_shard(self, client, entity, shard, checkpoint):
+        """Scarica un frammento con la pipeline dell'account assegnato"""
+        pipeline = ArchivePipeline(
+            client, entity, self.group["name"], self.nickname, self.base_dir,
+            checkpoint=ShardCheckpoint(checkpoint, retry_failed=shard.index == 0),
+            history=self._iter_shard(client, entity, shard),
+            messages_file=self._part_file(shard),
+            progress=self.progress,
+            lazy_media=self.lazy_media
+        )
+        stats = await pipeline.run()
+
+        for key in ('total_messages', 'media_count', 'media_previews', 'media_skipped', 'text_count'):
+            self.stats[key] += stats[key]
+        self.user_cache.update(pipeline.user_cache)
+        self.accounts[shard.owner]['shards'] += 1
+        self.accounts[shard.owner]['messages'] += stats['total_messages']
+
+    def _remove_parts(self):
+        """Elimina i file di testo dei frammenti di un'esecuzione precedente"""
+        for path in glob.glob(os.path.join(self.archive_path, "messages.*.part")):
+            os.remove(path)
+
+    def _merge_parts(self):
+        """Aggiunge a messages.txt il testo dei frammenti in ordine di ID"""
+        messages_file = get_messages_file(self.group["name"], self.nickname, self.base_dir, self.group["id"])
+        with open(messages_file, 'a', encoding='utf-8') as output:
+            for shard in sorted(self.shards, key=lambda shard: shard.first_id):
+                part_file = self._part_file(shard)
+                if os.path.exists(part_file):
+                    with open(part_file, 'r', encoding='utf-8') as part:
+                        for line in part:
+                            output.write(line)
+                    os.remove(part_file)
+
+async def download_sharded_archive(selected_group, operation_id=None, accounts=None, filters=None, progress=None,
+                                   lazy=False):
+    """
+    Scarica l'archivio di un gruppo con tutti gli account che vi hanno accesso
+
+    Args:
+        selected_group: Gruppo selezionato ({"user", "group"})
+        operation_id: ID dell'operazione
+        accounts: Dictionary aggiornato con lo stato dei singoli account (opzionale)
+        filters: ArchiveFilter opzionale
+        progress: ArchiveProgress opzionale per l'avanzamento in tempo reale
+        lazy: Salva solo miniature e metadati dei media
+
+    Returns:
+        True se il download è stato completato
+    """
+    group = selected_group["group"]
+    operation_id = operation_id or f"archive_{int(time.time())}"
+    if not is_shardable(group["id"]):
+        # Gruppo base: gli ID dei messaggi non sono condivisi tra gli account
+        log_info(f"{group['name']} non è un supergruppo o un canale: archivio con il solo account {selected_group['user']}",
+                 "sharded_archive.log")
+        return await download_group_archive(selected_group, None, operation_id, filters, progress, lazy)
+    nicknames = find_group_accounts(group["id"])
+
+    print(f"\n📥 Avvio download archivio multi-account per: {group['name']}")
+    print(f"👥 Account con accesso: {', '.join(dict.fromkeys([selected_group['user']] + nicknames))}")
+
+    archive = ShardedArchive(selected_group, nicknames, operation_id, filters=filters, progress=progress, lazy=lazy)
+    if accounts is not None:
+        accounts.update(archive.accounts)
+        archive.accounts = accounts
+
+    os.makedirs(archive.archive_path, exist_ok=True)
+    log_file = os.path.join(archive.archive_path, "download_log.txt")
+    text_writer.append(log_file, f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Avvio download archivio multi-account per "
+                       f"{group['name']} (ID: {group['id']}) con {', '.join(archive.nicknames)}\n")
+
+    start_time = time.time()
+    try:
+        stats = await archive.run()
+        write_archive_report(archive.archive_path, group["name"], group["id"], stats, archive.user_cache, time.time() - start_time)
+        await update_message_export(archive.archive_path, group["id"], [archive.nickname], filters)
+        text_writer.append(log_file, f"Frammenti: {stats['shards']} (ridistribuiti: {stats['steals']})\n")
+        return True
+    except Exception as e:
+        log_error(f"Errore durante il download dell'archivio multi-account: {e}\n{traceback.format_exc()}")
+        return False
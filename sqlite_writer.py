@@ -0,0 +1,141 @@
+"""
+Thread scrittore condiviso dagli archivi SQLite
+
+Archivio delle sessioni, archivio dei messaggi e indice dei media non
+scrivono mai direttamente sul database: le scritture vengono accodate e
+applicate da un unico thread per archivio, raggruppate in transazioni
+fino a batch_size scritture o flush_interval secondi. Le letture usano
+connessioni proprie di ogni thread, in parallelo grazie alla modalità WAL.
+"""
+
+import queue
+import sqlite3
+import threading
+import time
+from utils import log_error
+
+def connect_wal(db_file):
+    """Apre una connessione a un database SQLite in modalità WAL"""
+    conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+    conn.execute("pragma journal_mode=wal")
+    conn.execute("pragma synchronous=normal")
+    conn.execute("pragma busy_timeout=30000")
+    return conn
+
+class SQLiteWriter:
+    """
+    Scritture accodate di un archivio SQLite
+
+    Ogni scrittura indica il database a cui è destinata (key, passata a
+    connect): le scritture di un blocco vengono applicate in una
+    transazione per database, nell'ordine in cui sono state accodate.
+    """
+
+    def __init__(self, name, connect, flush_interval, batch_size, description, on_commit=None):
+        """
+        Inizializza lo scrittore (il thread parte alla prima scrittura)
+
+        Args:
+            name: Nome del thread
+            connect: Funzione che dalla chiave restituisce una nuova connessione
+            flush_interval: Secondi massimi di attesa prima di salvare un blocco
+            batch_size: Scritture massime per blocco
+            description: Archivio mostrato nei messaggi di errore ("nell'archivio dei messaggi")
+            on_commit: Funzione chiamata con chiave e scritture (sql, rows) dopo ogni transazione
+        """
+        self.name = name
+        self.connect = connect
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.description = description
+        self.on_commit = on_commit
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        """True se il thread scrittore è stato avviato"""
+        return self._thread is not None
+
+    def _ensure_thread(self):
+        """Avvia il thread scrittore al primo utilizzo"""
+        if self._thread is not None:
+            return
+
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._thread.start()
+
+    def enqueue(self, sql, rows, key=None):
+        """
+        Accoda una scrittura
+
+        Args:
+            sql: Istruzione da eseguire con executemany
+            rows: Parametri dell'istruzione
+            key: Database di destinazione (per gli archivi con un database per account)
+        """
+        self._ensure_thread()
+        self._queue.put((key, sql, rows))
+
+    def _run(self):
+        """Applica le scritture accodate raggruppandole in una transazione per database"""
+        connections = {}
+
+        while True:
+            batch = [self._queue.get()]
+
+            # Raccogli altre scritture fino al limite di dimensione o di tempo
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size and not isinstance(batch[-1], threading.Event):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            waiters = [item for item in batch if isinstance(item, threading.Event)]
+            writes = {}
+            for item in batch:
+                if not isinstance(item, threading.Event):
+                    key, sql, rows = item
+                    writes.setdefault(key, []).append((sql, rows))
+
+            for key, statements in writes.items():
+                try:
+                    conn = connections.get(key)
+                    if conn is None:
+                        conn = connections[key] = self.connect(key)
+                    with conn:
+                        for sql, rows in statements:
+                            conn.executemany(sql, rows)
+                    if self.on_commit:
+                        self.on_commit(key, statements)
+                except Exception as e:
+                    target = f" di {key}" if key is not None else ""
+                    log_error(f"Errore durante la scrittura {self.description}{target}: {e}")
+
+            for waiter in waiters:
+                waiter.set()
+
+    def flush(self, timeout=10):
+        """
+        Attende che tutte le scritture accodate siano salvate
+
+        Returns:
+            True se le scritture sono state salvate entro il timeout
+        """
+        if self._thread is None:
+            return True
+
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def pending(self):
+        """Numero di scritture in coda"""
+        return self._queue.qsize()
@@ -11,7 +11,7 @@ import argparse
 import time
 import threading
 from api_server import run_api_server
-from api_config import API_HOST, API_PORT, API_DEBUG
+from api_config import API_HOST, API_PORT, API_DEBUG, API_WARMUP
 from utils import log_info, log_error
 
 def parse_arguments():
@@ -27,6 +27,9 @@ def parse_arguments():
     parser.add_argument('--debug', action='store_true', default=API_DEBUG,
                        help='Avvia in modalità debug')
     
+    parser.add_argument('--warmup', action='store_true', default=API_WARMUP,
+                       help='Connetti tutti gli account prima di segnalare il server come pronto')
+    
     return parser.parse_args()
 
 def main():
@@ -44,6 +47,19 @@ def main():
         if orphaned_sessions:
             print(f"⚠️ Rilevate {len(orphaned_sessions)} sessioni orfane in uso. Alcune funzionalità potrebbero essere limitate.")
         
+        # Preriscalda le connessioni in background: /api/status indica quando è concluso
+        if args.warmup:
+            from connection_pool import connection_pool
+            print("🔥 Preriscaldamento delle connessioni in corso...")
+            connection_pool.start_warm_up()
+        
+        # Riprendi le operazioni di archivio rimaste in coda o interrotte dall'ultimo arresto
+        import api_routes  # registra i tipi di job della coda
+        from job_queue import job_queue
+        resumed_jobs = job_queue.resume()
+        if resumed_jobs:
+            print(f"📋 Riprese {resumed_jobs} operazioni di archivio in coda")
+        
         # Registro l'avvio nei log
         log_info(f"API Server avviato su {args.host}:{args.port}", "api_server.log")
         
@@ -57,6 +73,14 @@ def main():
         log_error(error_msg)
         print(f"\n❌ {error_msg}")
         return 1
+    finally:
+        # Ferma la coda dei job e chiudi le connessioni persistenti verso Telegram
+        from connection_pool import connection_pool
+        from telegram_engine import telegram_engine
+        from job_queue import job_queue
+        job_queue.stop()
+        connection_pool.close()
+        telegram_engine.stop()
     
     return 0
 
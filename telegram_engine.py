@@ -0,0 +1,201 @@
+"""
+Motore asincrono unico per tutte le operazioni Telegram
+
+Questo modulo esegue un solo loop di eventi asyncio persistente in un
+thread dedicato. Le route Flask vi inviano le coroutine e ricevono un
+future, così i client Telethon (legati al loop su cui sono creati)
+possono essere riutilizzati tra richieste diverse e il numero di thread
+resta costante indipendentemente dal carico.
+"""
+
+import asyncio
+import threading
+import time
+from utils import log_error, log_info
+
+class TelegramEngine:
+    """
+    Thread con il loop di eventi condiviso dalle operazioni Telegram
+
+    Le operazioni di lunga durata (archivi, monitoraggio) possono essere
+    registrate con un nome, per consultarne lo stato o annullarle.
+    """
+
+    def __init__(self):
+        """Inizializza il motore senza avviare il thread"""
+        self.tasks = {}
+        self.tasks_lock = threading.RLock()
+        self._loop = None
+        self._thread = None
+        self._loop_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        """Avvia il thread del motore se non è già in esecuzione"""
+        with self._loop_lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._run_loop,
+                    args=(self._loop,),
+                    name="telegram-engine",
+                    daemon=True
+                )
+                self._thread.start()
+                log_info("Motore Telegram avviato", "api_server.log")
+            return self._loop
+
+    def _run_loop(self, loop):
+        """Esegue il loop di eventi nel thread del motore"""
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            loop.close()
+
+    @property
+    def loop(self):
+        """Loop di eventi del motore (avviato al primo accesso)"""
+        return self._ensure_loop()
+
+    def is_running(self):
+        """Verifica se il thread del motore è attivo"""
+        return self._thread is not None and self._thread.is_alive()
+
+    def submit(self, coro, name=None, task_type=None):
+        """
+        Invia una coroutine al loop del motore
+
+        Args:
+            coro: Coroutine da eseguire
+            name: Nome con cui registrare l'operazione (opzionale)
+            task_type: Tipo dell'operazione, mostrato nello stato
+
+        Returns:
+            concurrent.futures.Future con il risultato della coroutine
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+        if name:
+            with self.tasks_lock:
+                self.tasks[name] = {
+                    'future': future,
+                    'type': task_type,
+                    'started_at': time.time()
+                }
+
+            def _forget(done, name=name):
+                with self.tasks_lock:
+                    if self.tasks.get(name, {}).get('future') is done:
+                        del self.tasks[name]
+
+            future.add_done_callback(_forget)
+
+        return future
+
+    def run(self, coro, timeout=None):
+        """
+        Esegue una coroutine sul motore e ne attende il risultato
+
+        Da non usare dal thread del motore stesso.
+
+        Args:
+            coro: Coroutine da eseguire
+            timeout: Secondi massimi di attesa (None = nessun limite)
+
+        Returns:
+            Il risultato della coroutine
+        """
+        return self.submit(coro).result(timeout)
+
+    def call_later(self, delay, callback, *args):
+        """Pianifica una funzione sul loop del motore dopo 'delay' secondi"""
+        loop = self._ensure_loop()
+        loop.call_soon_threadsafe(loop.call_later, delay, callback, *args)
+
+    def cancel(self, name):
+        """
+        Annulla un'operazione registrata
+
+        Args:
+            name: Nome dell'operazione
+
+        Returns:
+            True se l'operazione era in corso ed è stata annullata
+        """
+        with self.tasks_lock:
+            task = self.tasks.get(name)
+
+        if task is None:
+            return False
+        return task['future'].cancel()
+
+    def get_status(self):
+        """
+        Ottiene lo stato del motore e delle operazioni registrate
+
+        Returns:
+            Dictionary con lo stato del motore
+        """
+        with self.tasks_lock:
+            tasks = {
+                name: {
+                    'type': task['type'],
+                    'started_at': task['started_at'],
+                    'running': not task['future'].done()
+                }
+                for name, task in self.tasks.items()
+            }
+
+        loop = self._loop
+        pending = 0
+        if loop is not None and not loop.is_closed() and self.is_running():
+            try:
+                pending = asyncio.run_coroutine_threadsafe(self._count_tasks(), loop).result(5)
+            except Exception as e:
+                log_error(f"Impossibile leggere lo stato del motore Telegram: {e}")
+
+        return {
+            'running': self.is_running(),
+            'pending_coroutines': pending,
+            'threads': threading.active_count(),
+            'tasks': tasks
+        }
+
+    async def _count_tasks(self):
+        """Conta le coroutine attive sul loop, esclusa quella corrente"""
+        return len(asyncio.all_tasks()) - 1
+
+    def stop(self, timeout=10):
+        """
+        Annulla le operazioni in corso e ferma il loop del motore
+
+        Args:
+            timeout: Secondi massimi di attesa per l'annullamento
+        """
+        with self._loop_lock:
+            loop = self._loop
+            thread = self._thread
+            self._loop = None
+            self._thread = None
+
+        if loop is None or loop.is_closed():
+            return
+
+        async def _shutdown():
+            current = asyncio.current_task()
+            pending = [task for task in asyncio.all_tasks() if task is not current]
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        try:
+            asyncio.run_coroutine_threadsafe(_shutdown(), loop).result(timeout)
+        except Exception as e:
+            log_error(f"Errore durante l'arresto del motore Telegram: {e}")
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            if thread is not None:
+                thread.join(timeout)
+
+# Singleton globale del TelegramEngine
+telegram_engine = TelegramEngine()
@@ -35,6 +35,12 @@ def archive_status(data):
     print(data)
     events_received.append({"type": "archive_status", "data": data, "time": time.time()})
 
+@sio.event
+def archive_progress(data):
+    print("\nRicevuto evento archive_progress:")
+    print(data)
+    events_received.append({"type": "archive_progress", "data": data, "time": time.time()})
+
 @sio.event
 def server_pong(data):
     print("\nRicevuto pong dal server:")
@@ -0,0 +1,220 @@
+"""
+Scrittura in background dei file di testo (log e metadati)
+
+Log, metadati dei media e registri degli inoltri venivano scritti con un
+open(..., "a") per ogni riga, direttamente nel loop di eventi: nei gruppi
+più attivi l'I/O bloccante rallentava la gestione degli aggiornamenti.
+Le righe vengono ora accodate e scritte da un unico thread, che tiene
+aperti i file più usati e li aggiorna a blocchi (group commit) quando le
+righe accodate superano TEXT_WRITER_BATCH_BYTES o dopo
+TEXT_WRITER_FLUSH_INTERVAL secondi.
+
+Durabilità (TEXT_WRITER_DURABILITY):
+- "buffered": le righe restano nel buffer del file fino al riempimento o alla chiusura
+- "flush": ogni blocco viene passato al sistema operativo (sopravvive a un crash del programma)
+- "fsync": ogni blocco viene anche forzato su disco (sopravvive a un'interruzione di corrente)
+
+replace() sostituisce invece l'intero contenuto di un file (ad esempio un
+checkpoint) dopo aver scritto le righe accodate prima.
+"""
+
+import atexit
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from config import (
+    TEXT_WRITER_FLUSH_INTERVAL, TEXT_WRITER_BATCH_BYTES, TEXT_WRITER_DURABILITY, TEXT_WRITER_MAX_OPEN_FILES
+)
+
+DURABILITY_MODES = ("buffered", "flush", "fsync")
+
+class TextWriter:
+    """
+    Scrittore asincrono dei file di testo in modalità append
+
+    append() non tocca mai il disco; flush() permette di attendere che le
+    righe già accodate siano scritte.
+    """
+
+    def __init__(self, flush_interval=TEXT_WRITER_FLUSH_INTERVAL, batch_bytes=TEXT_WRITER_BATCH_BYTES,
+                 durability=TEXT_WRITER_DURABILITY, max_open_files=TEXT_WRITER_MAX_OPEN_FILES):
+        """Inizializza lo scrittore (il thread parte alla prima scrittura)"""
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f"Durabilità non valida: {durability} (valide: {', '.join(DURABILITY_MODES)})")
+
+        self.flush_interval = flush_interval
+        self.batch_bytes = batch_bytes
+        self.durability = durability
+        self.max_open_files = max(1, max_open_files)
+        self._queue = queue.Queue()
+        self._handles = OrderedDict()
+        self._writer = None
+        self._lock = threading.Lock()
+        self.stats = {'lines': 0, 'commits': 0, 'bytes': 0}
+
+    def append(self, path, text):
+        """
+        Accoda del testo da aggiungere in fondo a un file
+
+        Args:
+            path: Percorso del file (la cartella viene creata se necessario)
+            text: Testo da aggiungere, comprensivo degli a capo
+        """
+        self._ensure_writer()
+        self._queue.put((path, text))
+
+    def replace(self, path, text):
+        """
+        Accoda la sostituzione atomica del contenuto di un file
+
+        Le righe accodate in precedenza vengono scritte prima della
+        sostituzione, che avviene con un file temporaneo e os.replace.
+
+        Args:
+            path: Percorso del file
+            text: Nuovo contenuto del file
+        """
+        self._ensure_writer()
+        self._queue.put((path, text, "replace"))
+
+    def _ensure_writer(self):
+        """Avvia il thread scrittore al primo utilizzo"""
+        if self._writer is not None:
+            return
+
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="text-writer", daemon=True)
+                self._writer.start()
+
+    def _writer_loop(self):
+        """Raccoglie le righe accodate e le scrive a blocchi"""
+        pending = {}
+        pending_bytes = 0
+        deadline = None
+
+        while True:
+            timeout = None if deadline is None else max(0, deadline - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if isinstance(item, tuple) and len(item) == 3:
+                # Le righe accodate prima della sostituzione vengono scritte per prime
+                self._commit(pending, force=True)
+                pending, pending_bytes, deadline = {}, 0, None
+                self._replace(item[0], item[1])
+                continue
+
+            if isinstance(item, tuple):
+                path, text = item
+                pending.setdefault(path, []).append(text)
+                pending_bytes += len(text)
+                if deadline is None:
+                    deadline = time.time() + self.flush_interval
+
+            # Scrivi il blocco allo scadere del tempo, oltre la dimensione massima o su richiesta
+            if item is None or isinstance(item, threading.Event) or pending_bytes >= self.batch_bytes:
+                self._commit(pending, force=item is not None and not isinstance(item, tuple))
+                pending, pending_bytes, deadline = {}, 0, None
+
+            if isinstance(item, threading.Event):
+                item.set()
+
+    def _handle(self, path):
+        """Restituisce il file aperto in append, chiudendo quello usato meno di recente oltre il limite"""
+        handle = self._handles.get(path)
+        if handle is not None:
+            self._handles.move_to_end(path)
+            return handle
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        handle = open(path, "a", encoding="utf-8")
+        self._handles[path] = handle
+
+        while len(self._handles) > self.max_open_files:
+            _, oldest = self._handles.popitem(last=False)
+            oldest.close()
+        return handle
+
+    def _commit(self, pending, force=False):
+        """
+        Scrive un blocco di righe
+
+        Args:
+            pending: Dictionary percorso -> testi da aggiungere
+            force: Passa al sistema operativo anche i file in modalità "buffered" (flush esplicito)
+        """
+        for path, texts in pending.items():
+            try:
+                handle = self._handle(path)
+                data = "".join(texts)
+                handle.write(data)
+                if self.durability != "buffered":
+                    handle.flush()
+                if self.durability == "fsync":
+                    os.fsync(handle.fileno())
+                self.stats['lines'] += len(texts)
+                self.stats['bytes'] += len(data)
+            except Exception as e:
+                # Niente log_error: scriverebbe a sua volta tramite questo thread
+                print(f"❌ ERRORE: scrittura di {path} non riuscita: {e}")
+
+        if force and self.durability == "buffered":
+            for handle in self._handles.values():
+                handle.flush()
+        if pending:
+            self.stats['commits'] += 1
+
+    def _replace(self, path, text):
+        """Sostituisce il contenuto di un file in modo atomico"""
+        temp_file = f"{path}.tmp"
+        try:
+            with open(temp_file, "w", encoding="utf-8") as f:
+                f.write(text)
+                if self.durability != "buffered":
+                    f.flush()
+                if self.durability == "fsync":
+                    os.fsync(f.fileno())
+            os.replace(temp_file, path)
+            self.stats['commits'] += 1
+        except Exception as e:
+            print(f"❌ ERRORE: scrittura di {path} non riuscita: {e}")
+
+    def flush(self, timeout=10):
+        """
+        Attende che tutte le righe accodate siano scritte
+
+        Returns:
+            True se le righe sono state scritte entro il timeout
+        """
+        if self._writer is None:
+            return True
+
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def get_status(self):
+        """Restituisce lo stato dello scrittore"""
+        return {
+            "durability": self.durability,
+            "pending": self._queue.qsize(),
+            "open_files": len(self._handles),
+            **self.stats
+        }
+
+    def close(self, timeout=10):
+        """Scrive le righe in sospeso prima della chiusura del programma"""
+        self.flush(timeout)
+
+# Singleton globale del TextWriter
+text_writer = TextWriter()
+
+# Le righe accodate non devono andare perse all'uscita
+atexit.register(text_writer.close)
@@ -0,0 +1,204 @@
+"""
+Cache condivisa delle informazioni sugli utenti
+
+Archivi e monitoraggi chiamavano get_entity per ogni nuovo mittente e
+perdevano le informazioni alla fine dell'operazione. Le informazioni
+vengono ora prese dagli utenti già restituiti da Telegram insieme ai
+messaggi; i mittenti mancanti vengono risolti con richieste GetUsers a
+blocchi. La cache è condivisa da tutti gli account e salvata
+nell'archivio delle sessioni, quindi sopravvive al riavvio.
+"""
+
+import threading
+import time
+from telethon import functions, types, utils
+from session_storage import session_store
+from utils import log_error
+from config import USER_CACHE_TTL, USER_RESOLVE_BATCH
+
+def get_user_info(entity):
+    """Costruisce il dizionario con le informazioni di un utente (o canale) di Telegram"""
+    return {
+        "id": utils.get_peer_id(entity),
+        "username": getattr(entity, 'username', None),
+        "first_name": getattr(entity, 'first_name', None),
+        "last_name": getattr(entity, 'last_name', None),
+        "display_name": utils.get_display_name(entity)
+    }
+
+def get_unknown_user_info(user_id):
+    """Informazioni di ripiego per un utente che non è stato possibile risolvere"""
+    return {"id": user_id, "display_name": f"User_{user_id}"}
+
+class UserCache:
+    """
+    Informazioni sugli utenti visti da qualsiasi account
+
+    Le voci più vecchie di USER_CACHE_TTL vengono usate solo se
+    l'utente non può essere risolto di nuovo.
+    """
+
+    def __init__(self, ttl=USER_CACHE_TTL):
+        """Inizializza la cache degli utenti"""
+        self.ttl = ttl
+        self.users = {}
+        self.lock = threading.RLock()
+        self.stats = {'hits': 0, 'from_messages': 0, 'resolved': 0, 'requests': 0}
+
+    def _is_fresh(self, entry):
+        return time.time() - entry[1] < self.ttl
+
+    def store(self, entity):
+        """
+        Aggiorna la cache con un'entità restituita da Telegram
+
+        Returns:
+            Dizionario con le informazioni sull'utente
+        """
+        info = get_user_info(entity)
+        now = int(time.time())
+        with self.lock:
+            entry = self.users.get(info["id"])
+            # Salva solo i cambiamenti o le voci da rinfrescare
+            if entry and entry[0] == info and self._is_fresh(entry):
+                return entry[0]
+            self.users[info["id"]] = (info, now)
+
+        session_store.save_users([(
+            info["id"], info["username"], info["first_name"],
+            info["last_name"], info["display_name"], now
+        )])
+        return info
+
+    def from_message(self, message):
+        """
+        Informazioni sul mittente di un messaggio, se Telegram le ha già restituite
+
+        Returns:
+            Dizionario con le informazioni sul mittente o None
+        """
+        sender = getattr(message, 'sender', None)
+        if sender is None:
+            return None
+        with self.lock:
+            self.stats['from_messages'] += 1
+        return self.store(sender)
+
+    def _lookup(self, user_ids):
+        """Cerca gli utenti in memoria e nell'archivio delle sessioni"""
+        with self.lock:
+            found = {user_id: self.users[user_id] for user_id in user_ids if user_id in self.users}
+
+        missing = [user_id for user_id in user_ids if user_id not in found]
+        if missing:
+            for user_id, username, first_name, last_name, display_name, date in session_store.get_users(missing):
+                info = {
+                    "id": user_id, "username": username, "first_name": first_name,
+                    "last_name": last_name, "display_name": display_name
+                }
+                found[user_id] = (info, date)
+            with self.lock:
+                for user_id in missing:
+                    if user_id in found:
+                        self.users.setdefault(user_id, found[user_id])
+
+        return found
+
+    def find_usernames(self, usernames):
+        """
+        ID degli utenti già visti con questi username, senza richieste a Telegram
+
+        Returns:
+            Dictionary username (minuscolo) -> ID dell'utente
+        """
+        wanted = {username.lstrip("@").lower() for username in usernames}
+        found = {}
+        with self.lock:
+            for info, _ in self.users.values():
+                if info.get("username") and info["username"].lower() in wanted:
+                    found[info["username"].lower()] = info["id"]
+
+        missing = wanted - set(found)
+        if missing:
+            for user_id, username, *_ in session_store.find_users(missing):
+                found.setdefault(username.lower(), user_id)
+        return found
+
+    async def resolve(self, client, user_ids):
+        """
+        Restituisce le informazioni di più utenti con il minor numero di richieste
+
+        Gli utenti non presenti (o scaduti) vengono richiesti con GetUsers a
+        blocchi, usando gli access hash già salvati nella sessione dell'account.
+
+        Args:
+            client: Client Telegram connesso
+            user_ids: ID degli utenti
+
+        Returns:
+            Dictionary ID -> informazioni sull'utente
+        """
+        user_ids = list(dict.fromkeys(user_id for user_id in user_ids if user_id))
+        cached = self._lookup(user_ids)
+        result = {user_id: entry[0] for user_id, entry in cached.items() if self._is_fresh(entry)}
+        with self.lock:
+            self.stats['hits'] += len(result)
+
+        # Access hash dalla sessione: nessuna richiesta a Telegram
+        input_users = []
+        others = []
+        for user_id in user_ids:
+            if user_id in result:
+                continue
+            try:
+                peer = client.session.get_input_entity(user_id)
+            except (ValueError, TypeError):
+                peer = None
+            if isinstance(peer, types.InputPeerUser):
+                input_users.append(types.InputUser(peer.user_id, peer.access_hash))
+            else:
+                others.append(user_id)
+
+        for start in range(0, len(input_users), USER_RESOLVE_BATCH):
+            chunk = input_users[start:start + USER_RESOLVE_BATCH]
+            try:
+                with self.lock:
+                    self.stats['requests'] += 1
+                users = await client(functions.users.GetUsersRequest(chunk))
+                for user in users:
+                    if isinstance(user, types.User):
+                        result[user.id] = self.store(user)
+                        with self.lock:
+                            self.stats['resolved'] += 1
+            except Exception as e:
+                log_error(f"Impossibile risolvere {len(chunk)} utenti: {e}")
+                others.extend(input_user.user_id for input_user in chunk)
+
+        # Canali come mittenti o utenti non presenti nella sessione
+        for user_id in others:
+            if user_id in result:
+                continue
+            try:
+                with self.lock:
+                    self.stats['requests'] += 1
+                result[user_id] = self.store(await client.get_entity(user_id))
+                with self.lock:
+                    self.stats['resolved'] += 1
+            except Exception as e:
+                log_error(f"Impossibile ottenere informazioni sull'utente {user_id}: {e}")
+
+        for user_id in user_ids:
+            if user_id not in result:
+                # Meglio un'informazione scaduta che nessuna
+                entry = cached.get(user_id)
+                result[user_id] = entry[0] if entry else get_unknown_user_info(user_id)
+
+        return result
+
+    def get_status(self):
+        """Restituisce lo stato della cache degli utenti"""
+        with self.lock:
+            return {"users": len(self.users), **self.stats}
+
+# Singleton globale della cache degli utenti
+user_cache = UserCache()
@@ -1,17 +1,16 @@
-import os
-import time
-import random
 import asyncio
-from telethon import TelegramClient
+from rate_limiter import ScheduledTelegramClient
+from session_manager import session_manager
+from session_storage import session_store
 from utils import load_json, save_json, log_error
 from config import API_ID, API_HASH, PHONE_NUMBERS_FILE
 
 async def create_client(nickname):
     """Crea un client con gestione migliorata delle sessioni."""
-    # Usa il client standard ma con parametri migliorati
-    session_path = f'session_{nickname}'
-    client = TelegramClient(
-        session_path, 
+    # Sessione dell'account nell'archivio condiviso
+    _, session = session_manager.create_session(nickname)
+    client = ScheduledTelegramClient(
+        session, 
         API_ID, 
         API_HASH,
         connection_retries=10,
@@ -53,24 +52,15 @@ async def verify_and_add_user(nickname, phone_number):
     client = await create_client(nickname)
     
     try:
-        # Evita conflitti con altre istanze
-        await asyncio.sleep(random.uniform(0.2, 0.5))
-        
-        # Aggiungi tentativi multipli per l'avvio
-        max_attempts = 5
-        for attempt in range(max_attempts):
-            try:
-                await client.start(phone_number)
-                break
-            except Exception as e:
-                if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                    print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                    await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                else:
-                    raise
+        # Il login crea la chiave di autorizzazione: accesso esclusivo all'account
+        async with session_manager.use(nickname, exclusive=True):
+            await client.start(phone_number)
+            
+            # Se arriviamo qui, la connessione è riuscita
+            await client.disconnect()
         
-        # Se arriviamo qui, la connessione è riuscita
-        await client.disconnect()
+        # Assicura che la nuova autorizzazione sia salvata
+        await asyncio.get_running_loop().run_in_executor(None, session_store.flush)
         
         # Aggiorna il file degli utenti
         phone_numbers = load_json(PHONE_NUMBERS_FILE)
@@ -109,15 +99,10 @@ def remove_user():
     del phone_numbers[nickname]
     save_json(PHONE_NUMBERS_FILE, phone_numbers)
     
-    # Rimuove il file di sessione se esiste
-    session_file = f'session_{nickname}.session'
-    if os.path.exists(session_file):
-        try:
-            # Attendi un po' per assicurarsi che il file non sia in uso
-            time.sleep(0.5)
-            os.remove(session_file)
-        except Exception as e:
-            print(f"⚠️ Impossibile rimuovere il file di sessione: {e}")
+    # Rimuove la sessione dall'archivio e il vecchio file se esiste
+    if not session_manager.delete(nickname):
+        print("⚠️ Impossibile rimuovere il file di sessione")
+    session_store.flush()
     
     print(f"✅ Utente '{nickname}' rimosso con successo.")
     return True
@@ -141,21 +126,8 @@ async def check_user_auth(nickname, phone_number):
     client = await create_client(nickname)
     
     try:
-        # Evita conflitti con altre istanze
-        await asyncio.sleep(random.uniform(0.2, 0.5))
-        
-        # Aggiungi tentativi multipli per l'avvio
-        max_attempts = 5
-        for attempt in range(max_attempts):
-            try:
-                await client.start(phone_number)
-                break
-            except Exception as e:
-                if "database is locked" in str(e).lower() and attempt < max_attempts - 1:
-                    print(f"⚠️ Database bloccato, nuovo tentativo in corso... ({attempt+1}/{max_attempts})")
-                    await asyncio.sleep(random.uniform(1, 3) * (attempt + 1))
-                else:
-                    raise
+        async with session_manager.use(nickname):
+            await client.start(phone_number)
                     
         # Ottieni info utente
         me = await client.get_me()
@@ -9,19 +9,16 @@ import sys
 import platform
 import subprocess
 from config import DOWNLOADS_DIR
+from text_writer import text_writer
 
 def log_error(message):
-    """Registra un errore in un file di log."""
-    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-    with open(os.path.join(DOWNLOADS_DIR, "errors.txt"), "a", encoding="utf-8") as f:
-        f.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}\n")
+    """Registra un errore in un file di log (scritto in background)."""
+    text_writer.append(os.path.join(DOWNLOADS_DIR, "errors.txt"), f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}\n")
     print(f"❌ ERRORE: {message}")
 
 def log_info(message, file_name="info.txt"):
-    """Registra un'informazione in un file di log."""
-    os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-    with open(os.path.join(DOWNLOADS_DIR, file_name), "a", encoding="utf-8") as f:
-        f.write(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}\n")
+    """Registra un'informazione in un file di log (scritto in background)."""
+    text_writer.append(os.path.join(DOWNLOADS_DIR, file_name), f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] {message}\n")
 
 def load_json(file_path):
     """Carica dati da un file JSON."""
@@ -141,7 +138,8 @@ async def retry_operation(func, *args, retries=3, delay=1, **kwargs):
         except Exception as e:
             if attempt <= retries:
                 print(f"⚠️ Tentativo {attempt}/{retries} fallito: {e}")
-                await asyncio.sleep(delay)
+                # Con un FloodWait attendi il tempo indicato da Telegram
+                await asyncio.sleep(getattr(e, 'seconds', None) or delay)
             else:
                 log_error(f"Operazione fallita dopo {retries} tentativi: {e}\n{traceback.format_exc()}")
                 raise
@@ -161,13 +159,14 @@ def acquire_lock(lock_file, instance_id):
     
     for attempt in range(max_retries):
         try:
-            if not os.path.exists(lock_path):
-                # Crea file di lock con ID dell'istanza
-                with open(lock_path, "w", encoding="utf-8") as f:
+            try:
+                # Creazione atomica: fallisce se un'altra istanza possiede il lock
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                with os.fdopen(fd, "w", encoding="utf-8") as f:
                     f.write(f"{instance_id}")
                 lock_acquired = True
                 break
-            else:
+            except FileExistsError:
                 # Verifica se il lock è scaduto (più di 5 secondi)
                 try:
                     mtime = os.path.getmtime(lock_path)